@@ -1,7 +1,7 @@
 import logging
 import os
-import shutil
-from typing import Optional
+import random
+from typing import Any, List, Optional
 
 import typer
 import uvicorn
@@ -25,6 +25,9 @@ def start(
     host: str = typer.Option("localhost", help="Host URL"),
     port: int = typer.Option(8000, help="URL port"),
     workers: int = typer.Option(1, help="Number of workers"),
+    watch: bool = typer.Option(
+        False, help="Add the documents created, changed or deleted to the vectorstore"
+    ),
     log_level: str = typer.Option("info", help="Log level (info, debug, warn, error)"),
 ) -> None:
     logging.basicConfig(level=logging.getLevelName(log_level.upper()))
@@ -32,6 +35,8 @@ def start(
     log_config["formatters"]["access"]["fmt"] = log_format
     log_config["formatters"]["default"]["fmt"] = log_format
     conf = parse_conf(config)
+    if watch:
+        conf.vector.watch = True
     llm = Llm(conf=conf)
     app = ChatEndpoint(llm=llm, conf=conf)
     uvicorn.run(
@@ -53,6 +58,9 @@ def build(
     documents: Optional[str] = typer.Option(
         None, help="Path to the folder containing documents to vectorize"
     ),
+    shards: Optional[int] = typer.Option(
+        None, help="Number of processes embedding the documents in parallel on CPU"
+    ),
     log_level: str = typer.Option("info", help="Log level (info, debug, warn, error)"),
 ) -> None:
     logging.basicConfig(level=logging.getLevelName(log_level.upper()))
@@ -65,15 +73,197 @@ def build(
         conf.vector.vector_path = vector
     if documents:
         conf.vector.documents_path = documents
+    if shards:
+        conf.vector.build_shards = shards
     log.info(
         f"Vectorizing documents from {BOLD}{documents}{END} as vectorstore in {conf.vector.vector_path}"
     )
     if conf.vector.vector_path and os.path.exists(conf.vector.vector_path):
-        shutil.rmtree(conf.vector.vector_path)
+        from libre_chat.backends import get_backend
+        from libre_chat.vectorstore import remove_vectorstore
+
+        remove_vectorstore(conf.vector.vector_path, get_backend(conf))
     Llm(conf=conf)
     log.info(f"Documents successfully vectorized in {BOLD}{conf.vector.vector_path}{END}")
 
 
+@cli.command("watch")
+def watch(
+    config: str = typer.Argument(
+        default_conf.conf_path, help="Path to the libre-chat YAML configuration file"
+    ),
+    vector: Optional[str] = typer.Option(None, help="Path to the vectorstore folder"),
+    documents: Optional[str] = typer.Option(
+        None, help="Path to the folder containing documents to vectorize"
+    ),
+    interval: Optional[float] = typer.Option(
+        None, help="Seconds between scans of the documents folder"
+    ),
+    log_level: str = typer.Option("info", help="Log level (info, debug, warn, error)"),
+) -> None:
+    """Add the documents created, changed or deleted in the documents folder to the vectorstore,
+    without starting the API. The workers of the API reload the vectorstore once updated."""
+    import torch
+
+    from libre_chat.jobs import IngestionJobs
+    from libre_chat.vectorstore import DEFAULT_DOCUMENT_LOADERS
+    from libre_chat.watcher import DocumentsWatcher
+
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()))
+    conf = parse_conf(config)
+    if vector:
+        conf.vector.vector_path = vector
+    if documents:
+        conf.vector.documents_path = documents
+    if interval:
+        conf.vector.watch_interval = interval
+    if not conf.vector.vector_path:
+        log.error("❌ No vectorstore path provided in the configuration")
+        raise typer.Exit(1)
+    device = torch.device(0) if torch.cuda.is_available() else torch.device("cpu")
+    jobs = IngestionJobs(conf, DEFAULT_DOCUMENT_LOADERS, device, conf.vector.vector_path)
+    watcher = DocumentsWatcher(conf, jobs, DEFAULT_DOCUMENT_LOADERS)
+    if not watcher.acquire():
+        log.error(f"❌ {conf.vector.documents_path} is already watched by another process")
+        raise typer.Exit(1)
+    jobs.on_done = lambda job: log.info(f"👀 {watcher.stats()}")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        jobs.close()
+
+
+@cli.command("text-cache")
+def text_cache(
+    config: str = typer.Argument(
+        default_conf.conf_path, help="Path to the libre-chat YAML configuration file"
+    ),
+    max_mb: Optional[float] = typer.Option(
+        None, help="Remove the least recently used entries until the cache is smaller"
+    ),
+    days: Optional[float] = typer.Option(
+        None, help="Remove the entries not used for this number of days"
+    ),
+    log_level: str = typer.Option("info", help="Log level (info, debug, warn, error)"),
+) -> None:
+    """Show the size of the cache of the text extracted from the documents, and prune it"""
+    from libre_chat.text_cache import TextCache
+
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()))
+    conf = parse_conf(config)
+    if not conf.vector.text_cache_path:
+        log.error("❌ The text cache is disabled, set vector.text_cache_path to enable it")
+        raise typer.Exit(1)
+    cache = TextCache(conf.vector.text_cache_path)
+    if max_mb is not None or days is not None:
+        removed = cache.prune(int(max_mb * 1024**2) if max_mb is not None else None, days)
+        log.info(f"🧹 Removed {removed} entries from the text cache")
+    for key, value in cache.stats().items():
+        print(f"{key:<12} {value}")
+
+
+@cli.command("bench")
+def bench(
+    config: str = typer.Argument(
+        default_conf.conf_path, help="Path to the libre-chat YAML configuration file"
+    ),
+    k: int = typer.Option(10, help="Number of documents retrieved by each query"),
+    queries: int = typer.Option(200, help="Number of queries, sampled from the chunks indexed"),
+    sample: int = typer.Option(
+        10000, help="Chunks embedded again when the vectors of the index cannot be read"
+    ),
+    index: List[str] = typer.Option(
+        [], help="Other FAISS index types to compare, e.g. HNSW32 or IVF1024,PQ16"
+    ),
+    nprobe: Optional[int] = typer.Option(None, help="IVF clusters visited by a search"),
+    ef_search: Optional[int] = typer.Option(None, help="HNSW search depth"),
+    log_level: str = typer.Option("info", help="Log level (info, debug, warn, error)"),
+) -> None:
+    """Report the recall@k against a flat search and the p50/p99 latency of the vectorstore index"""
+    import numpy as np
+
+    from libre_chat.backends import get_backend
+    from libre_chat.embeddings import close_embeddings, get_embeddings
+    from libre_chat.index import benchmark_indexes, index_description, index_vectors
+    from libre_chat.vectorstore import (
+        current_generation,
+        has_index,
+        load_manifest,
+        vectorstore_dir,
+    )
+
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()))
+    conf = parse_conf(config)
+    if nprobe:
+        conf.vector.nprobe = nprobe
+    if ef_search:
+        conf.vector.ef_search = ef_search
+    if conf.vector.backend != "faiss":
+        log.error(f"❌ Only the FAISS indexes can be benchmarked, not {conf.vector.backend}")
+        raise typer.Exit(1)
+    vector_path = conf.vector.vector_path
+    if not vector_path or not has_index(vector_path):
+        log.error(f"❌ No vectorstore found in {vector_path}, build it with libre-chat build")
+        raise typer.Exit(1)
+    embeddings = get_embeddings(conf, "cpu", ingest=True)
+    # Memory-mapped, only the chunks sampled are read
+    vectorstore: Any = get_backend(conf).load(
+        conf, vectorstore_dir(vector_path, current_generation(vector_path)), embeddings
+    )
+    doc_ids = list(vectorstore.index_to_docstore_id.values())
+    # The index actually built, flat if the one of the settings could not be trained
+    manifest = load_manifest(vector_path) or {}
+    factory = manifest.get("index", {}).get("factory") or index_description(conf)
+
+    def chunk_text(doc_id: str) -> str:
+        return str(vectorstore.docstore.search(doc_id).page_content)
+
+    rng = random.Random(0)
+    # The index deployed is benchmarked on all its vectors, read back from the index
+    vectors, exact = index_vectors(vectorstore.index)
+    existing_index = vectorstore.index
+    suffix = ""
+    if vectors is None:
+        # Only the indexes built from a sample of the chunks embedded again can be compared
+        sample_ids = rng.sample(doc_ids, min(sample, len(doc_ids)))
+        vectors = np.array(embeddings.embed_documents([chunk_text(i) for i in sample_ids]))
+        existing_index = None
+        exact = True
+        index = [factory, *index]
+        suffix = f" (sample of {len(sample_ids)})"
+        log.warning(
+            f"⚠️ The vectors of the vectorstore index cannot be read, the indexes are built and compared on a sample of {len(sample_ids)} chunks embedded again, not the vectorstore index"
+        )
+    elif not exact:
+        log.info(
+            "📏 The index compresses the vectors, the recall is measured against an exact search of the decoded vectors"
+        )
+    # Queries are the beginning of chunks, like a question about a passage of the documents
+    query_texts = [
+        " ".join(text.split()[: max(len(text.split()) // 2, 1)])
+        for text in (chunk_text(i) for i in rng.sample(doc_ids, min(queries, len(doc_ids))))
+    ]
+    log.info(f"📏 Benchmarking {len(query_texts)} queries on {len(vectors)} chunks")
+    results = benchmark_indexes(
+        conf,
+        vectors,
+        np.array([embeddings.embed_query(text) for text in query_texts]),
+        k=k,
+        index=existing_index,
+        index_factories=index,
+        exact=exact,
+        index_name=f"{factory} (vectorstore)",
+    )
+    for res in results:
+        res["index"] += suffix
+    close_embeddings(embeddings)
+    print(f"{'index':<32} {'recall@' + str(k):>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for res in results:
+        print(
+            f"{res['index']:<32} {res[f'recall@{k}']:>10} {res['p50_ms']:>10} {res['p99_ms']:>10}"
+        )
+
+
 @cli.command("version")
 def version() -> None:
     print(__version__)
@@ -0,0 +1,392 @@
+"""Module: Backends storing the chunks of the documents and their vectors"""
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS, Qdrant
+from qdrant_client import QdrantClient, models
+
+from libre_chat.conf import ChatConf
+from libre_chat.docstore import has_chunks, load_mmap_vectorstore, write_chunks
+from libre_chat.index import create_index, estimate_recall, is_flat, tune_index
+from libre_chat.utils import BOLD, CYAN, END, log
+
+__all__ = [
+    "Batch",
+    "FaissBackend",
+    "QdrantBackend",
+    "VectorBackend",
+    "get_backend",
+    "lock_qdrant_storage",
+]
+
+# Texts, vectors, metadatas and ids of a batch of chunks embedded
+Batch = Tuple[List[str], List[List[float]], List[Dict[str, Any]], List[str]]
+
+QDRANT_DIR = "qdrant"
+QDRANT_COLLECTION = "libre_chat_rag"
+# Server and collection of a generation stored in a Qdrant server
+QDRANT_SERVER_FILE = "server.json"
+# Files or folders holding the vectors of a generation, for each backend
+INDEX_FILES = ["index.faiss", QDRANT_DIR]
+
+
+class VectorBackend:
+    """
+    Storage of the chunks of the documents and their vectors. The ingestion and the retrieval
+    only use these methods, and the langchain VectorStore returned by the backend.
+    Each generation of the vectorstore is saved by the backend in its own folder.
+    """
+
+    def train_size(self, conf: ChatConf) -> int:
+        """Number of vectors to embed before creating the store, to train its index."""
+        return 1
+
+    def create(
+        self,
+        conf: ChatConf,
+        embeddings: Embeddings,
+        batches: List[Batch],
+        manifest: Optional[Dict[str, Any]] = None,
+    ) -> VectorStore:
+        """Create a store with the first batches embedded."""
+        raise NotImplementedError
+
+    def add(self, store: Any, batch: Batch) -> None:
+        raise NotImplementedError
+
+    def can_delete(self, conf: ChatConf) -> bool:
+        """If chunks can be removed from the store, otherwise it is rebuilt."""
+        return True
+
+    def delete(self, store: Any, ids: List[str]) -> None:
+        raise NotImplementedError
+
+    def count(self, store: Any) -> int:
+        raise NotImplementedError
+
+    def save(self, store: Any, path: str) -> None:
+        """Save the store in the folder of a new generation. The generation is loaded to query it."""
+        raise NotImplementedError
+
+    def load(
+        self, conf: ChatConf, path: str, embeddings: Embeddings, update: bool = False
+    ) -> VectorStore:
+        """Load the store saved in the folder of a generation, to query it, or to update it
+        and save it as a new generation."""
+        raise NotImplementedError
+
+    def remove(self, path: str) -> None:
+        """Remove what a generation stores outside of its folder, before the folder is removed."""
+
+
+class FaissBackend(VectorBackend):
+    """FAISS index and chunks loaded in memory, or memory-mapped for querying."""
+
+    def train_size(self, conf: ChatConf) -> int:
+        return 1 if is_flat(conf) else conf.vector.index_train_size
+
+    def create(
+        self,
+        conf: ChatConf,
+        embeddings: Embeddings,
+        batches: List[Batch],
+        manifest: Optional[Dict[str, Any]] = None,
+    ) -> FAISS:
+        if is_flat(conf):
+            texts, vectors, metadatas, ids = batches[0]
+            vectorstore = FAISS.from_embeddings(
+                list(zip(texts, vectors)), embeddings, metadatas=metadatas, ids=ids
+            )
+            for batch in batches[1:]:
+                self.add(vectorstore, batch)
+            return vectorstore
+        # The index is trained on the vectors of the batches, its recall on them is recorded
+        sample = np.array([vector for batch in batches for vector in batch[1]], dtype=np.float32)
+        index, factory = create_index(conf, sample)
+        recall = estimate_recall(conf, index, factory, sample)
+        if recall:
+            log.info(
+                f"📏 {BOLD}{recall['index']}{END} index recall@10 {BOLD}{CYAN}{recall['recall@10']}{END} against an exact search, on {len(sample)} vectors"
+            )
+        if manifest is not None:
+            manifest["index"] = {
+                # Flat if the index could not be trained
+                "factory": factory,
+                "dimension": sample.shape[1],
+                "recall@10": recall["recall@10"] if recall else None,
+            }
+        vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+        for batch in batches:
+            self.add(vectorstore, batch)
+        return vectorstore
+
+    def add(self, store: FAISS, batch: Batch) -> None:
+        texts, vectors, metadatas, ids = batch
+        store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+
+    def can_delete(self, conf: ChatConf) -> bool:
+        # Removing vectors from IVF or HNSW indexes does not keep the positions used by the docstore
+        return is_flat(conf)
+
+    def delete(self, store: FAISS, ids: List[str]) -> None:
+        store.delete(ids)
+
+    def count(self, store: FAISS) -> int:
+        return len(store.index_to_docstore_id)
+
+    def save(self, store: FAISS, path: str) -> None:
+        store.save_local(path)
+        # Also saved in a format that workers can memory-map
+        write_chunks(store, path)
+
+    def load(
+        self, conf: ChatConf, path: str, embeddings: Embeddings, update: bool = False
+    ) -> FAISS:
+        if not update and conf.vector.mmap and has_chunks(path):
+            # Pages of the index and chunks are shared by the workers, and read when needed
+            vectorstore = load_mmap_vectorstore(path, embeddings)
+        else:
+            vectorstore = FAISS.load_local(path, embeddings)
+        tune_index(vectorstore.index, conf)
+        return vectorstore
+
+
+class QdrantBackend(VectorBackend):
+    """
+    Qdrant storing the chunks and their vectors, with the vectors and the HNSW index on disk, and
+    payload indexes on the metadata used to filter the searches (vector.qdrant_payload_indexes),
+    so collections larger than the RAM can be served.
+    With vector.qdrant_url each generation is a collection of a Qdrant server, queried by all
+    the workers. Otherwise Qdrant is embedded in the process, and stores each generation in its
+    folder without server. The embedded Qdrant can only be opened by one process, so the API must
+    run with a single worker, and it searches the vectors in memory, without the indexes.
+    """
+
+    def __init__(self) -> None:
+        self.clients: Dict[str, QdrantClient] = {}
+        self.servers: Dict[str, QdrantClient] = {}
+        self.lock = threading.Lock()
+
+    def _client(self, path: str) -> QdrantClient:
+        """Clients are shared in the process, Qdrant locks the storage for the client opening it."""
+        with self.lock:
+            for old_path in [p for p in self.clients if not os.path.exists(p)]:
+                # Storage of a generation removed
+                self.clients.pop(old_path).close()
+            if path not in self.clients:
+                try:
+                    self.clients[path] = QdrantClient(path=path)
+                except RuntimeError as e:
+                    raise RuntimeError(
+                        f"The Qdrant storage {path} is opened by another process, the embedded qdrant backend only supports 1 worker, set vector.qdrant_url to use a Qdrant server: {e}"
+                    ) from e
+            return self.clients[path]
+
+    def _server(self, url: str) -> QdrantClient:
+        with self.lock:
+            if url not in self.servers:
+                self.servers[url] = QdrantClient(url=url)
+            return self.servers[url]
+
+    def _close(self, path: str) -> None:
+        with self.lock:
+            client = self.clients.pop(path, None)
+            if client:
+                client.close()
+
+    def _create_collection(
+        self, conf: ChatConf, client: QdrantClient, collection: str, size: int
+    ) -> None:
+        client.create_collection(
+            collection_name=collection,
+            vectors_config=models.VectorParams(
+                size=size, distance=models.Distance.COSINE, on_disk=True
+            ),
+            hnsw_config=models.HnswConfigDiff(on_disk=True),
+            on_disk_payload=True,
+        )
+        if conf.vector.qdrant_url:
+            # The embedded Qdrant has no payload indexes
+            for field in conf.vector.qdrant_payload_indexes:
+                client.create_payload_index(
+                    collection_name=collection,
+                    field_name=f"{Qdrant.METADATA_KEY}.{field}",
+                    field_schema=models.PayloadSchemaType.KEYWORD,
+                )
+
+    @staticmethod
+    def _new_collection() -> str:
+        return f"{QDRANT_COLLECTION}-{uuid.uuid4().hex}"
+
+    def create(
+        self,
+        conf: ChatConf,
+        embeddings: Embeddings,
+        batches: List[Batch],
+        manifest: Optional[Dict[str, Any]] = None,
+    ) -> Qdrant:
+        if conf.vector.qdrant_url:
+            client = self._server(conf.vector.qdrant_url)
+            collection = self._new_collection()
+        else:
+            vector_path = conf.vector.vector_path
+            if vector_path:
+                os.makedirs(vector_path, exist_ok=True)
+            path = os.path.join(tempfile.mkdtemp(prefix=".build-", dir=vector_path), QDRANT_DIR)
+            client = self._client(path)
+            collection = QDRANT_COLLECTION
+        self._create_collection(conf, client, collection, len(batches[0][1][0]))
+        store = Qdrant(client=client, collection_name=collection, embeddings=embeddings)
+        for batch in batches:
+            self.add(store, batch)
+        return store
+
+    @staticmethod
+    def _point_id(chunk_id: str) -> str:
+        """Qdrant only accepts integers and UUIDs as ids."""
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, chunk_id))
+
+    def add(self, store: Qdrant, batch: Batch) -> None:
+        texts, vectors, metadatas, ids = batch
+        store.client.upsert(
+            collection_name=store.collection_name,
+            points=[
+                models.PointStruct(
+                    id=self._point_id(chunk_id),
+                    vector=vector,
+                    payload={
+                        store.content_payload_key: text,
+                        store.metadata_payload_key: metadata,
+                    },
+                )
+                for text, vector, metadata, chunk_id in zip(texts, vectors, metadatas, ids)
+            ],
+        )
+
+    def delete(self, store: Qdrant, ids: List[str]) -> None:
+        store.client.delete(
+            collection_name=store.collection_name,
+            points_selector=models.PointIdsList(points=[self._point_id(i) for i in ids]),
+        )
+
+    def count(self, store: Qdrant) -> int:
+        return int(store.client.count(collection_name=store.collection_name).count)
+
+    def save(self, store: Qdrant, path: str) -> None:
+        """Move the embedded storage built to the folder of the generation, the store is closed.
+        For a Qdrant server, the generation records the collection built."""
+        build_path = next((p for p, client in self.clients.items() if client is store.client), None)
+        if build_path is None:
+            url = next(url for url, client in self.servers.items() if client is store.client)
+            os.makedirs(os.path.join(path, QDRANT_DIR))
+            with open(os.path.join(path, QDRANT_DIR, QDRANT_SERVER_FILE), "w") as file:
+                json.dump({"url": url, "collection": store.collection_name}, file)
+            return
+        self._close(build_path)
+        shutil.move(build_path, os.path.join(path, QDRANT_DIR))
+        shutil.rmtree(os.path.dirname(build_path), ignore_errors=True)
+
+    @staticmethod
+    def _read_server(path: str) -> Optional[Dict[str, str]]:
+        """Server and collection of a generation, None if stored by the embedded Qdrant."""
+        try:
+            with open(os.path.join(path, QDRANT_DIR, QDRANT_SERVER_FILE)) as file:
+                server: Dict[str, str] = json.load(file)
+                return server
+        except FileNotFoundError:
+            return None
+
+    def _copy(self, conf: ChatConf, client: QdrantClient, collection: str) -> str:
+        """Copy the points of a collection to a new one, updated and saved as a new generation."""
+        copy = self._new_collection()
+        params = client.get_collection(collection).config.params
+        self._create_collection(conf, client, copy, params.vectors.size)  # type: ignore[union-attr]
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection,
+                limit=conf.vector.ingest_batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            if points:
+                client.upsert(
+                    collection_name=copy,
+                    points=[
+                        models.PointStruct(id=p.id, vector=p.vector, payload=p.payload)  # type: ignore[arg-type]
+                        for p in points
+                    ],
+                )
+            if offset is None:
+                return copy
+
+    def load(
+        self, conf: ChatConf, path: str, embeddings: Embeddings, update: bool = False
+    ) -> Qdrant:
+        server = self._read_server(path)
+        if server:
+            client = self._server(conf.vector.qdrant_url or server["url"])
+            collection = server["collection"]
+            if update:
+                collection = self._copy(conf, client, collection)
+            return Qdrant(client=client, collection_name=collection, embeddings=embeddings)
+        storage = os.path.join(path, QDRANT_DIR)
+        if update:
+            # Updates are written to a copy, saved as a new generation
+            build_path = os.path.join(
+                tempfile.mkdtemp(prefix=".build-", dir=conf.vector.vector_path), QDRANT_DIR
+            )
+            shutil.copytree(storage, build_path)
+            storage = build_path
+        return Qdrant(
+            client=self._client(storage), collection_name=QDRANT_COLLECTION, embeddings=embeddings
+        )
+
+    def remove(self, path: str) -> None:
+        server = self._read_server(path)
+        if server:
+            self._server(server["url"]).delete_collection(collection_name=server["collection"])
+        else:
+            self._close(os.path.join(path, QDRANT_DIR))
+
+
+def lock_qdrant_storage(vector_path: str) -> IO[str]:
+    """Take the lock of the process serving an embedded Qdrant storage, released when the process
+    exits. Raises a ValueError if another process, e.g. another worker, already holds it."""
+    os.makedirs(os.path.dirname(os.path.abspath(vector_path)), exist_ok=True)
+    lock_path = f"{os.path.normpath(vector_path)}.qdrant.lock"
+    lock_file = open(lock_path, "a")  # noqa: SIM115
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise ValueError(
+            f"The embedded Qdrant storage {vector_path} is already opened by another process, start the API with 1 worker, set vector.qdrant_url to use a Qdrant server, or use the faiss backend"
+        ) from None
+    return lock_file
+
+
+BACKENDS = {"faiss": FaissBackend, "qdrant": QdrantBackend}
+_backends: Dict[str, VectorBackend] = {}
+
+
+def get_backend(conf: ChatConf) -> VectorBackend:
+    """Backend of the vectorstore selected in the settings, shared in the process."""
+    if conf.vector.backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown vectorstore backend {conf.vector.backend}, use one of {', '.join(BACKENDS)}"
+        )
+    if conf.vector.backend not in _backends:
+        _backends[conf.vector.backend] = BACKENDS[conf.vector.backend]()
+    return _backends[conf.vector.backend]
@@ -41,17 +41,45 @@ class SettingsVector(BaseConf):
     embeddings_path: str = "sentence-transformers/all-MiniLM-L6-v2"
     # or embeddings_path: str = "./embeddings/all-MiniLM-L6-v2"
     embeddings_download: Optional[str] = None
+    embeddings_cache_path: Optional[str] = "./vectorstore/embeddings_cache"  # null to disable
+    embeddings_cache_dtype: str = "float32"  # Or float16 to halve the cache size
+    embed_batch_size: int = 32  # Chunks of similar token length encoded together
+    text_cache_path: Optional[str] = "./vectorstore/text_cache"  # null to disable
     vector_path: Optional[str] = None
+    backend: str = "faiss"  # Or qdrant, embedded and stored on disk, without server
+    qdrant_url: Optional[str] = None  # Qdrant server instead, e.g. http://qdrant:6333
+    qdrant_payload_indexes: List[str] = ["source"]  # Metadata indexed by the Qdrant server
     vector_download: Optional[str] = None
     documents_path: str = "documents/"
     documents_download: Optional[str] = None
+    upload_max_mb: int = 1024  # Max size of a file uploaded, or extracted from a zip
+    unzip_max_mb: int = 4096  # Max size of all the files extracted from a zip
+    unzip_max_ratio: float = 100  # Max compression ratio of a file in a zip, to reject zip bombs
+    unzip_workers: int = 4  # Threads extracting large zip files
 
     chunk_size: int = 500
     chunk_overlap: int = 50
+    chunk_unit: str = "chars"  # Or tokens, of the embeddings model and the LLM
+    ingest_workers: Optional[int] = None  # Defaults to info.workers
+    ingest_batch_size: int = 256  # Chunks embedded and indexed at once
+    ingest_memory_mb: int = 64  # Max text size buffered in a batch
+    ingest_debounce: float = 2  # Seconds without upload before updating the vectorstore
+    watch: bool = False  # Add the files changed in documents_path to the vectorstore
+    watch_interval: float = 2  # Seconds between scans of documents_path
+    build_shards: int = 1  # Processes encoding the chunks on CPU, each with a share of the cores
     chain_type: str = "stuff"  # Or: map_reduce, reduce, map_rerank https://docs.langchain.com/docs/components/chains/index_related_chains
     search_type: str = "similarity"  # Or: similarity_score_threshold, mmr https://python.langchain.com/docs/modules/data_connection/retrievers/vectorstore
     return_sources_count: int = 4
     score_threshold: Optional[float] = None  # Between 0 and 1
+    index_factory: str = "Flat"  # FAISS index, e.g. IVF1024,Flat or HNSW32 or IVF1024,PQ16
+    index_train_size: int = 50000  # Vectors used to train the IVF and PQ indexes
+    vector_dtype: str = "float32"  # Or float16, int8 to compress the vectors in the index
+    pca_dim: Optional[int] = None  # Reduce the vectors to this dimension with a PCA
+    nprobe: int = 16  # IVF clusters visited by a search
+    ef_search: int = 64  # HNSW search depth
+    mmap: bool = True  # Memory-map the index and chunks, shared by the workers
+    retrieval_cache_size: int = 1024  # Queries with cached embeddings and results, 0 to disable
+    reload_interval: float = 2  # Seconds between checks for a new version saved by other workers
 
 
 class SettingsLlm(BaseConf):
@@ -61,8 +89,21 @@ class SettingsLlm(BaseConf):
     max_new_tokens: int = 1024
     temperature: float = 0.01
     gpu_layers: int = 100  # Number of layers to run on the GPU (if detected)
+    replicas: int = 1  # Number of model instances generating answers in parallel
+    n_threads: Optional[int] = None  # Threads used by each replica, defaults to llama.cpp choice
+    n_ctx: Optional[int] = None  # Context size of each request, in tokens
+    engine: str = "replicas"  # replicas or batched
+    max_sequences: int = 8  # Requests decoded together by the batched engine
+    kv_cache_mb: int = 0  # RAM for the states of conversations, each answer copies its state
+    kv_cache_min_tokens: int = 32  # Shortest prefix shared with a prompt to reuse a state
+    kv_cache_path: Optional[str] = None  # Folder to spill the states evicted from RAM
+    kv_cache_disk_mb: int = 8192
+    prompt_prefix_cache: bool = True  # Evaluate the static start of the prompt only once
     prompt_variables: List[str] = ["input", "history"]
     prompt_template: str = ""
+    queue_size: int = 32  # Max number of requests waiting for the LLM
+    queue_timeout: float = 120  # Max time in seconds a request waits for the LLM
+    coalesce_requests: bool = True  # Identical prompts running together share one generation
 
 
 class SettingsAuth(BaseConf):
@@ -77,11 +118,21 @@ class SettingsAuth(BaseConf):
     regular_users: List[str] = []
 
 
+class SettingsCache(BaseConf):
+    enabled: bool = True  # Cache the responses to the prompts sent to /prompt
+    max_entries: int = 1024
+    max_mb: int = 64
+    ttl: int = 86400  # Seconds before a cached response expires
+    semantic_threshold: Optional[float] = None  # e.g. 0.95 to reuse responses to similar prompts
+    prewarm: bool = False  # Answer the info.examples at startup
+
+
 class ChatConf(BaseConf):
     conf_path: str = "chat.yml"
     conf_url: Optional[str] = None
     llm: SettingsLlm = SettingsLlm()
     vector: SettingsVector = SettingsVector()
+    cache: SettingsCache = SettingsCache()
     info: SettingsInfo = SettingsInfo()
     auth: SettingsAuth = SettingsAuth()
 
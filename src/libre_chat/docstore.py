@@ -0,0 +1,99 @@
+"""Module: Chunks of a vectorstore stored in files memory-mapped by all the workers"""
+import json
+import mmap
+import os
+from typing import Any, Iterator, List, Mapping, Union
+
+import faiss
+import numpy as np
+from langchain.schema.document import Document
+from langchain.schema.embeddings import Embeddings
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+from libre_chat.utils import log
+
+__all__ = ["MmapDocstore", "has_chunks", "load_mmap_vectorstore", "write_chunks"]
+
+CHUNKS_FILE = "chunks.jsonl"
+OFFSETS_FILE = "chunks.offsets.npy"
+
+
+def write_chunks(vectorstore: FAISS, path: str) -> None:
+    """Write the chunks of a vectorstore in the order of its index: one JSON line per chunk,
+    and the offset of each line in a numpy array."""
+    offsets: List[int] = [0]
+    with open(os.path.join(path, CHUNKS_FILE), "wb") as file:
+        for position in range(len(vectorstore.index_to_docstore_id)):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[position])
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find the chunk at position {position} in the docstore")
+            line = json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata}, default=str
+            )
+            offsets.append(offsets[-1] + file.write(line.encode() + b"\n"))
+    np.save(os.path.join(path, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+
+
+def has_chunks(path: str) -> bool:
+    return os.path.exists(os.path.join(path, CHUNKS_FILE)) and os.path.exists(
+        os.path.join(path, OFFSETS_FILE)
+    )
+
+
+class MmapDocstore(Docstore):
+    """
+    Read-only docstore reading the chunks from memory-mapped files, the id of a chunk is its
+    position in the index. Nothing is loaded at startup, and the pages read are in the page
+    cache shared by all the processes of the node.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self.data: Union[mmap.mmap, bytes] = b""
+        with open(os.path.join(path, CHUNKS_FILE), "rb") as file:
+            if os.fstat(file.fileno()).st_size > 0:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def search(self, search: str) -> Union[str, Document]:
+        position = int(search)
+        if not 0 <= position < len(self):
+            return f"ID {search} not found."
+        chunk = json.loads(self.data[self.offsets[position] : self.offsets[position + 1]])
+        return Document(page_content=chunk["page_content"], metadata=chunk["metadata"])
+
+
+class _PositionIds(Mapping[int, str]):
+    """Map the positions in the index to the ids of the MmapDocstore, without building a dict."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.size))
+
+    def __len__(self) -> int:
+        return self.size
+
+
+def load_mmap_vectorstore(path: str, embeddings: Embeddings, **kwargs: Any) -> FAISS:
+    """Load a read-only vectorstore with its index and chunks memory-mapped."""
+    index_path = os.path.join(path, "index.faiss")
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        # Older FAISS versions can only memory-map some index types
+        log.warning(f"⚠️ Could not memory-map the index {index_path}, loading it in memory: {e}")
+        index = faiss.read_index(index_path)
+    docstore = MmapDocstore(path)
+    if index.ntotal != len(docstore):
+        raise ValueError(f"The index and the chunks saved in {path} do not match")
+    return FAISS(embeddings, index, docstore, _PositionIds(len(docstore)), **kwargs)  # type: ignore[arg-type]
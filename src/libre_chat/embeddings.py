@@ -0,0 +1,289 @@
+"""Module: Embeddings used to vectorize documents, with an on-disk cache"""
+import fcntl
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+from libre_chat.conf import ChatConf
+
+__all__ = [
+    "CachedEmbeddings",
+    "EmbeddingsCache",
+    "ShardedEmbeddings",
+    "close_embeddings",
+    "get_embeddings",
+]
+
+KEY_SIZE = 16
+
+
+def text_key(text: str) -> bytes:
+    """Content address of a text in the embeddings cache."""
+    return hashlib.blake2b(text.encode(), digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingsCache:
+    """Append-only on-disk cache of the embeddings computed by a model, shared by processes.
+
+    Vectors are stored as rows of a raw float matrix, read through a memory map, and their
+    text hashes are stored in the same order in a keys file. Rows are appended and repaired while
+    holding a lock on the cache folder, and their positions are taken from the size of the files,
+    so processes adding vectors at the same time never mix their keys and vectors.
+    Vectors are always written before their keys, rows left without key by a crash are dropped.
+    """
+
+    def __init__(self, cache_path: str, model_id: str, dtype: str = "float32") -> None:
+        self.dtype = np.dtype(dtype)
+        # Each model and dtype has its own folder, a cache is never reset while used by a process
+        self.path = os.path.join(
+            cache_path, hashlib.sha256(f"{model_id}:{self.dtype.name}".encode()).hexdigest()[:16]
+        )
+        self.keys_path = os.path.join(self.path, "keys.bin")
+        self.vectors_path = os.path.join(self.path, "vectors.bin")
+        self.info_path = os.path.join(self.path, "info.json")
+        self.lock_path = os.path.join(self.path, "lock")
+        self.model_id = model_id
+        self.dim: Optional[int] = None
+        self.index: Dict[bytes, int] = {}
+        # Rows of the files read in the index
+        self.size = 0
+        self._vectors: Optional["np.memmap[Any, Any]"] = None
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock():
+            self._sync()
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Exclusive lock on the cache, shared by all the processes using it."""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Read the rows added by other processes, and drop partially written rows.
+        Must be called while holding the lock."""
+        if not self.dim and os.path.exists(self.info_path):
+            with open(self.info_path) as file:
+                self.dim = json.load(file).get("dim")
+        if not self.dim or not os.path.exists(self.keys_path):
+            return
+        row_size = self.dim * self.dtype.itemsize
+        size = min(
+            os.path.getsize(self.keys_path) // KEY_SIZE,
+            os.path.getsize(self.vectors_path) // row_size,
+        )
+        os.truncate(self.keys_path, size * KEY_SIZE)
+        os.truncate(self.vectors_path, size * row_size)
+        if size > self.size:
+            with open(self.keys_path, "rb") as file:
+                file.seek(self.size * KEY_SIZE)
+                keys = file.read((size - self.size) * KEY_SIZE)
+            for i in range(size - self.size):
+                self.index.setdefault(keys[i * KEY_SIZE : (i + 1) * KEY_SIZE], self.size + i)
+            self.size = size
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _rows(self) -> "np.memmap[Any, Any]":
+        if self._vectors is None or len(self._vectors) < self.size:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r", shape=(self.size, self.dim or 0)
+            )
+        return self._vectors
+
+    def get(self, keys: List[bytes]) -> List[Optional[List[float]]]:
+        """Get the cached vectors for a list of text keys, None for the ones not in the cache."""
+        rows = self._rows() if self.index else None
+        return [
+            rows[self.index[key]].astype(np.float32).tolist()
+            if rows is not None and key in self.index
+            else None
+            for key in keys
+        ]
+
+    def add(self, keys: List[bytes], vectors: List[List[float]]) -> None:
+        """Append new vectors to the cache."""
+        with self._lock():
+            self._sync()
+            new = {key: vector for key, vector in zip(keys, vectors) if key not in self.index}
+            if not new:
+                return
+            matrix = np.asarray(list(new.values()), dtype=self.dtype)
+            if not self.dim:
+                self.dim = int(matrix.shape[1])
+                with open(self.info_path, "w") as file:
+                    json.dump(
+                        {"model_id": self.model_id, "dtype": self.dtype.name, "dim": self.dim}, file
+                    )
+            with open(self.vectors_path, "ab") as file:
+                file.write(matrix.tobytes())
+            with open(self.keys_path, "ab") as file:
+                file.write(b"".join(new))
+            for key in new:
+                self.index[key] = self.size
+                self.size += 1
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings looking up the vectors of documents in an EmbeddingsCache before encoding them.
+    Queries are always encoded by the underlying embeddings."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingsCache) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [text_key(text) for text in texts]
+        vectors = self.cache.get(keys)
+        # Only encode each missing text once, even if it appears several times in the batch
+        missing = {key: text for key, text, vector in zip(keys, texts, vectors) if vector is None}
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.add(list(missing.keys()), computed)
+            by_key = dict(zip(missing.keys(), computed))
+            vectors = [
+                vector if vector is not None else by_key[key] for key, vector in zip(keys, vectors)
+            ]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return vectors  # type: ignore[return-value]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+# Embeddings model of a shard process
+_shard: Dict[str, Embeddings] = {}
+
+
+def _init_shard(factory: Callable[[], Embeddings], threads: int) -> None:
+    """Load the embeddings model of a shard process, using only its share of the CPU cores."""
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(threads)
+    with suppress(ImportError):
+        import torch
+
+        torch.set_num_threads(threads)
+    _shard["embeddings"] = factory()
+
+
+def _embed_shard(texts: List[str]) -> List[List[float]]:
+    return _shard["embeddings"].embed_documents(texts)
+
+
+class ShardedEmbeddings(Embeddings):
+    """Embeddings encoding documents on several processes, each with its own model and an equal
+    share of the CPU cores. Texts are split in contiguous shards, and the vectors are returned in
+    the original order, so the vectorstore is the same as when encoded by a single process."""
+
+    def __init__(
+        self, factory: Callable[[], Embeddings], shards: int, threads: Optional[int] = None
+    ) -> None:
+        self.factory = factory
+        self.shards = shards
+        self.threads = threads or max(1, (os.cpu_count() or 1) // shards)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.local: Optional[Embeddings] = None
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self.executor is None:
+            # Spawned, torch does not support forking a process where it started its threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.shards,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_shard,
+                initargs=(self.factory, self.threads),
+            )
+        size = math.ceil(len(texts) / self.shards)
+        futures = [
+            self.executor.submit(_embed_shard, texts[start : start + size])
+            for start in range(0, len(texts), size)
+        ]
+        return [vector for future in futures for vector in future.result()]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.local is None:
+            self.local = self.factory()
+        return self.local.embed_query(text)
+
+    def close(self) -> None:
+        """Stop the shard processes, they are started again if more documents are embedded."""
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def embeddings_report(embeddings: Embeddings, chunks: int, seconds: float) -> Optional[str]:
+    """Summarize the throughput of the chunks embedded in seconds, and the cache hits."""
+    if chunks < 1:
+        return None
+    report = [f"embedded {chunks} chunks at {chunks / max(seconds, 1e-9):.1f} chunks/sec"]
+    if isinstance(embeddings, CachedEmbeddings):
+        if embeddings.hits > 0:
+            report.append(f"reused {embeddings.hits} embeddings from the cache")
+        embeddings = embeddings.embeddings
+    if isinstance(embeddings, ShardedEmbeddings):
+        report.append(f"on {embeddings.shards} processes of {embeddings.threads} threads")
+    return ", ".join(report).capitalize()
+
+
+def close_embeddings(embeddings: Embeddings) -> None:
+    """Stop the processes started to embed documents, if any."""
+    while isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+    if isinstance(embeddings, ShardedEmbeddings):
+        embeddings.close()
+
+
+def _hf_embeddings(conf: ChatConf, device: Any) -> Embeddings:
+    """Sentence transformers already sort the texts of each call by length, so each batch of
+    embed_batch_size texts holds texts of similar length."""
+    return HuggingFaceEmbeddings(
+        model_name=conf.vector.embeddings_path,
+        model_kwargs={"device": device},
+        encode_kwargs={"batch_size": conf.vector.embed_batch_size},
+    )
+
+
+def get_embeddings(conf: ChatConf, device: Any, ingest: bool = False) -> Embeddings:
+    """Get the embeddings model used to vectorize the documents and the queries.
+    When ingesting documents, texts are looked up in the on-disk embeddings cache first.
+    On CPU they are encoded by vector.build_shards processes.
+    """
+    # TODO: use fastembed?
+    if not ingest:
+        return _hf_embeddings(conf, device)
+    if conf.vector.build_shards > 1 and str(device) == "cpu":
+        encoder: Embeddings = ShardedEmbeddings(
+            partial(_hf_embeddings, conf, device), conf.vector.build_shards
+        )
+    else:
+        encoder = _hf_embeddings(conf, device)
+    if conf.vector.embeddings_cache_path:
+        return CachedEmbeddings(
+            encoder,
+            EmbeddingsCache(
+                conf.vector.embeddings_cache_path,
+                conf.vector.embeddings_path,
+                conf.vector.embeddings_cache_dtype,
+            ),
+        )
+    return encoder
@@ -0,0 +1,404 @@
+"""Module: Engine decoding concurrent requests together in batches with llama.cpp"""
+import asyncio
+import codecs
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from libre_chat.kv_cache import load_prefix_state, prefix_state_path, save_prefix_state
+from libre_chat.utils import log
+
+__all__ = ["BatchedEngine", "BatchedLlamaCpp"]
+
+
+class _Sequence:
+    """A request being generated by the engine, identified by its sequence id in the KV cache."""
+
+    def __init__(
+        self,
+        tokens: List[int],
+        max_tokens: int,
+        temperature: float,
+        stop: List[str],
+        on_token: Optional[Callable[[str], None]],
+    ) -> None:
+        self.pending = tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop = stop
+        self.on_token = on_token
+        self.future: "Future[str]" = Future()
+        self.seq_id = -1
+        self.pos = 0
+        self.evaluated: List[int] = []
+        self.generated = 0
+        self.text = ""
+        # Characters of the text already sent to on_token
+        self.streamed = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.cancelled = False
+
+
+class BatchedEngine:
+    """
+    Continuous batching on top of llama.cpp: the requests submitted concurrently are decoded
+    together, each with its own sequence id in a shared KV cache. Between two decode steps,
+    finished sequences leave the batch and new requests join it, so a request never waits for
+    the longest generation of the batch to finish.
+
+    The KV cache of a finished sequence is kept until its id is reused. A new request takes the
+    idle sequence sharing the longest prefix with its prompt, so the next turn of a conversation
+    only evaluates the new tokens. Otherwise the least recently used sequence is taken.
+
+    The static prefix of the prompts is evaluated once in a sequence reserved for it, and copied
+    in the KV cache of the new requests starting with it.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        max_sequences: int = 8,
+        n_ctx: int = 2048,
+        n_batch: int = 512,
+        n_threads: Optional[int] = None,
+        seed: Optional[int] = None,
+        prefix: str = "",
+        save_prefix_state: bool = False,
+    ) -> None:
+        import llama_cpp
+
+        self.llama_cpp = llama_cpp
+        self.max_sequences = max_sequences
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        # The KV cache is shared by all the sequences and the prefix, each one can use n_ctx tokens
+        self.model = llama_cpp.Llama(
+            model_path=model_path,
+            n_ctx=n_ctx * (max_sequences + 1),
+            n_batch=n_batch,
+            n_threads=n_threads,
+            use_mmap=True,
+            verbose=False,
+        )
+        # Llama creates a context for 1 sequence, recreate it with a sequence for each request
+        # and one for the prefix. The first context is freed before allocating the new KV cache
+        params = self.model.context_params
+        params.n_seq_max = max_sequences + 1
+        self.model._ctx = None
+        self.model._ctx = llama_cpp._internals._LlamaContext(
+            model=self.model._model, params=params, verbose=False
+        )
+        self.ctx = self.model._ctx.ctx
+        self.n_vocab = self.model.n_vocab()
+        self.eos = self.model.token_eos()
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, max_sequences + 1)
+        self.rng = np.random.default_rng(seed)
+        self._queue: "queue.Queue[_Sequence]" = queue.Queue()
+        self._active: Dict[int, _Sequence] = {}
+        # Taken to change the active sequences, read by the threads cancelling requests
+        self._lock = threading.Lock()
+        # Idle sequence ids, least recently used first, with the tokens still in their KV cache
+        self._idle: "OrderedDict[int, List[int]]" = OrderedDict(
+            (seq_id, []) for seq_id in range(max_sequences)
+        )
+        # Stats
+        self._steps = 0
+        self._batched_tokens = 0
+        self._generated = 0
+        self._decode_seconds = 0.0
+        self._reused_tokens = 0
+        self._prefix: List[int] = []
+        if prefix:
+            state_path = (
+                prefix_state_path(model_path, prefix, self.model.n_ctx(), "batched")
+                if save_prefix_state
+                else None
+            )
+            self._pin_prefix(prefix, state_path)
+        self._thread = threading.Thread(target=self._run, name="batched-engine", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: str,
+        max_tokens: int = 256,
+        temperature: float = 0.8,
+        stop: Optional[List[str]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> "Future[str]":
+        """Add a request to the next decode step, returns a future resolved with the generated text.
+        on_token is called from the engine thread with each new piece of text."""
+        tokens = self.model.tokenize(prompt.encode(), add_bos=True)
+        if len(tokens) >= self.n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx}"
+            )
+        max_tokens = min(max_tokens, self.n_ctx - len(tokens))
+        seq = _Sequence(tokens, max_tokens, temperature, stop or [], on_token)
+        self._queue.put(seq)
+        return seq.future
+
+    def generate(self, prompt: str, **kwargs: Any) -> str:
+        """Generate the answer to a prompt, blocking until it is complete."""
+        return self.submit(prompt, **kwargs).result()
+
+    def cancel(self, future: "Future[str]") -> None:
+        """Stop generating a request, e.g. when its client went away."""
+        with self._lock, self._queue.mutex:
+            sequences = list(self._active.values()) + list(self._queue.queue)
+        for seq in sequences:
+            if seq.future is future:
+                seq.cancelled = True
+
+    def _admit(self) -> None:
+        """Move the requests waiting to the batch while there are free sequence ids."""
+        while self._idle:
+            try:
+                # Block only when there is nothing to decode
+                seq = self._queue.get(block=not self._active)
+            except queue.Empty:
+                return
+            if seq.cancelled:
+                seq.future.cancel()
+                continue
+            self._assign(seq)
+            with self._lock:
+                self._active[seq.seq_id] = seq
+
+    def _pin_prefix(self, prefix: str, state_path: Optional[str]) -> None:
+        """Evaluate the static prefix of the prompts, or restore its state saved to disk,
+        and keep it in the sequence after the ones used by the requests."""
+        # The last token could merge with the text following the prefix
+        tokens = self.model.tokenize(prefix.encode(), add_bos=True)[:-1]
+        if not tokens:
+            return
+        state = load_prefix_state(state_path, self.model) if state_path else None
+        if state is not None:
+            log.info(f"♻️  Restoring the state of the prompt prefix from {state_path}")
+            self.model.load_state(state)
+        else:
+            log.info(f"⏳ Evaluating the prompt prefix ({len(tokens)} tokens)")
+            self.model.eval(tokens)
+            if state_path:
+                save_prefix_state(state_path, self.model.save_state())
+        # Llama evaluates in the sequence 0, move it to the reserved sequence
+        self.llama_cpp.llama_kv_cache_seq_cp(self.ctx, 0, self.max_sequences, 0, len(tokens))
+        self.llama_cpp.llama_kv_cache_seq_rm(self.ctx, 0, -1, -1)
+        self._prefix = tokens
+
+    def _assign(self, seq: _Sequence) -> None:
+        """Give a sequence id to a request, reusing the tokens already in the KV cache."""
+        tokens = seq.pending
+        # Keep at least one token to evaluate, to get the logits of the next one
+        # On equal prefixes, max keeps the first one: the least recently used
+        seq_id, cached = max(
+            self._idle.items(), key=lambda item: self.model.longest_token_prefix(item[1], tokens)
+        )
+        prefix = min(self.model.longest_token_prefix(cached, tokens), len(tokens) - 1)
+        pinned = min(self.model.longest_token_prefix(self._prefix, tokens), len(tokens) - 1)
+        if pinned > prefix:
+            # Start from the static prefix, in the least recently used sequence
+            seq_id = next(iter(self._idle))
+            self.llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, -1, -1)
+            self.llama_cpp.llama_kv_cache_seq_cp(self.ctx, self.max_sequences, seq_id, 0, pinned)
+            prefix = pinned
+        del self._idle[seq_id]
+        self.llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, prefix, -1)
+        seq.seq_id = seq_id
+        seq.pos = prefix
+        seq.evaluated = tokens[:prefix]
+        seq.pending = tokens[prefix:]
+        self._reused_tokens += prefix
+
+    def _finish(self, seq: _Sequence, error: Optional[Exception] = None) -> None:
+        with self._lock:
+            del self._active[seq.seq_id]
+        if error:
+            # The KV cache may not match the tokens evaluated
+            self.llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, -1, -1)
+            seq.evaluated = []
+        self._idle[seq.seq_id] = seq.evaluated
+        if error:
+            seq.future.set_exception(error)
+        elif seq.cancelled:
+            seq.future.cancel()
+        else:
+            seq.future.set_result(seq.text)
+
+    def _fill_batch(self) -> Dict[int, _Sequence]:
+        """Add the next tokens of all active sequences to the batch: one token for the sequences
+        generating, and as many prompt tokens as fit for the new ones.
+        Returns the sequences to sample, by index of their logits in the batch."""
+        batch = self.batch
+        n = 0
+        to_sample = {}
+        # Sequences generating first, so prompts being evaluated do not delay them
+        for seq in sorted(self._active.values(), key=lambda s: len(s.pending)):
+            if n >= self.n_batch:
+                break
+            take = seq.pending[: self.n_batch - n]
+            for i, token in enumerate(take):
+                batch.token[n] = token
+                batch.pos[n] = seq.pos + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = seq.seq_id
+                batch.logits[n] = False
+                n += 1
+            seq.pos += len(take)
+            seq.evaluated.extend(take)
+            seq.pending = seq.pending[len(take) :]
+            if not seq.pending:
+                batch.logits[n - 1] = True
+                to_sample[n - 1] = seq
+        batch.n_tokens = n
+        return to_sample
+
+    def _sample(self, index: int, temperature: float) -> int:
+        logits = np.ctypeslib.as_array(
+            self.llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,)
+        )
+        if temperature <= 0:
+            return int(np.argmax(logits))
+        scaled = (logits - logits.max()) / temperature
+        probs = np.exp(scaled)
+        return int(self.rng.choice(self.n_vocab, p=probs / probs.sum()))
+
+    def _stream(self, seq: _Sequence, end: int) -> bool:
+        """Send the text generated up to end to on_token, False if it failed and seq finished."""
+        if end > seq.streamed and seq.on_token:
+            try:
+                seq.on_token(seq.text[seq.streamed : end])
+            except Exception as e:
+                self._finish(seq, e)
+                return False
+        seq.streamed = max(seq.streamed, end)
+        return True
+
+    def _accept(self, seq: _Sequence, token: int) -> None:
+        """Add a sampled token to a sequence, and finish it if it is complete."""
+        seq.generated += 1
+        if token == self.eos:
+            if self._stream(seq, len(seq.text)):
+                self._finish(seq)
+            return
+        seq.text += seq.decoder.decode(self.model.detokenize([token]))
+        stops = [seq.text.index(stop) for stop in seq.stop if stop in seq.text]
+        if stops:
+            seq.text = seq.text[: min(stops)]
+            if self._stream(seq, len(seq.text)):
+                self._finish(seq)
+            return
+        done = seq.generated >= seq.max_tokens
+        # The end of the text is held back while it could be the beginning of a stop string
+        held = max(
+            (n for stop in seq.stop for n in range(1, len(stop)) if seq.text.endswith(stop[:n])),
+            default=0,
+        )
+        if not self._stream(seq, len(seq.text) - (0 if done else held)):
+            return
+        if done:
+            self._finish(seq)
+        else:
+            seq.pending = [token]
+
+    def _step(self) -> None:
+        for seq in [s for s in self._active.values() if s.cancelled]:
+            self._finish(seq)
+        to_sample = self._fill_batch()
+        if self.batch.n_tokens == 0:
+            return
+        time_start = time.perf_counter()
+        status = self.llama_cpp.llama_decode(self.ctx, self.batch)
+        self._decode_seconds += time.perf_counter() - time_start
+        if status != 0:
+            log.error(f"❌ llama.cpp decode failed with status {status}")
+            for seq in list(self._active.values()):
+                self._finish(seq, RuntimeError(f"llama.cpp decode failed with status {status}"))
+            return
+        self._steps += 1
+        self._batched_tokens += self.batch.n_tokens
+        self._generated += len(to_sample)
+        for index, seq in to_sample.items():
+            self._accept(seq, self._sample(index, seq.temperature))
+
+    def _run(self) -> None:
+        while True:
+            self._admit()
+            try:
+                self._step()
+            except Exception as e:
+                log.error(f"❌ Error in the batched engine: {e}")
+                for seq in list(self._active.values()):
+                    self._finish(seq, e)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch occupancy and decoding throughput of the engine."""
+        return {
+            "active": len(self._active),
+            "waiting": self._queue.qsize(),
+            "max_sequences": self.max_sequences,
+            "steps": self._steps,
+            "avg_batch_tokens": round(self._batched_tokens / max(self._steps, 1), 2),
+            "tokens_per_second": round(self._generated / max(self._decode_seconds, 1e-9), 2),
+            "prefix_tokens_reused": self._reused_tokens,
+        }
+
+
+class BatchedLlamaCpp(LLM):
+    """LangChain LLM sending its prompts to a BatchedEngine shared by all the requests."""
+
+    engine: Any
+    max_tokens: int = 256
+    temperature: float = 0.8
+    streaming: bool = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "llamacpp-batched"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        on_token = run_manager.on_llm_new_token if run_manager and self.streaming else None
+        future = self.engine.submit(
+            prompt, self.max_tokens, self.temperature, stop=stop, on_token=on_token
+        )
+        return str(future.result())
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Tokens are generated in the engine thread, and sent in order to the async callbacks
+        loop = asyncio.get_running_loop()
+        tokens: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        future = self.engine.submit(
+            prompt,
+            self.max_tokens,
+            self.temperature,
+            stop=stop,
+            on_token=lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token),
+        )
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(tokens.put_nowait, None))
+        try:
+            while (token := await tokens.get()) is not None:
+                if run_manager and self.streaming:
+                    await run_manager.on_llm_new_token(token)
+            return str(await asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            self.engine.cancel(future)
+            raise
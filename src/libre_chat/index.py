@@ -0,0 +1,194 @@
+"""Module: FAISS index types for large corpora, and benchmark of their recall and latency"""
+import re
+import time
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from libre_chat.conf import ChatConf
+from libre_chat.utils import log
+
+__all__ = [
+    "benchmark_indexes",
+    "create_index",
+    "estimate_recall",
+    "index_description",
+    "index_vectors",
+    "is_flat",
+    "tune_index",
+]
+
+# FAISS encodings of the vectors stored in the index
+VECTOR_ENCODINGS = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+
+def index_description(conf: ChatConf) -> str:
+    """FAISS factory string of the index, with the encoding of the vectors (vector_dtype)
+    and the PCA reduction (pca_dim) of the settings, e.g. PCA128,IVF1024,SQ8"""
+    factory = conf.vector.index_factory.replace(" ", "")
+    if conf.vector.vector_dtype not in VECTOR_ENCODINGS:
+        raise ValueError(
+            f"Unknown vector_dtype {conf.vector.vector_dtype}, use one of {', '.join(VECTOR_ENCODINGS)}"
+        )
+    encoding = VECTOR_ENCODINGS[conf.vector.vector_dtype]
+    if encoding != "Flat":
+        if factory.endswith("Flat"):
+            factory = factory[: -len("Flat")] + encoding
+        elif re.fullmatch(r"HNSW\d+", factory):
+            factory = f"{factory},{encoding}"
+        else:
+            log.warning(f"⚠️ vector_dtype is ignored, {factory} already encodes the vectors")
+    if conf.vector.pca_dim:
+        factory = f"PCA{conf.vector.pca_dim},{factory}"
+    return factory
+
+
+def is_flat(conf: ChatConf) -> bool:
+    """Flat indexes do an exact search and do not need training."""
+    return index_description(conf) in ["Flat", "IDMap,Flat"]
+
+
+def index_vectors(index: Any) -> Tuple[Optional["np.ndarray[Any, Any]"], bool]:
+    """The vectors of an index, in the order of their positions, read without embedding the chunks
+    again, and if they are exact. The indexes compressing the vectors (SQ, PQ, PCA) return them
+    decoded, approximated. None if the index cannot reconstruct them."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    try:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # Maps the positions to the clusters holding them, not saved in the index
+            ivf.make_direct_map()
+        vectors = index.reconstruct_n(0, index.ntotal)
+    except RuntimeError:
+        return None, False
+    exact = isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat)) or (
+        isinstance(index, faiss.IndexHNSW)
+        and isinstance(faiss.downcast_index(index.storage), faiss.IndexFlat)
+    )
+    return vectors, exact
+
+
+def tune_index(index: Any, conf: ChatConf) -> None:
+    """Set the search time parameters of the IVF (nprobe) and HNSW (efSearch) indexes."""
+    params = faiss.ParameterSpace()
+    for name, value in [("nprobe", conf.vector.nprobe), ("efSearch", conf.vector.ef_search)]:
+        # Raises when this parameter does not apply to this index type
+        with suppress(RuntimeError):
+            params.set_index_parameter(index, name, value)
+
+
+def create_index(
+    conf: ChatConf, vectors: "np.ndarray[Any, Any]", index_factory: Optional[str] = None
+) -> Tuple[Any, str]:
+    """Create the FAISS index described by the settings, e.g. Flat, IVF1024,Flat, HNSW32
+    or PCA128,IVF1024,PQ16, and train it on a sample of the vectors if needed. The vectors are not added.
+    The PCA is stored in the index, and applied to the queries when searching.
+    Returns the index and its factory string, Flat if it could not be trained.
+    """
+    index_factory = index_factory or index_description(conf)
+    dim = vectors.shape[1]
+    index = faiss.index_factory(dim, index_factory)
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > conf.vector.index_train_size:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), conf.vector.index_train_size, replace=False)]
+        log.info(f"🏋️ Training the {index_factory} index on {len(sample)} vectors")
+        try:
+            index.train(np.ascontiguousarray(sample, dtype=np.float32))
+        except RuntimeError as e:
+            log.warning(
+                f"⚠️ Could not train the {index_factory} index on {len(sample)} vectors, using a flat index instead: {e}"
+            )
+            index = faiss.IndexFlatL2(dim)
+            index_factory = "Flat"
+    tune_index(index, conf)
+    return index, index_factory
+
+
+def _search(
+    index: Any, queries: "np.ndarray[Any, Any]", k: int
+) -> Tuple["np.ndarray[Any, Any]", List[float]]:
+    """Search the queries one by one, like the API does, and measure the latency of each."""
+    ids = []
+    latencies = []
+    for query in queries:
+        time_start = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - time_start) * 1000)
+        ids.append(found[0])
+    return np.stack(ids), latencies
+
+
+def _report(name: str, ids: Any, truth: Any, latencies: List[float], k: int) -> Dict[str, Any]:
+    recall = np.mean(
+        [len(set(found[found >= 0]) & set(expected)) / k for found, expected in zip(ids, truth)]
+    )
+    return {
+        "index": name,
+        f"recall@{k}": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def benchmark_indexes(
+    conf: ChatConf,
+    vectors: "np.ndarray[Any, Any]",
+    queries: "np.ndarray[Any, Any]",
+    k: int = 10,
+    index: Any = None,
+    index_factories: Optional[List[str]] = None,
+    exact: bool = True,
+    index_name: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Compare the recall@k and the p50/p99 latency of indexes against an exact flat search.
+    index is an existing index holding the vectors in the same order, named index_name,
+    index_factories are the index types to build from the vectors. exact is False when the vectors are decoded from
+    a compressed index: the flat search only finds the nearest decoded vectors."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    truth, latencies = _search(flat, queries, k)
+    results = [_report("Flat (exact)" if exact else "Flat (decoded)", truth, truth, latencies, k)]
+    candidates = [(index_name or index_description(conf), index)] if index else []
+    candidates += [(factory, None) for factory in index_factories or []]
+    for name, existing in candidates:
+        if existing is None:
+            candidate, _ = create_index(conf, vectors, name)
+            candidate.add(vectors)
+        else:
+            candidate = existing
+            tune_index(candidate, conf)
+        ids, latencies = _search(candidate, queries, k)
+        results.append(_report(name, ids, truth, latencies, k))
+    return results
+
+
+def estimate_recall(
+    conf: ChatConf,
+    index: Any,
+    index_factory: str,
+    vectors: "np.ndarray[Any, Any]",
+    k: int = 10,
+    queries: int = 100,
+) -> Optional[Dict[str, Any]]:
+    """Estimate the recall@k of a trained index against an exact search, using some of the vectors
+    as queries on the others, added to a copy of the index. The index itself is not changed, and
+    not trained again. None if there are not enough vectors."""
+    queries = min(queries, len(vectors) // 10)
+    if queries < 1 or len(vectors) - queries < k:
+        return None
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    candidate = faiss.clone_index(index)
+    candidate.add(vectors[queries:])
+    tune_index(candidate, conf)
+    results = benchmark_indexes(
+        conf, vectors[queries:], vectors[:queries], k=k, index=candidate, index_name=index_factory
+    )
+    return results[-1]
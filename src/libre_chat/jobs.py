@@ -0,0 +1,223 @@
+"""Module: Background jobs adding the documents uploaded to the vectorstore"""
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from libre_chat.conf import ChatConf
+from libre_chat.utils import log
+from libre_chat.vectorstore import update_vectorstore
+
+__all__ = ["IngestionJobs", "JobProgress", "run_ingestion"]
+
+JOBS_DIR = ".jobs"
+MAX_JOB_FILES = 100
+
+
+class JobProgress:
+    """
+    Progress of an ingestion job, called by the vectorstore functions with the fields to update.
+    It is written to a JSON file in the vectorstore folder, so any worker can report it.
+    """
+
+    def __init__(self, path: Optional[str], job: Dict[str, Any], interval: float = 0.5) -> None:
+        self.path = path
+        self.job = job
+        self.interval = interval
+        self.written = 0.0
+
+    def __call__(self, **fields: Any) -> None:
+        stage_changed = "stage" in fields and fields["stage"] != self.job.get("stage")
+        self.job.update(fields)
+        if self.job.get("started_at"):
+            elapsed = (self.job.get("finished_at") or time.time()) - self.job["started_at"]
+            self.job["seconds"] = round(elapsed, 1)
+            self.job["chunks_per_sec"] = round(
+                self.job.get("chunks_embedded", 0) / max(elapsed, 1e-9), 1
+            )
+        if stage_changed or time.monotonic() - self.written > self.interval:
+            self.write()
+
+    def write(self) -> None:
+        self.written = time.monotonic()
+        if not self.path:
+            return
+        # The vectorstore folder is removed when all the documents are deleted
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as file:
+            json.dump(self.job, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def run_ingestion(
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: str,
+    status_path: Optional[str],
+    job: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Update the vectorstore with the documents that changed, in the process of the job."""
+    progress = JobProgress(status_path, job)
+    progress(stage="ingesting", started_at=time.time())
+    try:
+        update_vectorstore(conf, document_loaders, device, vector_path, progress=progress)
+        progress(stage="done", finished_at=time.time())
+    except Exception as e:
+        log.error(f"❌ Ingestion job {job['id']} failed: {e}")
+        progress(
+            stage="failed",
+            finished_at=time.time(),
+            errors=[*job.get("errors", []), f"{type(e).__name__}: {e}"],
+        )
+    return progress.job
+
+
+class IngestionJobs:
+    """
+    Update the vectorstore with the documents uploaded in a separate process, one job at a time.
+    Uploads received while a job is waiting to start are added to this job, which starts once
+    no upload was received for vector.ingest_debounce seconds.
+    """
+
+    def __init__(
+        self,
+        conf: ChatConf,
+        document_loaders: Any,
+        device: Any,
+        vector_path: str,
+        on_done: Optional[Callable[[Dict[str, Any]], None]] = None,
+        run: Callable[..., Dict[str, Any]] = run_ingestion,
+    ) -> None:
+        self.conf = conf
+        self.document_loaders = document_loaders
+        self.device = device
+        self.vector_path = vector_path
+        self.on_done = on_done
+        self.run = run
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.pending: Optional[str] = None
+        self.timer: Optional[threading.Timer] = None
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.jobs_path = os.path.join(vector_path, JOBS_DIR)
+
+    def _status_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_path, f"{job_id}.json")
+
+    def submit(self, files: List[str]) -> Dict[str, Any]:
+        """Schedule the update of the vectorstore for the files uploaded, returns the job."""
+        with self.lock:
+            if self.pending:
+                job = self.jobs[self.pending]
+                job["files"] = sorted({*job["files"], *files})
+                job["uploads"] += 1
+            else:
+                job = {
+                    "id": uuid.uuid4().hex,
+                    "stage": "queued",
+                    "files": sorted(set(files)),
+                    "uploads": 1,
+                    "files_processed": 0,
+                    "chunks_split": 0,
+                    "chunks_embedded": 0,
+                    "errors": [],
+                    "created_at": time.time(),
+                }
+                self.jobs[job["id"]] = job
+                self.pending = job["id"]
+                self._prune()
+            os.makedirs(self.jobs_path, exist_ok=True)
+            JobProgress(self._status_path(job["id"]), job).write()
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.conf.vector.ingest_debounce, self._start)
+            self.timer.daemon = True
+            self.timer.start()
+            return dict(job)
+
+    def _start(self) -> None:
+        with self.lock:
+            if not self.pending:
+                return
+            job = self.jobs[self.pending]
+            job["stage"] = "ingesting"
+            self.pending = None
+            if self.executor is None:
+                # Spawned, torch does not support forking a process where it started its threads
+                self.executor = ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                )
+            log.info(f"📥 Starting the ingestion job {job['id']} for {len(job['files'])} files")
+            future = self.executor.submit(
+                self.run,
+                self.conf,
+                self.document_loaders,
+                self.device,
+                self.vector_path,
+                self._status_path(job["id"]),
+                job,
+            )
+        future.add_done_callback(lambda f: self._done(job["id"], f))
+
+    def _done(self, job_id: str, future: "Future[Dict[str, Any]]") -> None:
+        error = future.exception()
+        with self.lock:
+            job = self.jobs[job_id]
+            if error:
+                # The job process crashed
+                job.update(
+                    stage="failed",
+                    finished_at=time.time(),
+                    errors=[*job["errors"], f"{type(error).__name__}: {error}"],
+                )
+                JobProgress(self._status_path(job_id), job).write()
+            else:
+                job.update(future.result())
+        log.info(f"📥 Ingestion job {job_id} {job['stage']}")
+        if self.on_done:
+            self.on_done(dict(job))
+
+    def _prune(self) -> None:
+        """Only keep the status of the last jobs."""
+        if len(self.jobs) > MAX_JOB_FILES:
+            for job_id in sorted(self.jobs, key=lambda i: self.jobs[i]["created_at"])[
+                : len(self.jobs) - MAX_JOB_FILES
+            ]:
+                if self.jobs[job_id]["stage"] in ["done", "failed"]:
+                    del self.jobs[job_id]
+                    if os.path.exists(self._status_path(job_id)):
+                        os.remove(self._status_path(job_id))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status of a job, submitted to this worker or to another one."""
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            with open(self._status_path(job_id)) as file:
+                status: Dict[str, Any] = json.load(file)
+                return status
+        except OSError:
+            with self.lock:
+                job = self.jobs.get(job_id)
+                return dict(job) if job else None
+
+    def close(self) -> None:
+        """Cancel the job waiting to start, and wait for the running job."""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = [job["stage"] for job in self.jobs.values()]
+        return {stage: stages.count(stage) for stage in ["queued", "ingesting", "done", "failed"]}
@@ -0,0 +1,241 @@
+"""Module: Cache of the llama.cpp states of the conversations, to only evaluate the new tokens of each turn"""
+import hashlib
+import os
+import pickle
+import shutil
+import string
+from collections import OrderedDict
+from contextlib import suppress
+from threading import RLock
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from llama_cpp import BaseLlamaCache, Llama, LlamaState
+
+from libre_chat.utils import log
+
+__all__ = [
+    "SessionStateCache",
+    "load_prefix_state",
+    "load_state",
+    "prefix_state_path",
+    "save_prefix_state",
+    "save_state",
+    "static_prefix",
+]
+
+Key = Tuple[int, ...]
+
+
+class SessionStateCache(BaseLlamaCache):  # type: ignore[misc]
+    """
+    States of the llama.cpp context saved at the end of each answer, indexed by the tokens
+    evaluated. The next turn of a conversation starts with the tokens of the previous one, so
+    the model restores the state with the longest common prefix and only evaluates the new tokens.
+
+    States are kept in RAM with LRU eviction, and evicted states are spilled to disk if a path
+    is given. Pinned states, like the one of the static prefix of the prompt, are never evicted.
+    A state is only reused if it shares at least min_prefix_tokens tokens with the prompt, so
+    a state sharing only the BOS token is not loaded for nothing. With a capacity of 0, only the
+    pinned states are kept. The cache can be shared by all the replicas of a model.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int,
+        disk_path: Optional[str] = None,
+        disk_capacity_bytes: int = 0,
+        min_prefix_tokens: int = 2,
+    ) -> None:
+        super().__init__(capacity_bytes)
+        self.min_prefix_tokens = min_prefix_tokens
+        self.ram: "OrderedDict[Key, LlamaState]" = OrderedDict()
+        self.pinned: Dict[Key, LlamaState] = {}
+        self.disk: "OrderedDict[Key, Tuple[str, int]]" = OrderedDict()
+        self.disk_path = disk_path
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.tokens_matched = 0
+        if disk_path:
+            remove_stale_folders(disk_path)
+            # Each process spills its states in its own folder, the workers do not share them
+            self.disk_path = os.path.join(disk_path, str(os.getpid()))
+            # States are only valid for the model and context that produced them
+            shutil.rmtree(self.disk_path, ignore_errors=True)
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.ram.values())
+
+    @property
+    def disk_size(self) -> int:
+        return sum(size for _, size in self.disk.values())
+
+    def _find_longest_prefix_key(self, key: Key) -> Optional[Key]:
+        best_len = self.min_prefix_tokens - 1
+        best_key = None
+        # On equal prefixes the pinned states are kept, they are already in RAM
+        for k in list(self.pinned.keys()) + list(self.ram.keys()) + list(self.disk.keys()):
+            prefix_len = Llama.longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = k
+        return best_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        with self.lock:
+            key = tuple(key)
+            best = self._find_longest_prefix_key(key)
+            if best is None:
+                self.misses += 1
+                raise KeyError("No state for this prompt")
+            if best in self.pinned:
+                state = self.pinned[best]
+            elif best in self.disk:
+                # Bring back to RAM the state spilled to disk
+                path, _ = self.disk.pop(best)
+                try:
+                    state = load_state(path)
+                    os.remove(path)
+                except Exception as e:
+                    log.warning(f"⚠️ Could not load the state spilled in {path}: {e}")
+                    self.misses += 1
+                    raise KeyError("No state for this prompt") from e
+                self._put(best, state)
+            else:
+                state = self.ram[best]
+                self.ram.move_to_end(best)
+            self.hits += 1
+            self.tokens_matched += Llama.longest_token_prefix(best, key)
+            return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self.lock:
+            return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        if self.capacity_bytes <= 0:
+            return
+        with self.lock:
+            self._put(tuple(key), value)
+
+    def pin(self, key: Sequence[int], value: LlamaState) -> None:
+        """Keep a state in the cache, whatever its capacity."""
+        with self.lock:
+            self.pinned[tuple(key)] = value
+
+    def _put(self, key: Key, state: LlamaState) -> None:
+        self.ram.pop(key, None)
+        self.ram[key] = state
+        while self.cache_size > self.capacity_bytes and self.ram:
+            self._spill(*self.ram.popitem(last=False))
+
+    def _spill(self, key: Key, state: LlamaState) -> None:
+        """Write a state evicted from RAM to disk, dropping the oldest ones if the disk is full."""
+        if not self.disk_path or state.llama_state_size > self.disk_capacity_bytes:
+            return
+        path = os.path.join(self.disk_path, hashlib.sha256(str(key).encode()).hexdigest())
+        save_state(path, state)
+        self.disk[key] = (path, state.llama_state_size)
+        while self.disk_size > self.disk_capacity_bytes:
+            old_path, _ = self.disk.popitem(last=False)[1]
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                log.warning(f"⚠️ Could not remove the state spilled in {old_path}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Number and size of the states cached, and length of the prefixes matched."""
+        with self.lock:
+            return {
+                "states": len(self.ram),
+                "pinned": len(self.pinned),
+                "ram_mb": round(self.cache_size / 1024**2, 1),
+                "states_on_disk": len(self.disk),
+                "disk_mb": round(self.disk_size / 1024**2, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefix_tokens_matched": self.tokens_matched,
+            }
+
+
+def remove_stale_folders(disk_path: str) -> None:
+    """Remove the folders of the states spilled by processes that are not running anymore."""
+    if not os.path.isdir(disk_path):
+        return
+    for name in os.listdir(disk_path):
+        if not name.isdigit():
+            continue
+        try:
+            os.kill(int(name), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(disk_path, name), ignore_errors=True)
+        except PermissionError:
+            # Running as another user
+            continue
+
+
+def static_prefix(template: str) -> str:
+    """Text of a prompt template before its first variable, the same for all the prompts."""
+    prefix = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        prefix += literal
+        if field is not None:
+            break
+    return prefix
+
+
+def prefix_state_path(model_path: str, prefix: str, n_ctx: int, engine: str) -> str:
+    """Path of the state of a prompt prefix, next to the model it was evaluated with. The state
+    depends on the actual context size of the model and on the engine that evaluated it."""
+    stat = os.stat(model_path)
+    key = f"{prefix}:{engine}:{n_ctx}:{stat.st_size}:{stat.st_mtime_ns}"
+    return f"{model_path}.prefix-{hashlib.sha256(key.encode()).hexdigest()[:16]}.state"
+
+
+def load_prefix_state(path: str, model: Llama) -> Optional[LlamaState]:
+    """Load the state of a prompt prefix saved to disk, None if it is missing, unreadable, or was
+    saved by a context of another size than the one of the model."""
+    if not os.path.exists(path):
+        return None
+    try:
+        state = load_state(path)
+    except Exception as e:
+        log.warning(f"⚠️ Could not load the state of the prompt prefix from {path}: {e}")
+        return None
+    if len(state.input_ids) != model.n_ctx() or state.n_tokens > model.n_ctx():
+        log.warning(
+            f"⚠️ Ignoring the state of the prompt prefix in {path}, it was saved with a context of {len(state.input_ids)} tokens instead of {model.n_ctx()}"
+        )
+        return None
+    return state
+
+
+def save_prefix_state(path: str, state: Any) -> bool:
+    """Save the state of a prompt prefix to reuse it on restart, only an optimization: the state
+    is kept in memory if the folder of the model is read-only. Returns True if it was saved."""
+    try:
+        save_state(path, state)
+    except OSError as e:
+        log.warning(
+            f"⚠️ Could not save the state of the prompt prefix to {path}, it will be evaluated again on restart: {e}"
+        )
+        with suppress(OSError):
+            os.remove(f"{path}.tmp-{os.getpid()}")
+        return False
+    return True
+
+
+def save_state(path: str, state: Any) -> None:
+    """Write a llama.cpp state to disk, atomically."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(state, file)
+    os.replace(tmp_path, path)
+
+
+def load_state(path: str) -> Any:
+    with open(path, "rb") as file:
+        return pickle.load(file)  # noqa: S301
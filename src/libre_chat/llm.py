@@ -1,18 +1,44 @@
 """Module: Open-source LLM setup"""
+import hashlib
 import os
-from typing import Any, Dict, List, Optional
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Union
 
 import torch
 from langchain.chains import ConversationChain, RetrievalQA
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.llms import LlamaCpp
-from langchain_community.vectorstores import FAISS
 
+from libre_chat.backends import get_backend, lock_qdrant_storage
 from libre_chat.conf import ChatConf, default_conf
+from libre_chat.embeddings import get_embeddings
+from libre_chat.engine import BatchedEngine, BatchedLlamaCpp
+from libre_chat.jobs import IngestionJobs
+from libre_chat.kv_cache import (
+    SessionStateCache,
+    load_prefix_state,
+    prefix_state_path,
+    save_prefix_state,
+    static_prefix,
+)
+from libre_chat.response_cache import ResponseCache, normalize_prompt
+from libre_chat.retriever import CachedRetriever, RetrievalCache
+from libre_chat.scheduler import PRIORITY_API, PRIORITY_CHAT, InferenceScheduler
+from libre_chat.singleflight import SingleFlight
 from libre_chat.utils import BOLD, END, log, parallel_download
-from libre_chat.vectorstore import DEFAULT_DOCUMENT_LOADERS, build_vectorstore
+from libre_chat.vectorstore import (
+    DEFAULT_DOCUMENT_LOADERS,
+    build_vectorstore,
+    current_generation,
+    has_index,
+    is_vectorstore_up_to_date,
+    load_manifest,
+    update_vectorstore,
+    vectorstore_dir,
+)
+from libre_chat.watcher import DocumentsWatcher
 
 __all__ = [
     "Llm",
@@ -48,6 +74,29 @@ class Llm:
             prompt_variables if prompt_variables is not None else self.conf.llm.prompt_variables
         )
         self.prompt_template = prompt_template if prompt_template else self.conf.llm.prompt_template
+        # Prevent concurrent uploads to write the vectorstore at the same time
+        self.vectorstore_lock = Lock()
+        if self.conf.llm.engine not in ["replicas", "batched"]:
+            raise ValueError("The LLM engine should be replicas or batched")
+        if (
+            self.conf.vector.backend == "qdrant"
+            and not self.conf.vector.qdrant_url
+            and self.vector_path
+        ):
+            # Fails now when other workers serve the same embedded storage, not on their 1st query
+            self.qdrant_lock = lock_qdrant_storage(self.vector_path)
+        # Queue the requests waiting for a model replica, each replica generates one answer at a time
+        # With the batched engine, each slot is a sequence decoded in the batch
+        self.scheduler = InferenceScheduler(
+            slots=max(
+                1,
+                self.conf.llm.max_sequences
+                if self.conf.llm.engine == "batched"
+                else self.conf.llm.replicas,
+            ),
+            max_queue=self.conf.llm.queue_size,
+            max_wait=self.conf.llm.queue_timeout,
+        )
 
         # Check if GPU available
         if torch.cuda.is_available():
@@ -78,17 +127,88 @@ class Llm:
 
         self.download_data()
         if self.vector_path:
-            build_vectorstore(self.conf, self.document_loaders, self.device, self.vector_path)
-        # if self.vector_path and not self.has_vectorstore():
-        #     build_vectorstore(self.conf, self.vector_path, self.device)
-        # else:
-        #     log.info(f"♻️  Reusing existing vectorstore at {BOLD}{self.vector_path}{END}, skip building the vectorstore")
-
-        log.info(f"🤖 Loading model from {BOLD}{self.model_path}{END}")
-        self.llm = self.get_llm()
+            if is_vectorstore_up_to_date(self.conf, self.document_loaders, self.vector_path):
+                log.info(
+                    f"♻️  Reusing existing vectorstore at {BOLD}{self.vector_path}{END}, documents and settings did not change"
+                )
+            else:
+                self.update_vectorstore()
+
+        self.engine: Optional[BatchedEngine] = None
+        self.kv_cache: Optional[SessionStateCache] = None
+        # The beginning of the prompt template is the same for all the requests
+        prefix = static_prefix(self.prompt_template) if self.conf.llm.prompt_prefix_cache else ""
+        if self.conf.llm.engine == "batched":
+            log.info(
+                f"🤖 Loading model from {BOLD}{self.model_path}{END} to decode up to {self.scheduler.slots} requests in batch"
+            )
+            self.engine = BatchedEngine(
+                self.model_path,
+                max_sequences=self.scheduler.slots,
+                n_ctx=self.conf.llm.n_ctx or 2048,
+                n_threads=self.conf.llm.n_threads,
+                prefix=prefix,
+                save_prefix_state=True,
+            )
+        else:
+            log.info(
+                f"🤖 Loading {self.scheduler.slots} replica(s) of the model from {BOLD}{self.model_path}{END}"
+            )
+            if self.conf.llm.kv_cache_mb > 0 or prefix:
+                # Shared by the replicas, so a conversation can continue on any of them
+                self.kv_cache = SessionStateCache(
+                    self.conf.llm.kv_cache_mb * 1024**2,
+                    self.conf.llm.kv_cache_path,
+                    self.conf.llm.kv_cache_disk_mb * 1024**2,
+                    self.conf.llm.kv_cache_min_tokens,
+                )
+        self.llms = [self.get_llm() for _ in range(self.scheduler.slots)]
+        self.llm = self.llms[0]
+        if self.kv_cache and prefix:
+            self.setup_prompt_prefix(prefix)
+        self.singleflight = SingleFlight()
+        self.response_cache: Optional[ResponseCache] = None
+        if self.conf.cache.enabled:
+            self.response_cache = ResponseCache(
+                max_entries=self.conf.cache.max_entries,
+                max_bytes=self.conf.cache.max_mb * 1024**2,
+                ttl=self.conf.cache.ttl,
+                semantic_threshold=self.conf.cache.semantic_threshold,
+                embeddings=get_embeddings(self.conf, self.device)
+                if self.conf.cache.semantic_threshold is not None
+                else None,
+            )
+        self.vectorstore_version = ""
+        self.vectorstore_generation: Optional[str] = None
+        self.dbqas: List[RetrievalQA] = []
+        self.vectorstore_checked = time.monotonic()
+        self.reload_lock = Lock()
+        self.retrieval_cache: Optional[RetrievalCache] = (
+            RetrievalCache(self.conf.vector.retrieval_cache_size)
+            if self.conf.vector.retrieval_cache_size > 0
+            else None
+        )
+        # Documents uploaded are added to the vectorstore by jobs running in the background
+        self.ingestion: Optional[IngestionJobs] = None
+        if self.vector_path:
+            self.ingestion = IngestionJobs(
+                self.conf,
+                self.document_loaders,
+                self.device,
+                self.vector_path,
+                on_done=lambda job: self.reload_vectorstore(),
+            )
+        self.watcher: Optional[DocumentsWatcher] = None
+        if self.ingestion and self.conf.vector.watch:
+            # Only one of the workers watches the folder, the others do nothing
+            self.watcher = DocumentsWatcher(self.conf, self.ingestion, self.document_loaders)
+            if not self.watcher.start():
+                self.watcher = None
         if self.has_vectorstore():
             log.info(f"💫 Loading vectorstore from {BOLD}{self.vector_path}{END}")
             self.setup_dbqa()
+        if self.response_cache and self.conf.cache.prewarm:
+            Thread(target=self.prewarm_cache, daemon=True).start()
         if not self.vector_path:
             log.info("🦜 No vectorstore provided, using a generic LLM")
 
@@ -107,15 +227,37 @@ class Llm:
         )
         parallel_download(ddl_list, self.conf.info.workers)
 
+    def build_vectorstore(self, documents_path: Optional[str] = None) -> None:
+        """Build the vectorstore from all the documents"""
+        if documents_path:
+            self.conf.vector.documents_path = documents_path
+        with self.vectorstore_lock:
+            build_vectorstore(self.conf, self.document_loaders, self.device, self.vector_path)
+
+    def update_vectorstore(self) -> None:
+        """Only add, change or remove the documents that changed since the vectorstore was built"""
+        if not self.vector_path:
+            return
+        with self.vectorstore_lock:
+            update_vectorstore(self.conf, self.document_loaders, self.device, self.vector_path)
+
+    def ingest_documents(self, files: List[str]) -> Optional[Dict[str, Any]]:
+        """Add the documents uploaded to the vectorstore in the background, returns the job doing it"""
+        if not self.ingestion:
+            return None
+        return self.ingestion.submit(files)
+
     def has_vectorstore(self) -> bool:
         """Check if vectorstore present"""
-        return bool(self.vector_path and os.path.exists(self.vector_path))
+        return has_index(self.vector_path)
 
     def get_vectorstore(self) -> str:
-        """Get the vectorstore path"""
-        return self.vector_path if self.vector_path and os.path.exists(self.vector_path) else ""
+        """Get the path of the current version of the vectorstore"""
+        return (
+            vectorstore_dir(self.vector_path) if self.has_vectorstore() and self.vector_path else ""
+        )
 
-    def get_llm(self, config: Optional[Dict[str, Any]] = None) -> LlamaCpp:
+    def get_llm(self, config: Optional[Dict[str, Any]] = None) -> Union[LlamaCpp, BatchedLlamaCpp]:
         if not config:
             config = {}
         if "temperature" not in config:
@@ -124,14 +266,28 @@ class Llm:
             config["max_new_tokens"] = self.conf.llm.max_new_tokens
         if "stream" not in config:
             config["stream"] = True
+        if self.engine:
+            # Light wrapper sending the prompts to the engine shared by all slots
+            return BatchedLlamaCpp(
+                engine=self.engine,
+                max_tokens=config["max_new_tokens"],
+                temperature=config["temperature"],
+                streaming=config["stream"],
+            )
+        if "n_threads" not in config and self.conf.llm.n_threads:
+            config["n_threads"] = self.conf.llm.n_threads
+        if "n_ctx" not in config and self.conf.llm.n_ctx:
+            config["n_ctx"] = self.conf.llm.n_ctx
         # if "gpu_layers" not in config:
         #     config["gpu_layers"] = self.conf.llm.gpu_layers if self.device.type != "cpu" else 0
         # if self.device.type != "cpu":
         #     config["n_gpu_layers"] = 40
         #     config["n_batch"] = 512
-        return LlamaCpp(
+        llm = LlamaCpp(
             model_path=self.model_path,
             top_p=1,
+            # Replicas share the model weights mapped in memory, only their context is duplicated
+            use_mmap=True,
             **config
             # model_type=self.conf.llm.model_type,
             # n_gpu_layers=40,  # Change this value based on your model and your GPU VRAM pool.
@@ -141,33 +297,113 @@ class Llm:
             # callback_manager=callback_manager,
             # verbose=True,  # Verbose is required to pass to the callback manager
         )
+        if self.kv_cache:
+            llm.client.set_cache(self.kv_cache)
+        return llm
+
+    def setup_prompt_prefix(self, prefix: str) -> None:
+        """Evaluate the static prefix of the prompt once, and pin its state in the cache used by
+        all the replicas. The state is saved next to the model to be reused on restart, if the folder
+        of the model is writable."""
+        if not isinstance(self.llm, LlamaCpp) or not self.kv_cache:
+            return
+        client = self.llm.client
+        # The last token could merge with the text following the prefix
+        tokens = client.tokenize(prefix.encode())[:-1]
+        if not tokens:
+            return
+        state_path = prefix_state_path(self.model_path, prefix, client.n_ctx(), "replicas")
+        state = load_prefix_state(state_path, client)
+        if state is not None:
+            log.info(f"♻️  Restoring the state of the prompt prefix from {BOLD}{state_path}{END}")
+        else:
+            log.info(f"⏳ Evaluating the prompt prefix ({len(tokens)} tokens)")
+            client.reset()
+            client.eval(tokens)
+            state = client.save_state()
+            save_prefix_state(state_path, state)
+        self.kv_cache.pin(tokens, state)
+
+    def check_vectorstore(self) -> None:
+        """Reload the vectorstore in the background if another worker saved a new generation.
+        Checked at most every vector.reload_interval seconds, running queries are not blocked."""
+        if not self.vector_path or (
+            self.dbqas
+            and time.monotonic() - self.vectorstore_checked < self.conf.vector.reload_interval
+        ):
+            return
+        self.vectorstore_checked = time.monotonic()
+        if self.dbqas and current_generation(self.vector_path) == self.vectorstore_generation:
+            return
+        if not self.dbqas:
+            # Nothing to answer with until the vectorstore is loaded
+            self.reload_vectorstore()
+        else:
+            Thread(target=self.reload_vectorstore, daemon=True).start()
+
+    def reload_vectorstore(self) -> None:
+        # Wait for the reload in progress only if there is nothing loaded to answer with
+        if not self.reload_lock.acquire(blocking=not self.dbqas):
+            return
+        try:
+            if (
+                not self.dbqas
+                or current_generation(self.vector_path) != self.vectorstore_generation
+            ):
+                log.info(
+                    f"🔄 Reloading the new version of the vectorstore {BOLD}{self.vector_path}{END}"
+                )
+                self.setup_dbqa()
+        finally:
+            self.reload_lock.release()
 
     def setup_dbqa(self) -> None:
         """Setup the vectorstore for QA"""
-        if self.has_vectorstore():
-            embeddings = HuggingFaceEmbeddings(
-                model_name=self.conf.vector.embeddings_path, model_kwargs={"device": self.device}
-            )
+        if self.has_vectorstore() and self.vector_path:
+            # Load the manifest and the index of the same generation
+            generation = current_generation(self.vector_path)
+            path = vectorstore_dir(self.vector_path, generation)
+            manifest = load_manifest(path)
+            # Version of the index loaded, the cached retrievals of other versions are not reused
+            version = manifest.get("fingerprint", "") if manifest else ""
+            embeddings = get_embeddings(self.conf, self.device)
             # FAISS should automatically use GPU?
-            vectorstore = FAISS.load_local(self.get_vectorstore(), embeddings)
-            # vectorstore = Qdrant(
-            #     QdrantClient(url=self.conf.vector.vector_path, prefer_grpc=True),
-            #     collection_name="libre_chat_rag",
-            #     embeddings=embeddings,
-            # )
+            vectorstore = get_backend(self.conf).load(self.conf, path, embeddings)
 
+            search_type = self.conf.vector.search_type
             search_args: Dict[str, Any] = {"k": self.conf.vector.return_sources_count}
-            if self.conf.vector.score_threshold is not None:
+            if self.conf.vector.score_threshold is not None and search_type != "mmr":
+                # The threshold is on the relevance score, between 0 and 1
                 search_args["score_threshold"] = self.conf.vector.score_threshold
-            self.dbqa = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type=self.conf.vector.chain_type,
-                retriever=vectorstore.as_retriever(
-                    # search_type=self.conf.vector.search_type, search_kwargs=search_args
-                ),
-                return_source_documents=self.conf.vector.return_sources_count > 0,
-                chain_type_kwargs={"prompt": self.prompt},
-            )
+                search_type = "similarity_score_threshold"
+            if self.retrieval_cache:
+                # Embeddings and documents found for the previous versions are dropped
+                self.retrieval_cache.set_version(version)
+                retriever: Any = CachedRetriever(
+                    vectorstore=vectorstore,
+                    cache=self.retrieval_cache,
+                    version=version,
+                    search_type=search_type,
+                    search_kwargs=search_args,
+                )
+            else:
+                retriever = vectorstore.as_retriever(
+                    search_type=search_type, search_kwargs=search_args
+                )
+            # One chain per model replica, all using the same retriever
+            self.dbqas = [
+                RetrievalQA.from_chain_type(
+                    llm=llm,
+                    chain_type=self.conf.vector.chain_type,
+                    retriever=retriever,
+                    return_source_documents=self.conf.vector.return_sources_count > 0,
+                    chain_type_kwargs={"prompt": self.prompt},
+                )
+                for llm in self.llms
+            ]
+            self.dbqa = self.dbqas[0]
+            self.vectorstore_generation = generation
+            self.vectorstore_version = version
 
     def query(
         self,
@@ -176,64 +412,122 @@ class Llm:
         config: Optional[Dict[str, Any]] = None,
         instructions: Optional[str] = None,
         callbacks: Optional[List[Any]] = None,
+        priority: int = PRIORITY_API,
     ) -> Dict[str, Any]:
         """Query the built LLM"""
         log.info(f"💬 Querying the LLM with prompt: {prompt}")
         if len(prompt) < 1:
             raise ValueError("Provide a prompt")
-        if self.vector_path:
-            if not self.has_vectorstore():
-                return {
-                    "result": "The vectorstore has not been built, please go to the [API web UI](/docs) (the green icon at the top right of the page), and upload documents to vectorize."
-                }
-            # self.setup_dbqa()  # we need to reload the dbqa each time to make sure all workers are up-to-date
-            res: Dict[str, Any] = self.dbqa({"query": prompt}, callbacks=callbacks)
-            log.debug(f"💭 Complete response from the LLM: {res}")
-            for i, doc in enumerate(res["source_documents"]):
-                res["source_documents"][i] = {
-                    "page_content": doc.page_content,
-                    "metadata": doc.metadata,
-                }
-                if "source" in res["source_documents"][i]["metadata"]:
-                    res["source_documents"][i]["metadata"]["filename"] = os.path.basename(
-                        res["source_documents"][i]["metadata"]["source"]
-                    )
-        else:
-            # Not using vectostore, generic conversation
-            # NOTE: initializing the LLM and conversation at every call to prevent the conversation to take up lot of memory after some time
-            # And enable to customize the instructions prompt and temperature for each query
-            # Memory is handled at the gradio level
-            if not memory:
-                memory = ConversationBufferMemory(ai_prefix="AI Assistant", memory_key="history")
-            template = instructions if instructions else self.prompt_template
-            prompt_template = PromptTemplate(
-                template=template, input_variables=self.prompt_variables
-            )
-            conversation = ConversationChain(
-                llm=self.llm,
-                prompt=prompt_template,
-                verbose=True,
-                memory=memory
-                # llm=self.get_llm(config), prompt=prompt_template, verbose=True, memory=memory
+        if self.vector_path and not self.has_vectorstore():
+            return {
+                "result": "The vectorstore has not been built, please go to the [API web UI](/docs) (the green icon at the top right of the page), and upload documents to vectorize."
+            }
+        self.check_vectorstore()
+        # Only single questions answered with the default settings are cached and coalesced
+        if memory or config or instructions or callbacks:
+            return self._query(prompt, memory, config, instructions, callbacks, priority)
+        scope = self.cache_scope()
+        if self.response_cache:
+            cached = self.response_cache.get(prompt, scope)
+            if cached:
+                log.info("⚡ Reusing the cached response to this prompt")
+                return cached
+        if self.conf.llm.coalesce_requests:
+            res = self.singleflight.do(
+                f"query:{scope}:{normalize_prompt(prompt)}",
+                lambda: self._query(prompt, priority=priority),
             )
-            resp = conversation.predict(input=prompt, callbacks=callbacks)
-
-            # NOTE: LCEL does not support callbacks handler yet https://github.com/langchain-ai/langchain/issues/14241
-            # chat_prompt = ChatPromptTemplate.from_template(template)
-            # chat_prompt = ChatPromptTemplate.from_messages(
-            #     [
-            #         ("system", "You're an assistant who's good at {ability}"),
-            #         MessagesPlaceholder(variable_name="history"),
-            #         ("human", "{question}"),
-            #     ]
-            # )
-            # output_parser = StrOutputParser()
-            # chain = chat_prompt | self.llm | output_parser
-            # resp = chain.invoke({"input": prompt}, callbacks=callbacks)
-
-            res = {"result": resp}
+        else:
+            res = self._query(prompt, priority=priority)
+        if self.response_cache:
+            self.response_cache.put(prompt, scope, res)
         return res
 
+    def _query(
+        self,
+        prompt: str,
+        memory: Any = None,
+        config: Optional[Dict[str, Any]] = None,
+        instructions: Optional[str] = None,
+        callbacks: Optional[List[Any]] = None,
+        priority: int = PRIORITY_API,
+    ) -> Dict[str, Any]:
+        # Wait for the LLM to be available, raise an error if too many requests are already waiting
+        with self.scheduler.slot(priority) as slot:
+            if self.vector_path:
+                res: Dict[str, Any] = self.dbqas[slot]({"query": prompt}, callbacks=callbacks)
+                log.debug(f"💭 Complete response from the LLM: {res}")
+                for i, doc in enumerate(res["source_documents"]):
+                    res["source_documents"][i] = {
+                        "page_content": doc.page_content,
+                        "metadata": doc.metadata,
+                    }
+                    if "source" in res["source_documents"][i]["metadata"]:
+                        res["source_documents"][i]["metadata"]["filename"] = os.path.basename(
+                            res["source_documents"][i]["metadata"]["source"]
+                        )
+            else:
+                # Not using vectostore, generic conversation
+                # NOTE: initializing the LLM and conversation at every call to prevent the conversation to take up lot of memory after some time
+                # And enable to customize the instructions prompt and temperature for each query
+                # Memory is handled at the gradio level
+                if not memory:
+                    memory = ConversationBufferMemory(
+                        ai_prefix="AI Assistant", memory_key="history"
+                    )
+                template = instructions if instructions else self.prompt_template
+                prompt_template = PromptTemplate(
+                    template=template, input_variables=self.prompt_variables
+                )
+                conversation = ConversationChain(
+                    llm=self.llms[slot],
+                    prompt=prompt_template,
+                    verbose=True,
+                    memory=memory
+                    # llm=self.get_llm(config), prompt=prompt_template, verbose=True, memory=memory
+                )
+                resp = conversation.predict(input=prompt, callbacks=callbacks)
+
+                # NOTE: LCEL does not support callbacks handler yet https://github.com/langchain-ai/langchain/issues/14241
+                # chat_prompt = ChatPromptTemplate.from_template(template)
+                # chat_prompt = ChatPromptTemplate.from_messages(
+                #     [
+                #         ("system", "You're an assistant who's good at {ability}"),
+                #         MessagesPlaceholder(variable_name="history"),
+                #         ("human", "{question}"),
+                #     ]
+                # )
+                # output_parser = StrOutputParser()
+                # chain = chat_prompt | self.llm | output_parser
+                # resp = chain.invoke({"input": prompt}, callbacks=callbacks)
+
+                res = {"result": resp}
+        return res
+
+    def cache_scope(self) -> str:
+        """Everything a cached response depends on, besides the prompt"""
+        scope = [
+            self.prompt_template,
+            self.vectorstore_version,
+            self.model_path,
+            str(self.conf.llm.temperature),
+            str(self.conf.llm.max_new_tokens),
+            str(self.conf.vector.return_sources_count),
+            str(self.conf.vector.score_threshold),
+            self.conf.vector.search_type,
+            self.conf.vector.chain_type,
+        ]
+        return hashlib.sha256("\n".join(scope).encode()).hexdigest()
+
+    def prewarm_cache(self) -> None:
+        """Answer the example prompts, so their responses are cached"""
+        for example in self.conf.info.examples:
+            try:
+                self.query(example)
+            except Exception as e:
+                log.warning(f"⚠️ Could not prewarm the cache with {example}: {e}")
+        log.info(f"🔥 Prewarmed the cache with {len(self.conf.info.examples)} examples")
+
     async def aquery(
         self,
         prompt: str,
@@ -241,48 +535,96 @@ class Llm:
         config: Optional[Dict[str, Any]] = None,
         instructions: Optional[str] = None,
         callbacks: Optional[List[Any]] = None,
+        priority: int = PRIORITY_CHAT,
     ) -> Dict[str, Any]:
         """Async query the built LLM"""
         log.info(f"💬 Querying the LLM with prompt: {prompt}")
         if len(prompt) < 1:
             raise ValueError("Provide a prompt")
-        # TODO: we might need to check if the vectorstore has changed since the last time it was queried,
-        # And rerun self.setup_dbqa() if it has changed. Otherwise uploading file will not be applied to all workers
-        if self.vector_path:
-            if not self.has_vectorstore():
-                return {
-                    "result": "The vectorstore has not been built, please go to the [API web UI](/docs) (the green icon at the top right of the page), and upload documents to vectorize."
-                }
-            # TODO: handle history
-            # self.setup_dbqa()  # we need to reload the dbqa each time to make sure all workers are up-to-date
-            res: Dict[str, Any] = await self.dbqa.acall({"query": prompt}, callbacks=callbacks)
-            log.debug(f"💭 Complete response from the LLM: {res}")
-            for i, doc in enumerate(res["source_documents"]):
-                # doc.to_json() not implemented yet
-                res["source_documents"][i] = {
-                    "page_content": doc.page_content,
-                    "metadata": doc.metadata,
-                }
-                if "source" in res["source_documents"][i]["metadata"]:
-                    res["source_documents"][i]["metadata"]["filename"] = os.path.basename(
-                        res["source_documents"][i]["metadata"]["source"]
-                    )
-        else:
-            # Not using vectostore, generic conversation
-            if not memory:
-                memory = ConversationBufferMemory(ai_prefix="AI Assistant")
-            template = instructions if instructions else self.prompt_template
-            PromptTemplate(template=template, input_variables=self.prompt_variables)
-            conversation = ConversationChain(
-                llm=self.llm,
-                prompt=self.prompt,
-                verbose=True,
-                memory=memory,
-            )
-            resp = await conversation.apredict(input=prompt, callbacks=callbacks)
-            res = {"result": resp}
+        if self.vector_path and not self.has_vectorstore():
+            return {
+                "result": "The vectorstore has not been built, please go to the [API web UI](/docs) (the green icon at the top right of the page), and upload documents to vectorize."
+            }
+        # Pick up the documents uploaded to other workers
+        self.check_vectorstore()
+        if config or instructions or not self.conf.llm.coalesce_requests:
+            return await self._aquery(prompt, memory, config, instructions, callbacks, priority)
+        # Requests with the same prompt and history share the generation and its token stream
+        history = memory.buffer if memory and not self.vector_path else ""
+        leader: List[bool] = []
+
+        async def generate(fanout: List[Any]) -> Dict[str, Any]:
+            leader.append(True)
+            return await self._aquery(prompt, memory, callbacks=fanout, priority=priority)
+
+        res = await self.singleflight.ado(
+            f"aquery:{self.cache_scope()}:{normalize_prompt(prompt)}:{history}", generate, callbacks
+        )
+        if not leader and memory and not self.vector_path:
+            # The conversation chain only saved the exchange in the memory of the leader
+            memory.save_context({"input": prompt}, {"response": res["result"]})
         return res
 
+    async def _aquery(
+        self,
+        prompt: str,
+        memory: Any = None,
+        config: Optional[Dict[str, Any]] = None,
+        instructions: Optional[str] = None,
+        callbacks: Optional[List[Any]] = None,
+        priority: int = PRIORITY_CHAT,
+    ) -> Dict[str, Any]:
+        async with self.scheduler.aslot(priority) as slot:
+            if self.vector_path:
+                # TODO: handle history
+                res: Dict[str, Any] = await self.dbqas[slot].acall(
+                    {"query": prompt}, callbacks=callbacks
+                )
+                log.debug(f"💭 Complete response from the LLM: {res}")
+                for i, doc in enumerate(res["source_documents"]):
+                    # doc.to_json() not implemented yet
+                    res["source_documents"][i] = {
+                        "page_content": doc.page_content,
+                        "metadata": doc.metadata,
+                    }
+                    if "source" in res["source_documents"][i]["metadata"]:
+                        res["source_documents"][i]["metadata"]["filename"] = os.path.basename(
+                            res["source_documents"][i]["metadata"]["source"]
+                        )
+            else:
+                # Not using vectostore, generic conversation
+                if not memory:
+                    memory = ConversationBufferMemory(ai_prefix="AI Assistant")
+                template = instructions if instructions else self.prompt_template
+                PromptTemplate(template=template, input_variables=self.prompt_variables)
+                conversation = ConversationChain(
+                    llm=self.llms[slot],
+                    prompt=self.prompt,
+                    verbose=True,
+                    memory=memory,
+                )
+                resp = await conversation.apredict(input=prompt, callbacks=callbacks)
+                res = {"result": resp}
+        return res
+
+    def stats(self) -> Dict[str, Any]:
+        """Get stats about the requests sent to the LLM"""
+        stats = {"scheduler": self.scheduler.stats()}
+        if self.engine:
+            stats["engine"] = self.engine.stats()
+        if self.kv_cache:
+            stats["kv_cache"] = self.kv_cache.stats()
+        if self.response_cache:
+            stats["response_cache"] = self.response_cache.stats()
+        stats["coalescing"] = self.singleflight.stats()
+        if self.retrieval_cache:
+            stats["retrieval_cache"] = self.retrieval_cache.stats()
+        if self.ingestion:
+            stats["ingestion_jobs"] = self.ingestion.stats()
+        if self.watcher:
+            stats["documents_watcher"] = self.watcher.stats()
+        return stats
+
 
 # "page_content": "Drug repositioning and repurposing for Alzheimer disease\nClive Ballard1",
 # "metadata": { "source": "documents/drug_repositioning_for_alzheimer_disease.pdf",
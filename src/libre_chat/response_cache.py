@@ -0,0 +1,140 @@
+"""Module: Cache of the responses of the LLM to the prompts asked frequently"""
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+__all__ = ["ResponseCache", "normalize_prompt"]
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Ignore the case and the spacing of a prompt."""
+    return " ".join(prompt.casefold().split())
+
+
+class _Entry:
+    def __init__(self, response: Dict[str, Any], vector: Optional["np.ndarray[Any, Any]"]) -> None:
+        self.response = response
+        self.vector = vector
+        self.created = time.monotonic()
+        self.size = len(json.dumps(response, default=str)) + (
+            vector.nbytes if vector is not None else 0
+        )
+
+
+class ResponseCache:
+    """
+    Responses of the LLM, looked up by exact match on the normalized prompt, then optionally by
+    similarity of the prompt embedding. Entries are evicted least recently used first when the
+    cache is over its number of entries or memory cap, and expire after ttl seconds.
+
+    Entries are only valid for a scope (the prompt template, the vectorstore version and the
+    generation settings): the cache is emptied when the scope changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024**2,
+        ttl: float = 3600,
+        semantic_threshold: Optional[float] = None,
+        embeddings: Optional[Embeddings] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold if embeddings else None
+        self.embeddings = embeddings
+        self.scope: Optional[str] = None
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _embed(self, prompt: str) -> Optional["np.ndarray[Any, Any]"]:
+        if not self.embeddings or self.semantic_threshold is None:
+            return None
+        vector = np.asarray(self.embeddings.embed_query(prompt), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _set_scope(self, scope: str) -> None:
+        """Drop all the entries if the scope changed. Must be called with the lock held."""
+        if scope != self.scope:
+            self.entries.clear()
+            self.size = 0
+            self.scope = scope
+
+    def _remove(self, key: str) -> None:
+        self.size -= self.entries.pop(key).size
+
+    def _semantic_match(self, vector: "np.ndarray[Any, Any]") -> Optional[str]:
+        keys = [key for key, entry in self.entries.items() if entry.vector is not None]
+        if not keys:
+            return None
+        scores = np.stack([self.entries[key].vector for key in keys]) @ vector  # type: ignore[misc]
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.semantic_threshold else None
+
+    def get(self, prompt: str, scope: str) -> Optional[Dict[str, Any]]:
+        """Get the cached response to a prompt, or None."""
+        key = normalize_prompt(prompt)
+        # Embed outside of the lock, it can take a few milliseconds
+        vector = (
+            self._embed(key)
+            if self.semantic_threshold is not None and key not in self.entries
+            else None
+        )
+        with self.lock:
+            self._set_scope(scope)
+            now = time.monotonic()
+            for expired in [k for k, e in self.entries.items() if now - e.created > self.ttl]:
+                self._remove(expired)
+            if key in self.entries:
+                self.hits += 1
+            else:
+                match = self._semantic_match(vector) if vector is not None else None
+                if not match:
+                    self.misses += 1
+                    return None
+                self.semantic_hits += 1
+                key = match
+            self.entries.move_to_end(key)
+            return copy.deepcopy(self.entries[key].response)
+
+    def put(self, prompt: str, scope: str, response: Dict[str, Any]) -> None:
+        """Cache the response to a prompt."""
+        key = normalize_prompt(prompt)
+        entry = _Entry(copy.deepcopy(response), self._embed(key))
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            self._set_scope(scope)
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Number and size of the entries, and hits and misses of the cache."""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "mb": round(self.size / 1024**2, 2),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
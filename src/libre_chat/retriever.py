@@ -0,0 +1,133 @@
+"""Module: Retriever caching the embeddings of the queries and the documents found for them"""
+import copy
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever
+from langchain.schema.document import Document
+
+from libre_chat.response_cache import normalize_prompt
+
+__all__ = ["CachedRetriever", "RetrievalCache"]
+
+
+class RetrievalCache:
+    """LRU caches of the query embeddings and of the documents retrieved, for a vectorstore version.
+    Both are emptied when the version changes."""
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.version: Optional[str] = None
+        self.embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.results: "OrderedDict[str, List[Document]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.embedding_hits = 0
+
+    def set_version(self, version: str) -> None:
+        with self.lock:
+            if version != self.version:
+                self.embeddings.clear()
+                self.results.clear()
+                self.version = version
+
+    def _get(self, cache: "OrderedDict[str, Any]", key: str) -> Any:
+        with self.lock:
+            if key not in cache:
+                return None
+            cache.move_to_end(key)
+            return cache[key]
+
+    def _put(self, cache: "OrderedDict[str, Any]", key: str, value: Any) -> None:
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+
+    def get_results(self, key: str) -> Optional[List[Document]]:
+        docs = self._get(self.results, key)
+        with self.lock:
+            if docs is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return copy.deepcopy(docs) if docs is not None else None
+
+    def put_results(self, key: str, docs: List[Document]) -> None:
+        self._put(self.results, key, copy.deepcopy(docs))
+
+    def get_embedding(self, query: str) -> Optional[List[float]]:
+        vector = self._get(self.embeddings, query)
+        if vector is not None:
+            with self.lock:
+                self.embedding_hits += 1
+        return vector  # type: ignore[no-any-return]
+
+    def put_embedding(self, query: str, vector: List[float]) -> None:
+        self._put(self.embeddings, query, vector)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "results": len(self.results),
+                "hits": self.hits,
+                "misses": self.misses,
+                "embedding_hits": self.embedding_hits,
+            }
+
+
+class CachedRetriever(BaseRetriever):
+    """Retriever of a FAISS vectorstore looking up the RetrievalCache before embedding the query
+    and searching the index."""
+
+    vectorstore: Any
+    cache: Any
+    version: str = ""
+    search_type: str = "similarity"
+    search_kwargs: Dict[str, Any] = {}
+
+    def _search(self, vector: List[float]) -> List[Document]:
+        kwargs = dict(self.search_kwargs)
+        if self.search_type == "similarity_score_threshold":
+            threshold = kwargs.pop("score_threshold", None)
+            relevance = self.vectorstore._select_relevance_score_fn()
+            docs_and_scores = self.vectorstore.similarity_search_with_score_by_vector(
+                vector, **kwargs
+            )
+            return [
+                doc
+                for doc, score in docs_and_scores
+                if threshold is None or relevance(score) >= threshold
+            ]
+        if self.search_type == "mmr":
+            docs: List[Document] = self.vectorstore.max_marginal_relevance_search_by_vector(
+                vector, **kwargs
+            )
+            return docs
+        kwargs.pop("score_threshold", None)
+        docs = self.vectorstore.similarity_search_by_vector(vector, **kwargs)
+        return docs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        normalized = normalize_prompt(query)
+        key = json.dumps(
+            [normalized, self.search_type, self.search_kwargs, self.version], sort_keys=True
+        )
+        docs = self.cache.get_results(key)
+        if docs is not None:
+            return docs  # type: ignore[no-any-return]
+        vector = self.cache.get_embedding(normalized)
+        if vector is None:
+            # The vector is shared by all the variants of the query, it must not depend on the first
+            vector = self.vectorstore._embed_query(normalized)
+            self.cache.put_embedding(normalized, vector)
+        docs = self._search(vector)
+        self.cache.put_results(key, docs)
+        return docs  # type: ignore[no-any-return]
@@ -10,7 +10,22 @@ from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.memory import ConversationBufferMemory
 
 from libre_chat.conf import ChatConf, default_conf
-from libre_chat.utils import ChatResponse, Prompt, log
+from libre_chat.scheduler import (
+    PRIORITY_API,
+    PRIORITY_CHAT,
+    SchedulerFullError,
+    SchedulerTimeoutError,
+)
+from libre_chat.utils import (
+    MB,
+    ChatResponse,
+    FileTooLargeError,
+    Prompt,
+    UnsafeFileError,
+    extract_zip,
+    log,
+    save_stream,
+)
 
 __all__ = [
     "ChatRouter",
@@ -28,9 +43,27 @@ api_responses: Optional[Dict[Union[int, str], Dict[str, Any]]] = {
     },
     400: {"description": "Bad Request"},
     422: {"description": "Unprocessable Entity"},
+    429: {
+        "description": "Too many requests waiting for the LLM, retry after the Retry-After delay"
+    },
+    503: {"description": "The LLM is saturated, retry after the Retry-After delay"},
 }
 
 
+def query_llm(llm: Any, prompt: str) -> JSONResponse:
+    """Query the LLM from a HTTP call, and turn the scheduler errors into 429 or 503 responses."""
+    try:
+        return JSONResponse(llm.query(prompt, priority=PRIORITY_API))
+    except SchedulerFullError as e:
+        raise HTTPException(
+            status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+        ) from e
+    except SchedulerTimeoutError as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+        ) from e
+
+
 @dataclass
 class PromptResponse:
     result: str
@@ -84,7 +117,7 @@ class ChatRouter(APIRouter):
             :param request: The HTTP GET request with a .body()
             :param prompt: Prompt to send to the LLM
             """
-            return JSONResponse(self.llm.query(prompt))
+            return query_llm(self.llm, prompt)
 
         @self.post(
             self.path,
@@ -102,7 +135,7 @@ class ChatRouter(APIRouter):
             :param request: The HTTP POST request with a .body()
             :param prompt: Prompt to send to the LLM.
             """
-            return JSONResponse(self.llm.query(prompt.prompt))
+            return query_llm(self.llm, prompt.prompt)
 
         @self.post(
             "/documents",
@@ -122,32 +155,78 @@ class ChatRouter(APIRouter):
                     status_code=403,
                     detail="The admin pass key provided was wrong",
                 )
+            uploaded_files = []
             for uploaded in files:
                 if uploaded.filename:  # no cov
-                    file_path = werkzeug.utils.safe_join(self.conf.vector.documents_path, uploaded.filename)
+                    file_path = werkzeug.utils.safe_join(
+                        self.conf.vector.documents_path, uploaded.filename
+                    )
                     if file_path is None:
                         raise HTTPException(
                             status_code=403,
                             detail=f"Invalid file name: {uploaded.filename}",
                         )
-
-                    with open(file_path, "wb") as file:
-                        file.write(uploaded.file.read())
-                    # Check if the uploaded file is a zip file
-                    if uploaded.filename.endswith(".zip"):
-                        log.info(f"🤐 Unzipping {file_path}")
-                        with zipfile.ZipFile(file_path, "r") as zip_ref:
-                            zip_ref.extractall(self.conf.vector.documents_path)
-                        os.remove(file_path)
-            # TODO: add just the uploaded files instead of rebuilding the triplestore
-            self.llm.build_vectorstore()
-            self.llm.setup_dbqa()
+                    try:
+                        # Written by chunks, the uploaded file is never fully loaded in memory
+                        save_stream(uploaded.file, file_path, self.conf.vector.upload_max_mb * MB)
+                        # Check if the uploaded file is a zip file
+                        if uploaded.filename.endswith(".zip"):
+                            log.info(f"🤐 Unzipping {file_path}")
+                            try:
+                                extracted = extract_zip(
+                                    file_path,
+                                    self.conf.vector.documents_path,
+                                    max_file_bytes=self.conf.vector.upload_max_mb * MB,
+                                    max_bytes=self.conf.vector.unzip_max_mb * MB,
+                                    max_ratio=self.conf.vector.unzip_max_ratio,
+                                    workers=self.conf.vector.unzip_workers,
+                                )
+                            finally:
+                                os.remove(file_path)
+                            # The job reports the documents extracted, not the zip file
+                            uploaded_files.extend(extracted)
+                        else:
+                            uploaded_files.append(uploaded.filename)
+                    except FileTooLargeError as e:
+                        raise HTTPException(status_code=413, detail=str(e)) from e
+                    except (UnsafeFileError, zipfile.BadZipFile) as e:
+                        raise HTTPException(status_code=400, detail=str(e)) from e
+            # Only the files that were added or changed are embedded, by a job in the background
+            job = self.llm.ingest_documents(uploaded_files)
+            if not job:
+                return JSONResponse(
+                    {"message": f"Documents uploaded in {self.conf.vector.documents_path}."}
+                )
             return JSONResponse(
                 {
-                    "message": f"Documents uploaded in {self.conf.vector.documents_path}, vectorstore rebuilt."
-                }
+                    "message": f"Documents uploaded in {self.conf.vector.documents_path}, the vectorstore will be updated by the job {job['id']}.",
+                    "job": job,
+                    "status_url": f"/documents/jobs/{job['id']}",
+                },
+                status_code=202,
             )
 
+        @self.get(
+            "/documents/jobs/{job_id}",
+            description="""Get the progress of the job adding uploaded documents to the vectorstore: stage, files and chunks processed, throughput and errors.""",
+            response_description="Job progress",
+            response_model={},
+            tags=["vectorstore"],
+        )
+        def get_ingestion_job(
+            job_id: str,
+            admin_pass: Optional[str] = None,
+        ) -> JSONResponse:
+            if self.conf.auth.admin_pass and admin_pass != self.conf.auth.admin_pass:
+                raise HTTPException(
+                    status_code=403,
+                    detail="The admin pass key provided was wrong",
+                )
+            job = self.llm.ingestion.get(job_id) if self.llm.ingestion else None
+            if not job:
+                raise HTTPException(status_code=404, detail=f"Ingestion job {job_id} not found")
+            return JSONResponse(job)
+
         @self.get(
             "/documents",
             description="""List documents uploaded to the server.""",
@@ -168,6 +247,25 @@ class ChatRouter(APIRouter):
             file_list = os.listdir(self.conf.vector.documents_path)
             return JSONResponse({"count": len(file_list), "files": file_list})
 
+        @self.get(
+            "/stats",
+            name="Get LLM stats",
+            description="""Get stats about the requests sent to the LLM, such as the number of requests waiting.""",
+            response_description="LLM stats",
+            response_model={},
+            tags=["monitoring"],
+        )
+        def get_stats(
+            admin_pass: Optional[str] = None,
+        ) -> JSONResponse:
+            """Get stats about the requests sent to the LLM."""
+            if self.conf.auth.admin_pass and admin_pass != self.conf.auth.admin_pass:
+                raise HTTPException(
+                    status_code=403,
+                    detail="The admin pass key provided was wrong",
+                )
+            return JSONResponse(self.llm.stats())
+
         @self.get(
             "/config",
             name="Get Chat configuration",
@@ -226,11 +324,17 @@ class ChatRouter(APIRouter):
                     start_resp = ChatResponse(sender="bot", message="", type="start")
                     await websocket.send_json(start_resp.dict())
 
-                    resp = await self.llm.aquery(
-                        data["prompt"],
-                        memory=memory,
-                        callbacks=[StreamWebsocketCallback(websocket)],
-                    )
+                    try:
+                        resp = await self.llm.aquery(
+                            data["prompt"],
+                            memory=memory,
+                            callbacks=[StreamWebsocketCallback(websocket)],
+                            priority=PRIORITY_CHAT,
+                        )
+                    except (SchedulerFullError, SchedulerTimeoutError) as e:
+                        error_resp = ChatResponse(sender="bot", message=str(e), type="error")
+                        await websocket.send_json(error_resp.model_dump())
+                        continue
                     # chat_history.append((question, resp["result"]))
                     # log.warning("RESULTS!")
                     # log.warning(resp["result"])
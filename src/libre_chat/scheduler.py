@@ -0,0 +1,225 @@
+"""Module: Scheduler to queue the requests sent to the LLM"""
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+__all__ = [
+    "InferenceScheduler",
+    "PRIORITY_API",
+    "PRIORITY_CHAT",
+    "SchedulerFullError",
+    "SchedulerTimeoutError",
+]
+
+# Lower values are served first
+PRIORITY_CHAT = 0
+PRIORITY_API = 1
+
+
+class SchedulerFullError(Exception):
+    """Raised when the queue of requests waiting for the LLM is full."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Too many requests waiting for the LLM, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class SchedulerTimeoutError(Exception):
+    """Raised when a request waited too long in the queue for the LLM."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"The LLM is saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """A request waiting for a slot, woken up by a thread event or an asyncio future."""
+
+    def __init__(self, priority: int, seq: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.seq = seq
+        self.slot: Optional[int] = None
+        self.enqueued = time.monotonic()
+        self.loop = loop
+        self.event = threading.Event()
+        self.future: Optional["asyncio.Future[int]"] = loop.create_future() if loop else None
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def grant(self, slot: int) -> None:
+        self.slot = slot
+        if self.loop and self.future:
+            self.loop.call_soon_threadsafe(_resolve, self.future, slot)
+        else:
+            self.event.set()
+
+
+def _resolve(future: "asyncio.Future[int]", slot: int) -> None:
+    if not future.done():
+        future.set_result(slot)
+
+
+class InferenceScheduler:
+    """
+    Admission control in front of the LLM: a bounded priority queue of requests waiting for one
+    of the slots that can run a generation. Works for requests coming from threads (sync HTTP
+    calls, gradio) and from the event loop (websocket).
+    """
+
+    def __init__(self, slots: int = 1, max_queue: int = 32, max_wait: float = 120) -> None:
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._free: List[int] = list(range(slots))
+        self._waiting: List[_Ticket] = []
+        self._seq = itertools.count()
+        # Stats
+        self._served = 0
+        self._started = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._cancelled = 0
+        self._avg_service = 0.0
+        self._avg_wait = 0.0
+        self._busy_since: Dict[int, float] = {}
+        self._created = time.monotonic()
+        self._slot_requests = [0] * slots
+        self._slot_busy = [0.0] * slots
+
+    def retry_after(self) -> int:
+        """Estimate in how many seconds a new request could be served."""
+        service = self._avg_service if self._avg_service > 0 else 10.0
+        return max(1, math.ceil(service * (len(self._waiting) + 1) / self.slots))
+
+    def _try_acquire(self, priority: int, loop: Optional[asyncio.AbstractEventLoop]) -> Any:
+        """Returns a free slot, or the ticket to wait for one. Must be called with the lock held."""
+        if self._free and not self._waiting:
+            slot = self._free.pop(0)
+            self._start(slot, 0)
+            return slot
+        if len(self._waiting) >= self.max_queue:
+            self._rejected += 1
+            raise SchedulerFullError(self.retry_after())
+        ticket = _Ticket(priority, next(self._seq), loop)
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _start(self, slot: int, waited: float) -> None:
+        self._busy_since[slot] = time.monotonic()
+        self._avg_wait = 0.9 * self._avg_wait + 0.1 * waited if self._started else waited
+        self._started += 1
+
+    def _cancel(self, ticket: _Ticket, timed_out: bool = True) -> Optional[int]:
+        """Remove a ticket from the queue, returns its slot if it was granted in the meantime.
+        Counted as timed out, or as cancelled by the client."""
+        with self._lock:
+            if ticket.slot is not None:
+                return ticket.slot
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            if timed_out:
+                self._timed_out += 1
+            else:
+                self._cancelled += 1
+            return None
+
+    def acquire(self, priority: int = PRIORITY_API) -> int:
+        """Wait for a free slot, blocking the current thread."""
+        with self._lock:
+            ticket = self._try_acquire(priority, None)
+        if isinstance(ticket, int):
+            return ticket
+        if not ticket.event.wait(self.max_wait):
+            slot = self._cancel(ticket)
+            if slot is None:
+                raise SchedulerTimeoutError(self.retry_after())
+        return int(ticket.slot)  # type: ignore[arg-type]
+
+    async def aacquire(self, priority: int = PRIORITY_CHAT) -> int:
+        """Wait for a free slot without blocking the event loop."""
+        with self._lock:
+            ticket = self._try_acquire(priority, asyncio.get_running_loop())
+        if isinstance(ticket, int):
+            return ticket
+        try:
+            return await asyncio.wait_for(asyncio.shield(ticket.future), self.max_wait)  # type: ignore[arg-type]
+        except asyncio.TimeoutError:
+            slot = self._cancel(ticket)
+            if slot is None:
+                raise SchedulerTimeoutError(self.retry_after()) from None
+            return slot
+        except asyncio.CancelledError:
+            # The client went away while waiting
+            slot = self._cancel(ticket, timed_out=False)
+            if slot is not None:
+                self.release(slot)
+            raise
+
+    def release(self, slot: int) -> None:
+        """Give back a slot, and hand it over to the next request waiting, if any."""
+        with self._lock:
+            now = time.monotonic()
+            service = now - self._busy_since.pop(slot, now)
+            self._avg_service = 0.9 * self._avg_service + 0.1 * service if self._served else service
+            self._served += 1
+            self._slot_requests[slot] += 1
+            self._slot_busy[slot] += service
+            if self._waiting:
+                ticket = heapq.heappop(self._waiting)
+                self._start(slot, now - ticket.enqueued)
+                ticket.grant(slot)
+            else:
+                self._free.append(slot)
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_API) -> Iterator[int]:
+        slot = self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    @asynccontextmanager
+    async def aslot(self, priority: int = PRIORITY_CHAT) -> AsyncIterator[int]:
+        slot = await self.aacquire(priority)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and counters of the scheduler, and utilization of each slot."""
+        with self._lock:
+            now = time.monotonic()
+            uptime = max(now - self._created, 1e-9)
+            slots = []
+            for slot in range(self.slots):
+                busy = self._slot_busy[slot] + now - self._busy_since.get(slot, now)
+                slots.append(
+                    {
+                        "slot": slot,
+                        "busy": slot in self._busy_since,
+                        "requests": self._slot_requests[slot],
+                        "utilization": round(busy / uptime, 3),
+                    }
+                )
+            return {
+                "slots": self.slots,
+                "busy": self.slots - len(self._free),
+                "queued": len(self._waiting),
+                "max_queue": self.max_queue,
+                "served": self._served,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "cancelled": self._cancelled,
+                "avg_service_seconds": round(self._avg_service, 3),
+                "avg_wait_seconds": round(self._avg_wait, 3),
+                "replicas": slots,
+            }
@@ -0,0 +1,169 @@
+"""Module: Coalesce identical requests running at the same time into a single generation"""
+import asyncio
+import copy
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, cast
+
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from libre_chat.utils import log
+
+__all__ = ["SingleFlight"]
+
+T = TypeVar("T")
+
+
+class _Subscriber:
+    """Callbacks of a request attached to a flight, with its own queue of the tokens to send,
+    so a slow or closed client does not hold back the others."""
+
+    def __init__(self, callbacks: List[Any], tokens: List[str]) -> None:
+        self.callbacks = callbacks
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        for token in tokens:
+            self.queue.put_nowait(token)
+
+    async def send(self) -> None:
+        """Send the tokens to the callbacks until the end of the generation."""
+        while True:
+            token = await self.queue.get()
+            if token is None:
+                return
+            try:
+                for callback in self.callbacks:
+                    res = callback.on_llm_new_token(token)
+                    if asyncio.iscoroutine(res):
+                        await res
+            except Exception as e:
+                # e.g. websocket closed, the request still gets the result
+                log.debug(f"Stop streaming a coalesced generation to a request: {e}")
+                return
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.future: "Future[Any]" = Future()
+        self.task: "Optional[asyncio.Future[Any]]" = None
+        # Loop of the async requests, the tokens can be generated in an executor thread
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.tokens: List[str] = []
+        self.subscribers: List[_Subscriber] = []
+
+    def subscribe(self, callbacks: List[Any]) -> _Subscriber:
+        """Attach a request, it first gets the tokens already generated. Called on the loop."""
+        subscriber = _Subscriber(callbacks, self.tokens)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def publish(self, token: Optional[str]) -> None:
+        """Queue a token for all the requests attached, None when the generation is over.
+        Can be called from any thread, the queues are only used on the loop of the requests."""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._queue, token)
+
+    def _queue(self, token: Optional[str]) -> None:
+        if token is not None:
+            self.tokens.append(token)
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait(token)
+
+
+class _FanoutCallback(AsyncCallbackHandler):
+    """Send the tokens generated for a flight to all the requests attached to it."""
+
+    def __init__(self, flight: _Flight) -> None:
+        super().__init__()
+        self.flight = flight
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.flight.publish(token)
+
+
+class SingleFlight:
+    """
+    Runs only one call at a time for a given key: the calls made with the same key while
+    it is running wait for its result, instead of running the same generation again.
+    Async calls also get the tokens streamed by the running generation, from the beginning.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key: str) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def _land(self, key: str, flight: _Flight, task: "Future[Any]") -> None:
+        """Share the result of the call running for a key, and let the next calls run again."""
+        with self._lock:
+            del self._flights[key]
+        flight.publish(None)
+        if task.cancelled():
+            flight.future.cancel()
+        elif task.exception() is not None:
+            flight.future.set_exception(task.exception())  # type: ignore[arg-type]
+        else:
+            flight.future.set_result(task.result())
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        """Call fn, or wait for the result of the call running for the same key."""
+        flight, leader = self._join(key)
+        if not leader:
+            return copy.deepcopy(flight.future.result())  # type: ignore[no-any-return]
+        task: "Future[T]" = Future()
+        try:
+            task.set_result(fn())
+        except BaseException as e:
+            task.set_exception(e)
+        self._land(key, flight, task)
+        return task.result()
+
+    async def ado(
+        self,
+        key: str,
+        fn: Callable[[List[Any]], Awaitable[T]],
+        callbacks: Optional[List[Any]] = None,
+    ) -> T:
+        """Await fn called with the callbacks streaming its tokens, or attach to the call running
+        for the same key."""
+        flight, leader = self._join(key)
+        subscriber = flight.subscribe(callbacks or [])
+        if leader:
+            flight.loop = asyncio.get_running_loop()
+            task: "asyncio.Future[T]" = asyncio.ensure_future(fn([_FanoutCallback(flight)]))
+            task.add_done_callback(lambda t: self._land(key, flight, t))  # type: ignore[arg-type]
+            flight.task = task
+        else:
+            # Set by the leader before the flight could be joined
+            task = cast("asyncio.Future[T]", flight.task)
+        sending = asyncio.ensure_future(subscriber.send())
+        try:
+            # The generation keeps running for the other requests if this one is cancelled
+            res = await asyncio.shield(task)
+            await sending
+        except asyncio.CancelledError:
+            flight.subscribers.remove(subscriber)
+            if not flight.subscribers:
+                task.cancel()
+            raise
+        finally:
+            sending.cancel()
+        return res if leader else copy.deepcopy(res)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": len(self._flights),
+            "generations": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,213 @@
+"""Module: Split the documents in chunks sized in tokens of the embeddings model and of the LLM"""
+import copy
+import json
+import math
+import os
+from contextlib import suppress
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.schema.document import Document
+from langchain.text_splitter import TextSplitter
+
+from libre_chat.conf import ChatConf
+from libre_chat.utils import log
+
+__all__ = ["TokenAwareTextSplitter", "TokenCounter", "llm_chunk_budget"]
+
+SEPARATORS = ["\n\n", "\n", ". ", " "]
+# Tokens of the instructions and of the question in the prompt, besides the documents
+PROMPT_RESERVE_TOKENS = 256
+
+
+def embeddings_max_tokens(embeddings_path: str, tokenizer: Any) -> int:
+    """Max number of tokens of a text encoded by the embeddings model, longer texts are truncated."""
+    max_length = int(tokenizer.model_max_length)
+    config_path = os.path.join(embeddings_path, "sentence_bert_config.json")
+    if not os.path.exists(config_path):
+        with suppress(Exception):
+            from huggingface_hub import hf_hub_download
+
+            config_path = hf_hub_download(embeddings_path, "sentence_bert_config.json")
+    with suppress(OSError, ValueError), open(config_path) as file:
+        max_length = min(max_length, int(json.load(file)["max_seq_length"]))
+    return max_length - int(tokenizer.num_special_tokens_to_add())
+
+
+def llm_chunk_budget(conf: ChatConf) -> Optional[int]:
+    """Max number of LLM tokens of a chunk, so the sources stuffed in the prompt, the instructions
+    and the answer fit in the context of the LLM. None if the context is too small for the sources.
+    """
+    n_ctx = conf.llm.n_ctx or (2048 if conf.llm.engine == "batched" else 512)
+    sources = conf.vector.return_sources_count if conf.vector.chain_type == "stuff" else 1
+    budget = (n_ctx - conf.llm.max_new_tokens - PROMPT_RESERVE_TOKENS) // max(sources, 1)
+    if budget < 1:
+        log.warning(
+            f"⚠️ No room for the documents in the LLM context of {n_ctx} tokens with max_new_tokens {conf.llm.max_new_tokens}, chunks are only sized for the embeddings model"
+        )
+        return None
+    return budget
+
+
+class TokenCounter:
+    """
+    Count the tokens of texts with the tokenizer of the embeddings model, in one batched call,
+    and with the tokenizer of the LLM when its model is available (only its vocabulary is loaded).
+    The largest count is returned, so a chunk fits in the limits of both models.
+    """
+
+    def __init__(self, conf: ChatConf) -> None:
+        # Installed with sentence_transformers
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(conf.vector.embeddings_path)
+        self.limit = embeddings_max_tokens(conf.vector.embeddings_path, self.tokenizer)
+        self.llm: Any = None
+        budget = llm_chunk_budget(conf)
+        if budget is not None:
+            try:
+                from llama_cpp import Llama
+
+                self.llm = Llama(model_path=conf.llm.model_path, vocab_only=True, verbose=False)
+                self.limit = min(self.limit, budget)
+            except Exception as e:
+                log.warning(
+                    f"⚠️ Could not load the tokenizer of the LLM {conf.llm.model_path}, chunks are only sized for the embeddings model: {e}"
+                )
+
+    def __call__(self, texts: List[str]) -> List[int]:
+        encoded = self.tokenizer(
+            texts, add_special_tokens=False, return_attention_mask=False, verbose=False
+        )
+        counts = [len(ids) for ids in encoded["input_ids"]]
+        if self.llm:
+            counts = [max(count, llm) for count, llm in zip(counts, self.llm_counts(texts))]
+        return counts
+
+    def llm_counts(self, texts: List[str]) -> List[int]:
+        """Count the tokens of the LLM of all the texts in one buffer, llama.cpp only tokenizes
+        one text at a time, and Llama.tokenize allocates a buffer of the context size per text."""
+        import llama_cpp
+
+        encoded = [text.encode() for text in texts]
+        # At most one token per byte, and the leading space added by some tokenizers
+        size = max((len(text) for text in encoded), default=0) + 1
+        tokens = (llama_cpp.llama_token * size)()
+        model = self.llm.model
+        # A negative count is the number of tokens that did not fit in the buffer
+        return [
+            abs(llama_cpp.llama_tokenize(model, text, len(text), tokens, size, False, False))
+            for text in encoded
+        ]
+
+
+class TokenAwareTextSplitter(TextSplitter):
+    """
+    Split texts in chunks of at most chunk_size tokens, on paragraphs, then lines, sentences and
+    words like the RecursiveCharacterTextSplitter. The pieces of all the texts of a file are
+    tokenized together, one batched call per level of separator, and chunks are merged from the
+    token counts of their pieces. The chunks are counted again in one call for the build report.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[List[str]], List[int]],
+        chunk_size: int,
+        chunk_overlap: int,
+        separators: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, **kwargs)
+        self.count_tokens = count_tokens
+        self.separators = separators or SEPARATORS
+        self.lengths: List[int] = []
+
+    @staticmethod
+    def _split(piece: str, tokens: int, separator: str, chunk_size: int) -> List[str]:
+        if separator:
+            parts = piece.split(separator)
+            parts = [part + separator for part in parts[:-1]] + parts[-1:]
+        else:
+            # No separator left, cut the piece in parts of the same number of characters
+            step = math.ceil(len(piece) / max(math.ceil(tokens / chunk_size), 2))
+            parts = [piece[i : i + step] for i in range(0, len(piece), step)]
+        return [part for part in parts if part]
+
+    def _pieces(self, texts: List[str]) -> List[List[List[Any]]]:
+        """Split the texts in pieces of at most chunk_size tokens, returns their text and tokens."""
+        pieces: List[List[List[Any]]] = [[[text, None]] for text in texts]
+        uncounted = [piece for text in pieces for piece in text]
+        separators = iter(self.separators)
+        while uncounted:
+            for piece, tokens in zip(uncounted, self.count_tokens([p[0] for p in uncounted])):
+                piece[1] = tokens
+            separator = next(separators, "")
+            uncounted = []
+            for text in pieces:
+                split_pieces: List[List[Any]] = []
+                for piece in text:
+                    if piece[1] > self._chunk_size and len(piece[0]) > 1:
+                        parts = self._split(piece[0], piece[1], separator, self._chunk_size)
+                        split_pieces.extend([part, None] for part in parts)
+                        uncounted.extend(split_pieces[-len(parts) :])
+                    else:
+                        split_pieces.append(piece)
+                text[:] = split_pieces
+        return pieces
+
+    def _merge(self, pieces: List[List[Any]]) -> List[str]:
+        """Merge the pieces of a text in chunks, with chunk_overlap tokens of the previous chunk."""
+        chunks: List[str] = []
+        current: List[List[Any]] = []
+        current_tokens = 0
+
+        def add_chunk() -> None:
+            chunk = "".join(piece[0] for piece in current)
+            chunk = chunk.strip() if self._strip_whitespace else chunk
+            if chunk:
+                chunks.append(chunk)
+
+        for piece in pieces:
+            if current and current_tokens + piece[1] > self._chunk_size:
+                add_chunk()
+                while current and (
+                    current_tokens > self._chunk_overlap
+                    or current_tokens + piece[1] > self._chunk_size
+                ):
+                    current_tokens -= current.pop(0)[1]
+            current.append(piece)
+            current_tokens += piece[1]
+        if current:
+            add_chunk()
+        return chunks
+
+    def split_texts(self, texts: List[str]) -> List[List[str]]:
+        chunks = [self._merge(pieces) for pieces in self._pieces(texts)]
+        # The tokens of the pieces do not add up exactly to the tokens of the chunk they form
+        self.lengths.extend(self.count_tokens([chunk for text in chunks for chunk in text]))
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        return self.split_texts([text])[0]
+
+    def create_documents(
+        self, texts: List[str], metadatas: Optional[List[Dict[Any, Any]]] = None
+    ) -> List[Document]:
+        metadatas = metadatas or [{} for _ in texts]
+        return [
+            Document(page_content=chunk, metadata=copy.deepcopy(metadata))
+            for chunks, metadata in zip(self.split_texts(texts), metadatas)
+            for chunk in chunks
+        ]
+
+    def report(self) -> Optional[str]:
+        """Distribution of the token length of the chunks split."""
+        lengths = np.array(self.lengths)
+        if len(lengths) < 1:
+            return None
+        p50, p90, p99 = (int(p) for p in np.percentile(lengths, [50, 90, 99]))
+        over = int((lengths > self._chunk_size).sum())
+        return (
+            f"Chunks token length: min {lengths.min()}, p50 {p50}, p90 {p90}, p99 {p99}, max {lengths.max()}"
+            + (f", {over} over the limit of {self._chunk_size} tokens" if over else "")
+        )
@@ -0,0 +1,119 @@
+"""Module: Cache of the text extracted from the documents, reused when only the chunking changes"""
+import gzip
+import hashlib
+import json
+import os
+import time
+import uuid
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.schema.document import Document
+
+from libre_chat.utils import log
+
+__all__ = ["TextCache"]
+
+ENTRY_SUFFIX = ".jsonl.gz"
+
+
+class TextCache:
+    """
+    Documents extracted from a file by a loader, stored as gzipped JSON lines in a file named after
+    the hash of the file content and of the loader settings. Changing the chunking or the embeddings
+    does not parse the files again, only changing the files or their loaders does.
+    Entries are written atomically, so the workers loading files in parallel can share the cache.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @staticmethod
+    def key(file_hash: str, doc_load: Dict[str, Any]) -> str:
+        loader_cls = doc_load["loader_cls"]
+        loader = {
+            "loader_cls": f"{loader_cls.__module__}.{loader_cls.__qualname__}",
+            "loader_kwargs": doc_load.get("loader_kwargs", {}),
+        }
+        return hashlib.sha256(
+            json.dumps([file_hash, loader], sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}{ENTRY_SUFFIX}")
+
+    def get(self, file_hash: str, doc_load: Dict[str, Any], path: str) -> Optional[List[Document]]:
+        """Documents extracted from a file with the same content, None if not in the cache."""
+        entry_path = self._entry_path(self.key(file_hash, doc_load))
+        try:
+            with gzip.open(entry_path, "rt", encoding="utf-8") as file:
+                header = json.loads(file.readline())
+                documents = [Document(**json.loads(line)) for line in file]
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            log.warning(f"⚠️ Removing the corrupted text cache entry {entry_path}: {e}")
+            # Another worker may have removed or replaced it already, a miss either way
+            with suppress(FileNotFoundError):
+                os.remove(entry_path)
+            return None
+        # The same content can be found at another path
+        for doc in documents:
+            if doc.metadata.get("source") == header["source"]:
+                doc.metadata["source"] = path
+        # Last use, the least recently used entries are pruned first
+        with suppress(FileNotFoundError):
+            os.utime(entry_path)
+        return documents
+
+    def put(
+        self, file_hash: str, doc_load: Dict[str, Any], path: str, documents: List[Document]
+    ) -> None:
+        entry_path = self._entry_path(self.key(file_hash, doc_load))
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            file.write(json.dumps({"source": path}) + "\n")
+            for doc in documents:
+                line = {"page_content": doc.page_content, "metadata": doc.metadata}
+                file.write(json.dumps(line, default=str) + "\n")
+        os.replace(tmp_path, entry_path)
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """Path, size and last use of the entries, least recently used first."""
+        entries: List[Tuple[str, int, float]] = []
+        if not os.path.isdir(self.path):
+            return entries
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith(ENTRY_SUFFIX):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        return {
+            "path": self.path,
+            "entries": len(entries),
+            "size_mb": round(sum(size for _, size, _ in entries) / 1024**2, 2),
+            "oldest_days": round((time.time() - entries[0][2]) / 86400, 1) if entries else None,
+        }
+
+    def prune(self, max_bytes: Optional[int] = None, max_days: Optional[float] = None) -> int:
+        """Remove the entries not used for max_days, then the least recently used ones until
+        the cache is smaller than max_bytes. Returns the number of entries removed."""
+        entries = self.entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        removed = 0
+        for entry_path, entry_size, last_used in entries:
+            too_old = max_days is not None and time.time() - last_used > max_days * 86400
+            too_large = max_bytes is not None and size > max_bytes
+            if not too_old and not too_large:
+                break
+            os.remove(entry_path)
+            size -= entry_size
+            removed += 1
+        return removed
@@ -9,6 +9,7 @@ from langchain.callbacks.base import BaseCallbackHandler
 from langchain.memory import ConversationBufferMemory
 
 from libre_chat.llm import Llm
+from libre_chat.scheduler import PRIORITY_CHAT, SchedulerFullError, SchedulerTimeoutError
 
 RETRY_COMMAND = "/retry"
 USER_NAME = "User"
@@ -60,16 +61,21 @@ def gradio_app(llm: Llm) -> Any:
                 "temperature": temperature,
                 "max_new_tokens": max_new_tokens,
             }
-            res = llm.query(
-                input_text,
-                memory,
-                callbacks=[StreamGradioCallback(q)],
-                config=config,
-                instructions=instructions,
-            )
-            if "source_documents" in res:
-                sources_list.append(res["source_documents"])
-            q.put(job_done)
+            try:
+                res = llm.query(
+                    input_text,
+                    memory,
+                    callbacks=[StreamGradioCallback(q)],
+                    config=config,
+                    instructions=instructions,
+                    priority=PRIORITY_CHAT,
+                )
+                if "source_documents" in res:
+                    sources_list.append(res["source_documents"])
+            except (SchedulerFullError, SchedulerTimeoutError) as e:
+                q.put(f"⚠️ {e}")
+            finally:
+                q.put(job_done)
 
         # Create a thread and start the function
         t = Thread(target=task)
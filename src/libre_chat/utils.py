@@ -1,17 +1,27 @@
 import logging
 import os
 import shutil
+import uuid
 import zipfile
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
 from pydantic import BaseModel, validator
 from tqdm import tqdm
 from uvicorn.logging import ColourizedFormatter
+from werkzeug.utils import safe_join
 
-__all__ = ["Prompt", "parallel_download", "log"]
+__all__ = [
+    "Prompt",
+    "UnsafeFileError",
+    "FileTooLargeError",
+    "extract_zip",
+    "parallel_download",
+    "save_stream",
+    "log",
+]
 
 
 log_format = "%(levelprefix)s [%(asctime)s] %(message)s [%(module)s:%(funcName)s]"
@@ -63,7 +73,138 @@ class Prompt:
     # model: str
 
 
-def download_file(url: str, path: str) -> None:
+MB = 1024 * 1024
+CHUNK_SIZE = MB
+# Zip files smaller than this are extracted by a single thread
+PARALLEL_UNZIP_MIN_BYTES = 64 * MB
+
+
+class UnsafeFileError(ValueError):
+    """A file uploaded or downloaded that can not be written safely to disk."""
+
+
+class FileTooLargeError(UnsafeFileError):
+    """A file, or the files extracted from a zip, exceed the size limits."""
+
+
+def save_stream(
+    source: Union[BinaryIO, Iterable[bytes]],
+    path: str,
+    max_bytes: Optional[int] = None,
+    on_chunk: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """Write a file object or an iterator of bytes to a file chunk by chunk, returns its size.
+    The file is renamed to its path once complete, nothing is written if it exceeds max_bytes."""
+    chunks: Iterable[bytes] = (
+        iter(lambda: source.read(CHUNK_SIZE), b"") if hasattr(source, "read") else source
+    )
+    folder, filename = os.path.split(path)
+    tmp_path = os.path.join(folder, f".{filename}.{uuid.uuid4().hex[:8]}.part")
+    size = 0
+    try:
+        with open(tmp_path, "wb") as file:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise FileTooLargeError(f"{filename} is larger than {max_bytes / MB:g} MB")
+                file.write(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def _check_zip(
+    zip_ref: zipfile.ZipFile,
+    path: str,
+    max_file_bytes: Optional[int],
+    max_bytes: Optional[int],
+    max_ratio: Optional[float],
+) -> List[Tuple[zipfile.ZipInfo, str]]:
+    """Check the size, compression ratio and path of all the files in the zip before extracting it.
+    The sizes in the headers are trusted, zipfile stops reading a file at its size."""
+    members = []
+    total = 0
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        if (info.external_attr >> 16) & 0o170000 == 0o120000:
+            log.warning(f"⚠️ Skipping the symbolic link {info.filename} in the zip file")
+            continue
+        file_path = safe_join(path, info.filename)
+        if file_path is None:
+            raise UnsafeFileError(f"Invalid file name in the zip file: {info.filename}")
+        if max_file_bytes is not None and info.file_size > max_file_bytes:
+            raise FileTooLargeError(
+                f"{info.filename} in the zip file is larger than {max_file_bytes / MB:g} MB"
+            )
+        if max_ratio and info.file_size > max_ratio * max(info.compress_size, 1):
+            raise FileTooLargeError(
+                f"{info.filename} in the zip file is compressed more than {max_ratio:g} times"
+            )
+        total += info.file_size
+        if max_bytes is not None and total > max_bytes:
+            raise FileTooLargeError(
+                f"The files in the zip file are larger than {max_bytes / MB:g} MB"
+            )
+        members.append((info, file_path))
+    return members
+
+
+def _extract_files(
+    zip_ref: zipfile.ZipFile,
+    members: List[Tuple[zipfile.ZipInfo, str]],
+    on_chunk: Optional[Callable[[int], Any]] = None,
+) -> None:
+    for info, file_path in members:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with zip_ref.open(info) as source:
+            save_stream(source, file_path, info.file_size, on_chunk)
+
+
+def extract_zip(
+    zip_path: str,
+    path: str,
+    max_file_bytes: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    max_ratio: Optional[float] = None,
+    workers: int = 1,
+    on_chunk: Optional[Callable[[int], Any]] = None,
+) -> List[str]:
+    """Extract a zip file to a folder, streaming each file to disk, returns the names of the files.
+    Nothing is extracted if a file is outside of the folder, or exceeds the limits on its size,
+    the total size or the compression ratio (zip bombs). Large zip files are extracted by
+    several threads, each reading its own share of the files."""
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = _check_zip(zip_ref, path, max_file_bytes, max_bytes, max_ratio)
+        total = sum(info.file_size for info, _ in members)
+        workers = min(workers, len(members))
+        if workers <= 1 or total < PARALLEL_UNZIP_MIN_BYTES:
+            _extract_files(zip_ref, members, on_chunk)
+            return [info.filename for info, _ in members]
+    # Largest files first, each to the thread with the least bytes to extract
+    shares: List[List[Tuple[zipfile.ZipInfo, str]]] = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for member in sorted(members, key=lambda m: m[0].file_size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        shares[smallest].append(member)
+        sizes[smallest] += member[0].file_size
+
+    def extract_share(share: List[Tuple[zipfile.ZipInfo, str]]) -> None:
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            _extract_files(zip_ref, share, on_chunk)
+
+    # zlib releases the GIL while decompressing
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(extract_share, share) for share in shares]:
+            future.result()
+    return [info.filename for info, _ in members]
+
+
+def download_file(url: str, path: str, workers: int = 4) -> None:
     ddl_path = f"{path}-ddl" if not url.endswith(".zip") else f"{path}.zip"
     log.info(f"📥 Downloading {url} to {ddl_path}")
     progress_bar: Optional[tqdm] = None
@@ -72,17 +213,16 @@ def download_file(url: str, path: str) -> None:
             response.raise_for_status()
             total_size_in_bytes = int(response.headers.get("content-length", 0))
             progress_bar = tqdm(total=total_size_in_bytes, unit="iB", unit_scale=True)
-            with open(ddl_path, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    progress_bar.update(len(chunk))
-                    file.write(chunk)
+            save_stream(
+                response.iter_content(chunk_size=CHUNK_SIZE), ddl_path, on_chunk=progress_bar.update
+            )
             progress_bar.close()
         if ddl_path.endswith(".zip"):
             log.info(f"🤐 Unzipping {ddl_path} to {path}")
             with zipfile.ZipFile(ddl_path, "r") as zip_ref:
-                # Extract all the contents into the directory
-                for file in tqdm(zip_ref.infolist(), desc="Extracting "):
-                    zip_ref.extract(file, path)  # type: ignore
+                total_size = sum(info.file_size for info in zip_ref.infolist())
+            progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True, desc="Extracting ")
+            extract_zip(ddl_path, path, workers=workers, on_chunk=progress_bar.update)
         else:
             shutil.move(ddl_path, path)
     except Exception as e:
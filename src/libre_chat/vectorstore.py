@@ -1,13 +1,28 @@
 """Module: Open-source LLM setup"""
+import fcntl
+import hashlib
+import json
+import multiprocessing
 import os
+import re
+import shutil
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Union
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
 from langchain.schema.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
 from langchain_community.document_loaders import (
     CSVLoader,
-    DirectoryLoader,
     EverNoteLoader,
     JSONLoader,
     PyPDFLoader,
@@ -21,22 +36,549 @@ from langchain_community.document_loaders import (
     UnstructuredPowerPointLoader,
     UnstructuredWordDocumentLoader,
 )
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 
+from libre_chat.backends import INDEX_FILES, Batch, VectorBackend, get_backend
 from libre_chat.conf import ChatConf
+from libre_chat.docstore import CHUNKS_FILE, OFFSETS_FILE
+from libre_chat.embeddings import close_embeddings, embeddings_report, get_embeddings
+from libre_chat.index import index_description
+from libre_chat.splitter import TokenAwareTextSplitter, TokenCounter
+from libre_chat.text_cache import TextCache
 from libre_chat.utils import BOLD, CYAN, END, log
 
+MANIFEST_FILE = "manifest.json"
+GENERATION_FILE = "CURRENT"
+
+# Called with the fields of the progress of an ingestion job to update
+Progress = Callable[..., None]
+
+
+def hash_file(path: str) -> str:
+    """Compute the sha256 hash of a file content, reading it by blocks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def list_document_files(
+    documents_path: str, document_loaders: Any
+) -> Dict[str, List[Dict[str, Any]]]:
+    """List the files that will be loaded from the documents folder, with the loaders matching each file.
+    Follows the same rules as the langchain DirectoryLoader: only visible files at the root of the folder.
+    """
+    files: Dict[str, List[Dict[str, Any]]] = {}
+    if not os.path.isdir(documents_path):
+        return files
+    for filename in sorted(os.listdir(documents_path)):
+        if filename.startswith(".") or not os.path.isfile(os.path.join(documents_path, filename)):
+            continue
+        matching = [
+            doc_load for doc_load in document_loaders if Path(filename).match(doc_load["glob"])
+        ]
+        if matching:
+            files[filename] = matching
+    return files
+
+
+def load_file(
+    path: str,
+    doc_loads: List[Dict[str, Any]],
+    text_cache: Optional[TextCache] = None,
+    file_hash: Optional[str] = None,
+) -> List[Document]:
+    """Load a file with all the loaders matching its extension. The text extracted by a loader
+    is reused from the text cache if the file content did not change."""
+    documents: List[Document] = []
+    for doc_load in doc_loads:
+        loaded = text_cache.get(file_hash, doc_load, path) if text_cache and file_hash else None
+        if loaded is None:
+            loader = doc_load["loader_cls"](path, **doc_load.get("loader_kwargs", {}))
+            loaded = loader.load()
+            if text_cache and file_hash:
+                text_cache.put(file_hash, doc_load, path, loaded)
+        documents.extend(loaded)
+    return documents
+
+
+def chunk_ids(filename: str, file_hash: str, count: int) -> List[str]:
+    """Generate deterministic IDs for the chunks of a file."""
+    return [
+        str(uuid.uuid5(uuid.NAMESPACE_URL, f"{filename}:{file_hash}:{i}")) for i in range(count)
+    ]
+
+
+def current_generation(vector_path: Optional[str]) -> Optional[str]:
+    """Name of the generation of the vectorstore in use, cheap enough to be checked for each request.
+    None if the vectorstore is saved directly in vector_path."""
+    if not vector_path:
+        return None
+    try:
+        with open(os.path.join(vector_path, GENERATION_FILE)) as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def vectorstore_dir(vector_path: str, generation: Optional[str] = None) -> str:
+    """Folder of the current, or given, generation of a vectorstore."""
+    generation = generation or current_generation(vector_path)
+    return os.path.join(vector_path, generation) if generation else vector_path
+
+
+def has_index(vector_path: Optional[str]) -> bool:
+    return bool(vector_path) and any(
+        os.path.exists(os.path.join(vectorstore_dir(str(vector_path)), name))
+        for name in INDEX_FILES
+    )
+
+
+def load_manifest(vector_path: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Load the manifest of the files indexed in a vectorstore, if any."""
+    if not vector_path:
+        return None
+    manifest_path = os.path.join(vectorstore_dir(vector_path), MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as file:
+        manifest: Dict[str, Any] = json.load(file)
+    return manifest
+
+
+@contextmanager
+def lock_vectorstore(vector_path: Optional[str]) -> Iterator[None]:
+    """Exclusive lock on a vectorstore for the processes updating it, the workers and their jobs.
+    The lock file is next to vector_path, which is removed when all the documents are deleted."""
+    if not vector_path:
+        yield
+        return
+    lock_path = f"{os.path.normpath(vector_path)}.lock"
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def list_generations(vector_path: str) -> List[int]:
+    if not os.path.isdir(vector_path):
+        return []
+    return sorted(
+        int(match.group(1))
+        for match in (re.fullmatch(r"gen-(\d+)", name) for name in os.listdir(vector_path))
+        if match
+    )
+
+
+def remove_vectorstore(vector_path: str, backend: VectorBackend) -> None:
+    """Remove all the generations of a vectorstore."""
+    for generation in list_generations(vector_path):
+        backend.remove(os.path.join(vector_path, f"gen-{generation:06d}"))
+    shutil.rmtree(vector_path, ignore_errors=True)
+
+
+def save_vectorstore(
+    vectorstore: VectorStore, vector_path: str, manifest: Dict[str, Any], backend: VectorBackend
+) -> None:
+    """Save the vectorstore and its manifest as a new generation in vector_path, then switch the
+    CURRENT file to it with an atomic rename. Workers loading the vectorstore never see a partially
+    written index, and the previous generation is kept for the workers still loading it."""
+    os.makedirs(vector_path, exist_ok=True)
+    tmp_path = os.path.join(vector_path, f".tmp-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    backend.save(vectorstore, tmp_path)
+    with open(os.path.join(tmp_path, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+    while True:
+        generations = list_generations(vector_path)
+        generation = f"gen-{(generations[-1] if generations else 0) + 1:06d}"
+        try:
+            os.rename(tmp_path, os.path.join(vector_path, generation))
+            break
+        except OSError:
+            # Another process saved the same generation at the same time
+            if not os.path.exists(os.path.join(vector_path, generation)):
+                raise
+    tmp_file = os.path.join(vector_path, f".{GENERATION_FILE}.tmp-{os.getpid()}")
+    with open(tmp_file, "w") as file:
+        file.write(generation)
+    os.replace(tmp_file, os.path.join(vector_path, GENERATION_FILE))
+    for old in generations[:-1]:
+        backend.remove(os.path.join(vector_path, f"gen-{old:06d}"))
+        shutil.rmtree(os.path.join(vector_path, f"gen-{old:06d}"), ignore_errors=True)
+    # Files of a vectorstore saved directly in vector_path by previous versions
+    for legacy_file in ["index.faiss", "index.pkl", CHUNKS_FILE, OFFSETS_FILE, MANIFEST_FILE]:
+        if os.path.exists(os.path.join(vector_path, legacy_file)):
+            os.remove(os.path.join(vector_path, legacy_file))
+
+
+def _load_file_safe(
+    path: str,
+    doc_loads: List[Dict[str, Any]],
+    text_cache: Optional[TextCache] = None,
+    file_hash: Optional[str] = None,
+) -> Tuple[List[Document], Optional[str]]:
+    """Load a file in a worker process, returns the error instead of raising it to isolate failures."""
+    try:
+        return load_file(path, doc_loads, text_cache, file_hash), None
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}"
+
+
+def _iter_loaded_files(
+    conf: ChatConf, files: Dict[str, List[Dict[str, Any]]], hashes: Dict[str, str]
+) -> Iterator[Tuple[List[Document], Optional[str]]]:
+    """Load files on a pool of processes, only a few files per worker are loaded ahead to bound memory."""
+    workers = min(conf.vector.ingest_workers or conf.info.workers, len(files))
+    text_cache = TextCache(conf.vector.text_cache_path) if conf.vector.text_cache_path else None
+    to_submit = (
+        (
+            os.path.join(conf.vector.documents_path, filename),
+            doc_loads,
+            text_cache,
+            hashes.get(filename),
+        )
+        for filename, doc_loads in files.items()
+    )
+    if workers <= 1:
+        yield from (_load_file_safe(*args) for args in to_submit)
+        return
+
+    def new_pool() -> ProcessPoolExecutor:
+        # Spawned, torch does not support forking a process where it started its threads
+        return ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    executor = new_pool()
+    pending: Deque[Tuple[Tuple[Any, ...], "Future[Tuple[List[Document], Optional[str]]]"]] = deque()
+
+    def submit(args: Tuple[Any, ...]) -> None:
+        pending.append((args, executor.submit(_load_file_safe, *args)))
+
+    try:
+        for args in islice(to_submit, workers * 2):
+            submit(args)
+        while pending:
+            args, future = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # A worker crashed, e.g. in a native parser, and all the files loading failed with it.
+                # The file is loaded again alone in a new pool, to only fail the file crashing it
+                executor.shutdown(wait=False)
+                others = [other for other, _ in pending]
+                pending.clear()
+                executor = new_pool()
+                try:
+                    result = executor.submit(_load_file_safe, *args).result()
+                except BrokenProcessPool as e:
+                    result = [], f"{type(e).__name__}: the process loading the file crashed"
+                    executor.shutdown(wait=False)
+                    executor = new_pool()
+                for other in others:
+                    submit(other)
+            for args in islice(to_submit, 1):
+                submit(args)
+            yield result
+    finally:
+        executor.shutdown()
+
+
+def load_files(
+    conf: ChatConf,
+    files: Dict[str, List[Dict[str, Any]]],
+    hashes: Optional[Dict[str, str]] = None,
+) -> Iterator[Tuple[str, List[Document], Optional[str]]]:
+    """Load files in parallel on a pool of processes, results are yielded in the order of the files.
+    The text extracted from the files with a known hash goes through the text cache.
+    Files that fail to load are logged and skipped, with the error returned."""
+    for filename, (documents, error) in zip(files, _iter_loaded_files(conf, files, hashes or {})):
+        if error:
+            log.warning(f"⚠️ Failed to load {filename}, skipping it: {error}")
+        else:
+            log.debug(f"🗃️  Loaded {len(documents)} items from {filename}")
+        yield filename, documents, error
+
+
+def split_files(
+    conf: ChatConf,
+    files: Dict[str, List[Dict[str, Any]]],
+    stats: Dict[str, Dict[str, Any]],
+    text_splitter: TextSplitter,
+) -> Iterator[Tuple[str, List[Document], Dict[str, Any]]]:
+    """Load and split files from the documents folder, yields their chunks and manifest entry."""
+    hashes = {filename: stat["hash"] for filename, stat in stats.items()}
+    for filename, documents, error in load_files(conf, files, hashes):
+        chunks = text_splitter.split_documents(documents)
+        entry = {
+            **stats[filename],
+            "chunk_ids": chunk_ids(filename, stats[filename]["hash"], len(chunks)),
+        }
+        if error:
+            # Failed files are kept in the manifest to only retry them when they change
+            entry["error"] = error
+        yield filename, chunks, entry
+
+
+def report_files(
+    split: Iterator[Tuple[str, List[Document], Dict[str, Any]]], progress: Optional[Progress]
+) -> Iterator[Tuple[str, List[Document], Dict[str, Any]]]:
+    """Report the files loaded and split, and the ones that failed, to the progress of a job."""
+    files = 0
+    chunks = 0
+    errors: List[str] = []
+    for filename, documents, entry in split:
+        files += 1
+        chunks += len(documents)
+        if "error" in entry:
+            errors.append(f"{filename}: {entry['error']}")
+        if progress:
+            progress(files_processed=files, chunks_split=chunks, errors=errors)
+        yield filename, documents, entry
+
+
+def stat_documents(
+    documents_path: str, files: Dict[str, Any], manifest: Optional[Dict[str, Any]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Get the hash, size and modification time of each document. The hash is only recomputed
+    for files whose size or modification time changed since the manifest was written."""
+    indexed = manifest["files"] if manifest else {}
+    stats: Dict[str, Dict[str, Any]] = {}
+    for filename in files:
+        path = os.path.join(documents_path, filename)
+        stat = os.stat(path)
+        previous = indexed.get(filename)
+        if (
+            previous
+            and previous.get("size") == stat.st_size
+            and previous.get("mtime") == stat.st_mtime_ns
+        ):
+            file_hash = previous["hash"]
+        else:
+            file_hash = hash_file(path)
+        stats[filename] = {"hash": file_hash, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    return stats
+
+
+def refresh_manifest(
+    vector_path: str, manifest: Dict[str, Any], stats: Dict[str, Dict[str, Any]]
+) -> None:
+    """Record in the manifest of the current generation the size and modification time of the
+    files touched without changing their content, so they are not hashed again on the next start.
+    Must be called with the vectorstore locked."""
+    touched = False
+    for filename, entry in manifest["files"].items():
+        stat = stats.get(filename)
+        if (
+            stat
+            and stat["hash"] == entry["hash"]
+            and (entry.get("size"), entry.get("mtime"))
+            != (
+                stat["size"],
+                stat["mtime"],
+            )
+        ):
+            entry.update(size=stat["size"], mtime=stat["mtime"])
+            touched = True
+    if not touched:
+        return
+    manifest_path = os.path.join(vectorstore_dir(vector_path), MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        log.warning(f"⚠️ Could not update the manifest of the vectorstore: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def settings_fingerprint(conf: ChatConf, document_loaders: Any) -> str:
+    """Hash the settings that change the content of the vectorstore: embeddings, chunking and loaders."""
+    settings = {
+        "embeddings_path": conf.vector.embeddings_path,
+        "chunk_size": conf.vector.chunk_size,
+        "chunk_overlap": conf.vector.chunk_overlap,
+        "chunk_unit": conf.vector.chunk_unit,
+        "backend": conf.vector.backend,
+        "index_factory": index_description(conf),
+        "loaders": [
+            {
+                "glob": doc_load["glob"],
+                "loader_cls": f"{doc_load['loader_cls'].__module__}.{doc_load['loader_cls'].__qualname__}",
+                "loader_kwargs": doc_load.get("loader_kwargs", {}),
+            }
+            for doc_load in document_loaders
+        ],
+    }
+    if conf.vector.backend == "qdrant":
+        settings["qdrant"] = {
+            "url": conf.vector.qdrant_url,
+            "payload_indexes": conf.vector.qdrant_payload_indexes,
+        }
+    if conf.vector.chunk_unit == "tokens":
+        # The size of the chunks depends on the tokenizer and the context of the LLM
+        settings["llm"] = {
+            "model_path": conf.llm.model_path,
+            "n_ctx": conf.llm.n_ctx,
+            "engine": conf.llm.engine,
+            "max_new_tokens": conf.llm.max_new_tokens,
+            "return_sources_count": conf.vector.return_sources_count,
+            "chain_type": conf.vector.chain_type,
+        }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def vectorstore_fingerprint(settings: str, stats: Dict[str, Dict[str, Any]]) -> str:
+    """Combine the settings fingerprint with the hash of each document."""
+    sha = hashlib.sha256(settings.encode())
+    for filename in sorted(stats):
+        sha.update(f"{filename}:{stats[filename]['hash']}".encode())
+    return sha.hexdigest()
+
+
+def is_vectorstore_up_to_date(conf: ChatConf, document_loaders: Any, vector_path: str) -> bool:
+    """Check if the vectorstore was built from the current documents with the current settings."""
+    manifest = load_manifest(vector_path)
+    if (
+        not manifest
+        or manifest.get("documents_path") != conf.vector.documents_path
+        or not has_index(vector_path)
+    ):
+        return False
+    files = list_document_files(conf.vector.documents_path, document_loaders)
+    stats = stat_documents(conf.vector.documents_path, files, manifest)
+    settings = settings_fingerprint(conf, document_loaders)
+    if manifest.get("fingerprint") != vectorstore_fingerprint(settings, stats):
+        return False
+    with lock_vectorstore(vector_path):
+        current = load_manifest(vector_path)
+        # Unless another process saved a new generation in the meantime
+        if current and current.get("fingerprint") == manifest["fingerprint"]:
+            refresh_manifest(vector_path, current, stats)
+    return True
+
+
+def iter_batches(
+    conf: ChatConf, chunks: Iterator[Tuple[Document, str]]
+) -> Iterator[List[Tuple[Document, str]]]:
+    """Group chunks in batches of ingest_batch_size chunks, a batch is also emitted earlier
+    when the text it holds reaches the ingest_memory_mb budget."""
+    max_bytes = conf.vector.ingest_memory_mb * 1024 * 1024
+    batch: List[Tuple[Document, str]] = []
+    batch_bytes = 0
+    for chunk, chunk_id in chunks:
+        batch.append((chunk, chunk_id))
+        batch_bytes += len(chunk.page_content.encode())
+        if len(batch) >= conf.vector.ingest_batch_size or batch_bytes >= max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def add_batches(
+    vectorstore: Optional[VectorStore],
+    batches: Iterator[List[Tuple[Document, str]]],
+    embeddings: Embeddings,
+    conf: ChatConf,
+    manifest: Optional[Dict[str, Any]] = None,
+    progress: Optional[Progress] = None,
+) -> Optional[VectorStore]:
+    """Embed each batch of chunks and append it to the vectorstore, created from the first batch if needed.
+    Indexes that need training (IVF, PQ, SQ8, PCA) are created once vector.index_train_size vectors are
+    embedded, the batches embedded until then are kept in memory."""
+    backend = get_backend(conf)
+    count = 0
+    seconds = 0.0
+    pending: List[Batch] = []
+    pending_count = 0
+    for batch in batches:
+        texts = [chunk.page_content for chunk, _ in batch]
+        metadatas = [chunk.metadata for chunk, _ in batch]
+        ids = [chunk_id for _, chunk_id in batch]
+        time_start = time.perf_counter()
+        vectors = embeddings.embed_documents(texts)
+        seconds += time.perf_counter() - time_start
+        count += len(batch)
+        log.debug(f"📥 Embedded {count} chunks")
+        if progress:
+            progress(chunks_embedded=count)
+        if vectorstore is None:
+            pending.append((texts, vectors, metadatas, ids))
+            pending_count += len(batch)
+            if pending_count >= backend.train_size(conf):
+                vectorstore = backend.create(conf, embeddings, pending, manifest)
+                pending = []
+        else:
+            backend.add(vectorstore, (texts, vectors, metadatas, ids))
+    if pending:
+        # Less chunks than the size of the training sample
+        vectorstore = backend.create(conf, embeddings, pending, manifest)
+    close_embeddings(embeddings)
+    report = embeddings_report(embeddings, count, seconds)
+    if report:
+        log.info(f"⚡ {report}")
+    return vectorstore
+
+
+def get_text_splitter(conf: ChatConf) -> TextSplitter:
+    """Split the text up into small, semantically meaningful chunks (often sentences) https://js.langchain.com/docs/modules/data_connection/document_transformers/
+    With chunk_unit tokens, chunk_size is in tokens, and at most the max sequence length of the
+    embeddings model, and the share of each source in the context of the LLM."""
+    if conf.vector.chunk_unit == "chars":
+        return RecursiveCharacterTextSplitter(
+            chunk_size=conf.vector.chunk_size, chunk_overlap=conf.vector.chunk_overlap
+        )
+    if conf.vector.chunk_unit != "tokens":
+        raise ValueError(f"Unknown chunk_unit {conf.vector.chunk_unit}, use chars or tokens")
+    count_tokens = TokenCounter(conf)
+    chunk_size = min(conf.vector.chunk_size, count_tokens.limit)
+    log.info(f"📏 Splitting the documents in chunks of at most {BOLD}{chunk_size}{END} tokens")
+    return TokenAwareTextSplitter(
+        count_tokens, chunk_size, min(conf.vector.chunk_overlap, chunk_size // 2)
+    )
+
+
+def log_splitter_report(text_splitter: TextSplitter) -> None:
+    if isinstance(text_splitter, TokenAwareTextSplitter):
+        report = text_splitter.report()
+        if report:
+            log.info(f"📏 {report}")
+
 
 def build_vectorstore(
-    conf: ChatConf, document_loaders: Any, device: Any, vector_path: Optional[str] = None
-) -> Optional[FAISS]:
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> Optional[VectorStore]:
     """Build vectorstore from documents."""
+    with lock_vectorstore(vector_path):
+        return _build_vectorstore(conf, document_loaders, device, vector_path, progress)
+
+
+def _build_vectorstore(
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> Optional[VectorStore]:
     # NOTE: Using Qdrant blocked by UM proxy...
     # https://github.com/langchain-ai/langchain/blob/master/libs/community/langchain_community/vectorstores/qdrant.py
     time_start = datetime.now()
     documents_path = conf.vector.documents_path
-    docs_count = len(os.listdir(documents_path))
+    files = list_document_files(documents_path, document_loaders)
+    docs_count = len(files)
     if docs_count < 1:
         log.warning(
             f"⚠️ No documents found in {documents_path}, vectorstore will not be built, and a generic chatbot will be used until documents are added"
@@ -45,29 +587,29 @@ def build_vectorstore(
         log.info(
             f"🏗️ Building the vectorstore from the {BOLD}{CYAN}{docs_count}{END} documents found in {BOLD}{documents_path}{END}, using embeddings from {BOLD}{conf.vector.embeddings_path}{END}"
         )
-        documents: List[Document] = []
-        # Loading all file types provided in the document_loaders object
-        for doc_load in document_loaders:
-            loader = DirectoryLoader(
-                documents_path,
-                glob=doc_load["glob"],
-                loader_cls=doc_load["loader_cls"],
-                loader_kwargs=doc_load["loader_kwargs"] if "loader_kwargs" in doc_load else {},
-            )
-            loaded_docs = loader.load()
-            if len(loaded_docs) > 0:
-                log.info(f"🗃️  Loaded {len(loaded_docs)} items from {doc_load['glob']} files")
-            documents.extend(loaded_docs)
+        text_splitter = get_text_splitter(conf)
+        stats = stat_documents(documents_path, files)
+        settings = settings_fingerprint(conf, document_loaders)
+        manifest: Dict[str, Any] = {
+            "documents_path": documents_path,
+            "settings": settings,
+            "fingerprint": vectorstore_fingerprint(settings, stats),
+            "backend": conf.vector.backend,
+            "index": {"factory": index_description(conf)},
+            "files": {},
+        }
 
-        # Split the text up into small, semantically meaningful chunks (often sentences) https://js.langchain.com/docs/modules/data_connection/document_transformers/
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=conf.vector.chunk_size, chunk_overlap=conf.vector.chunk_overlap
-        )
-        splitted_texts = text_splitter.split_documents(documents)
-        # TODO: use fastembed?
-        embeddings = HuggingFaceEmbeddings(
-            model_name=conf.vector.embeddings_path, model_kwargs={"device": device}
-        )
+        if progress:
+            progress(files_total=docs_count)
+
+        def stream_chunks() -> Iterator[Tuple[Document, str]]:
+            for filename, chunks, entry in report_files(
+                split_files(conf, files, stats, text_splitter), progress
+            ):
+                manifest["files"][filename] = entry
+                yield from zip(chunks, entry["chunk_ids"])
+
+        embeddings = get_embeddings(conf, device, ingest=True)
         # TODO: use Qdrant vectorstore
         # os.makedirs(str(conf.vector.vector_path), exist_ok=True)
         # vectorstore = Qdrant.from_documents(
@@ -79,14 +621,119 @@ def build_vectorstore(
         #     prefer_grpc=True,
         #     # force_recreate=True,
         # )
-        vectorstore = FAISS.from_documents(splitted_texts, embeddings)
+        # Documents are loaded, split, embedded and indexed by batches to keep memory usage bounded
+        vectorstore = add_batches(
+            None, iter_batches(conf, stream_chunks()), embeddings, conf, manifest, progress
+        )
+        if vectorstore is None:
+            log.warning(f"⚠️ No text could be extracted from the documents in {documents_path}")
+            return None
+        log.info(
+            f"🗃️  Indexed {get_backend(conf).count(vectorstore)} chunks from {docs_count} files"
+        )
+        log_splitter_report(text_splitter)
         if vector_path:
-            vectorstore.save_local(vector_path)
+            if progress:
+                progress(stage="saving")
+            save_vectorstore(vectorstore, vector_path, manifest, get_backend(conf))
         log.info(f"✅ Vectorstore built in {datetime.now() - time_start}")
         return vectorstore
     return None
 
 
+def update_vectorstore(
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: str,
+    progress: Optional[Progress] = None,
+) -> Optional[VectorStore]:
+    """Update an existing vectorstore with the documents added, changed or removed since it was built.
+    Only the chunks of the files that changed are embedded, falls back to a full build if no manifest
+    is found, or if the settings used to build the vectorstore changed. Returns None without loading
+    the index when no document changed.
+    The vectorstore is locked from loading its last generation to saving the new one, so concurrent
+    jobs of several workers are applied one after the other, each on top of the previous one.
+    """
+    with lock_vectorstore(vector_path):
+        return _update_vectorstore(conf, document_loaders, device, vector_path, progress)
+
+
+def _update_vectorstore(
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: str,
+    progress: Optional[Progress] = None,
+) -> Optional[VectorStore]:
+    manifest = load_manifest(vector_path)
+    documents_path = conf.vector.documents_path
+    settings = settings_fingerprint(conf, document_loaders)
+    if (
+        not manifest
+        or manifest.get("documents_path") != documents_path
+        or manifest.get("settings") != settings
+    ):
+        return _build_vectorstore(conf, document_loaders, device, vector_path, progress)
+    time_start = datetime.now()
+    files = list_document_files(documents_path, document_loaders)
+    if len(files) < 1:
+        log.warning(f"⚠️ No documents left in {documents_path}, removing the vectorstore")
+        remove_vectorstore(vector_path, get_backend(conf))
+        return None
+
+    indexed: Dict[str, Dict[str, Any]] = manifest["files"]
+    stats = stat_documents(documents_path, files, manifest)
+    removed = [filename for filename in indexed if filename not in files]
+    changed = [
+        filename
+        for filename in files
+        if filename not in indexed or indexed[filename]["hash"] != stats[filename]["hash"]
+    ]
+    if not removed and not changed:
+        log.info(f"♻️  No changes in {BOLD}{documents_path}{END}, the vectorstore is up to date")
+        refresh_manifest(vector_path, manifest, stats)
+        return None
+    backend = get_backend(conf)
+    embeddings = get_embeddings(conf, device, ingest=True)
+
+    log.info(
+        f"🔄 Updating the vectorstore with {BOLD}{CYAN}{len(changed)}{END} new or changed and {BOLD}{CYAN}{len(removed)}{END} removed documents"
+    )
+    ids_to_delete: List[str] = []
+    for filename in removed + [f for f in changed if f in indexed]:
+        ids_to_delete.extend(indexed.pop(filename)["chunk_ids"])
+    if ids_to_delete and not backend.can_delete(conf):
+        log.info(f"🔄 Rebuilding the {index_description(conf)} index to remove the old chunks")
+        return _build_vectorstore(conf, document_loaders, device, vector_path, progress)
+    vectorstore = backend.load(conf, vectorstore_dir(vector_path), embeddings, update=True)
+    if ids_to_delete:
+        backend.delete(vectorstore, ids_to_delete)
+
+    text_splitter = get_text_splitter(conf)
+    changed_files = {filename: files[filename] for filename in changed}
+    if progress:
+        progress(files_total=len(changed_files), files_removed=len(removed))
+
+    def stream_chunks() -> Iterator[Tuple[Document, str]]:
+        for filename, chunks, entry in report_files(
+            split_files(conf, changed_files, stats, text_splitter), progress
+        ):
+            indexed[filename] = entry
+            yield from zip(chunks, entry["chunk_ids"])
+
+    add_batches(
+        vectorstore, iter_batches(conf, stream_chunks()), embeddings, conf, progress=progress
+    )
+    log_splitter_report(text_splitter)
+    manifest["fingerprint"] = vectorstore_fingerprint(settings, stats)
+    if progress:
+        progress(stage="saving")
+    save_vectorstore(vectorstore, vector_path, manifest, backend)
+    log.info(f"✅ Vectorstore updated in {datetime.now() - time_start}")
+    return vectorstore
+
+
 DEFAULT_DOCUMENT_LOADERS: List[Dict[str, Union[str, Any]]] = [
     {"glob": "*.pdf", "loader_cls": PyPDFLoader},
     {"glob": "*.csv", "loader_cls": CSVLoader, "loader_kwargs": {"encoding": "utf8"}},
@@ -0,0 +1,151 @@
+"""Module: Watch the documents folder, and add the files changed to the vectorstore"""
+import fcntl
+import os
+import threading
+import time
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+from libre_chat.conf import ChatConf
+from libre_chat.jobs import IngestionJobs
+from libre_chat.utils import BOLD, END, log
+from libre_chat.vectorstore import list_document_files, load_manifest
+
+__all__ = ["DocumentsWatcher"]
+
+# Size and modification time of a file
+FileState = Tuple[int, int]
+
+
+class DocumentsWatcher:
+    """
+    Scan the documents folder every vector.watch_interval seconds, and submit the files created,
+    modified or deleted to the ingestion jobs. Polling works the same on local folders, shared
+    volumes and rsync targets. A file is only submitted once it did not change between two scans,
+    so files still being copied are not ingested, and the jobs debounce bursts of changes.
+    Only one process watches a vectorstore, the one holding the lock file next to vector_path.
+    """
+
+    def __init__(self, conf: ChatConf, jobs: IngestionJobs, document_loaders: Any) -> None:
+        self.conf = conf
+        self.jobs = jobs
+        self.document_loaders = document_loaders
+        self.documents_path = conf.vector.documents_path
+        self.interval = conf.vector.watch_interval
+        # Files as they were last ingested, so changes made while not watching are also picked up
+        manifest = load_manifest(jobs.vector_path)
+        self.known: Dict[str, FileState] = {
+            filename: (entry.get("size", -1), entry.get("mtime", -1))
+            for filename, entry in (manifest["files"] if manifest else {}).items()
+        }
+        self.previous = self.scan()
+        # Time the changes of each job not done yet were detected
+        self.detected: Dict[str, float] = {}
+        self.changes = 0
+        self.last_lag: Optional[float] = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.lock_file: Optional[IO[str]] = None
+
+    def scan(self) -> Dict[str, FileState]:
+        files: Dict[str, FileState] = {}
+        for filename in list_document_files(self.documents_path, self.document_loaders):
+            try:
+                stat = os.stat(os.path.join(self.documents_path, filename))
+            except FileNotFoundError:
+                continue
+            files[filename] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def check(self) -> List[str]:
+        """Scan the folder once, and submit the files that changed, returns them."""
+        current = self.scan()
+        created: List[str] = []
+        modified: List[str] = []
+        deleted: List[str] = []
+        for filename in sorted({*current, *self.known}):
+            state = current.get(filename)
+            if state == self.known.get(filename) or state != self.previous.get(filename):
+                # Unchanged, or still being written
+                continue
+            if state is None:
+                deleted.append(filename)
+                del self.known[filename]
+            else:
+                (modified if filename in self.known else created).append(filename)
+                self.known[filename] = state
+        self.previous = current
+        changed = created + modified + deleted
+        if changed:
+            log.info(
+                f"👀 {len(created)} created, {len(modified)} modified and {len(deleted)} deleted documents in {BOLD}{self.documents_path}{END}"
+            )
+            job = self.jobs.submit(changed)
+            with self.lock:
+                self.detected.setdefault(job["id"], time.time())
+                self.changes += len(changed)
+        return changed
+
+    def run(self) -> None:
+        """Scan the folder until stopped."""
+        log.info(f"👀 Watching {BOLD}{self.documents_path}{END} for changes every {self.interval}s")
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                log.warning(f"⚠️ Could not scan the documents in {self.documents_path}: {e}")
+            if self.stopped.wait(self.interval):
+                return
+
+    def acquire(self) -> bool:
+        """Take the lock of the watcher of the vectorstore, False if another process holds it.
+        The lock is released when the process exits."""
+        lock_path = f"{os.path.normpath(self.jobs.vector_path)}.watch.lock"
+        lock_file = open(lock_path, "a")  # noqa: SIM115
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def start(self) -> bool:
+        """Watch the folder in a thread, unless another process already watches it."""
+        if not self.acquire():
+            log.info(f"👀 {BOLD}{self.documents_path}{END} is already watched by another process")
+            return False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Files waiting to be ingested, and time between the detection of a change and the end
+        of its ingestion (lag), for the last job done and the oldest job waiting."""
+        now = time.time()
+        with self.lock:
+            waiting_files = 0
+            for job_id, detected_at in list(self.detected.items()):
+                job = self.jobs.get(job_id)
+                if job and job["stage"] not in ["done", "failed"]:
+                    waiting_files += len(job["files"])
+                    continue
+                if job:
+                    self.last_lag = round(job.get("finished_at", now) - detected_at, 1)
+                del self.detected[job_id]
+            return {
+                "documents": len(self.known),
+                "changes_detected": self.changes,
+                "queue_jobs": len(self.detected),
+                "queue_files": waiting_files,
+                "lag_seconds": round(now - min(self.detected.values()), 1) if self.detected else 0,
+                "last_lag_seconds": self.last_lag,
+            }
@@ -48,6 +48,14 @@ def test_websocket_prompt_conversation() -> None:
                 pass  # wait for the end
 
 
+def test_get_stats() -> None:
+    """Test the LLM stats require the admin pass"""
+    response = client.get("/stats")
+    assert response.status_code == 403
+    response = client.get("/stats", params={"admin_pass": "testpass"})
+    assert response.status_code == 200
+
+
 def test_get_gradio_ui() -> None:
     """Test get gradio UI"""
     response = client.get("/")
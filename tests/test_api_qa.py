@@ -1,5 +1,6 @@
 """Test a question-answering chatbot with a vectorstore"""
 import os
+import time
 
 from fastapi.testclient import TestClient
 
@@ -41,8 +42,20 @@ def test_documents_success_upload() -> None:
         files=files,
         params={"admin_pass": conf.auth.admin_pass},
     )
-    assert response.status_code == 200
+    assert response.status_code == 202
     assert "Documents uploaded" in response.json()["message"]
+    job_id = response.json()["job"]["id"]
+    # The uploads are added to the vectorstore in the background
+    for _ in range(300):
+        job = client.get(
+            f"/documents/jobs/{job_id}", params={"admin_pass": conf.auth.admin_pass}
+        ).json()
+        if job["stage"] in ["done", "failed"]:
+            break
+        time.sleep(1)
+    assert job["stage"] == "done"
+    assert job["files"] == ["amsterdam.txt", "test.txt"]
+    assert job["files_processed"] > 0
 
 
 def test_documents_success_list() -> None:
@@ -0,0 +1,97 @@
+import os
+from typing import List
+
+import pytest
+from langchain.schema.embeddings import Embeddings
+from qdrant_client import QdrantClient
+
+from libre_chat.backends import QdrantBackend, get_backend, lock_qdrant_storage
+from libre_chat.conf import ChatConf
+
+
+class LetterEmbeddings(Embeddings):
+    """Embed texts by the count of a few letters"""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [[1.0 + text.count(letter) for letter in "aeiou"] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_qdrant_backend(tmp_path) -> None:
+    """Test chunks are added, searched with a filter, and removed from an embedded Qdrant saved as generations"""
+    conf = ChatConf()
+    conf.vector.backend = "qdrant"
+    conf.vector.vector_path = str(tmp_path)
+    backend = get_backend(conf)
+    assert isinstance(backend, QdrantBackend)
+    embeddings = LetterEmbeddings()
+    texts = ["banana", "kiwi", "apple", "pineapple"]
+    batch = (
+        texts,
+        embeddings.embed_documents(texts),
+        [{"source": "fruits.txt" if i < 2 else "more.txt"} for i in range(len(texts))],
+        [f"chunk-{i}" for i in range(len(texts))],
+    )
+    store = backend.create(conf, embeddings, [batch])
+    assert backend.count(store) == 4
+    backend.save(store, str(tmp_path / "gen-000001"))
+
+    store = backend.load(conf, str(tmp_path / "gen-000001"), embeddings)
+    docs = store.similarity_search("apple", k=1, filter={"source": "fruits.txt"})
+    assert docs[0].page_content in ["banana", "kiwi"]
+
+    # Updates are written to a copy of the generation
+    update = backend.load(conf, str(tmp_path / "gen-000001"), embeddings, update=True)
+    backend.delete(update, ["chunk-0", "chunk-1"])
+    backend.save(update, str(tmp_path / "gen-000002"))
+    assert backend.count(store) == 4
+    assert backend.count(backend.load(conf, str(tmp_path / "gen-000002"), embeddings)) == 2
+
+
+def test_qdrant_backend_single_process(tmp_path) -> None:
+    """Test a clear error is raised when the Qdrant storage is opened by another worker"""
+    other_worker = QdrantClient(path=str(tmp_path / "qdrant"))
+    with pytest.raises(RuntimeError, match="only supports 1 worker"):
+        QdrantBackend()._client(str(tmp_path / "qdrant"))
+    other_worker.close()
+    # Checked when the API starts
+    lock = lock_qdrant_storage(str(tmp_path / "vectorstore"))
+    with pytest.raises(ValueError, match="already opened by another process"):
+        lock_qdrant_storage(str(tmp_path / "vectorstore"))
+    lock.close()
+
+
+def test_qdrant_backend_server(tmp_path) -> None:
+    """Test each generation is a collection of the Qdrant server, copied to be updated"""
+    conf = ChatConf()
+    conf.vector.backend = "qdrant"
+    conf.vector.qdrant_url = "http://qdrant:6333"
+    conf.vector.vector_path = str(tmp_path)
+    backend = QdrantBackend()
+    # In-memory Qdrant instead of the server
+    backend.servers[conf.vector.qdrant_url] = server = QdrantClient(":memory:")
+    embeddings = LetterEmbeddings()
+    texts = ["banana", "kiwi", "apple"]
+    batch = (
+        texts,
+        embeddings.embed_documents(texts),
+        [{"source": f"{text}.txt"} for text in texts],
+        [f"chunk-{i}" for i in range(len(texts))],
+    )
+    store = backend.create(conf, embeddings, [batch])
+    backend.save(store, str(tmp_path / "gen-000001"))
+    store = backend.load(conf, str(tmp_path / "gen-000001"), embeddings)
+    docs = store.similarity_search("apple", k=1, filter={"source": "kiwi.txt"})
+    assert docs[0].page_content == "kiwi"
+
+    update = backend.load(conf, str(tmp_path / "gen-000001"), embeddings, update=True)
+    assert update.collection_name != store.collection_name
+    backend.delete(update, ["chunk-0"])
+    backend.save(update, str(tmp_path / "gen-000002"))
+    assert backend.count(store) == 3
+    assert backend.count(backend.load(conf, str(tmp_path / "gen-000002"), embeddings)) == 2
+    backend.remove(str(tmp_path / "gen-000001"))
+    assert [c.name for c in server.get_collections().collections] == [update.collection_name]
+    assert os.listdir(tmp_path / "gen-000002" / "qdrant") == ["server.json"]
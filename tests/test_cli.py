@@ -51,3 +51,9 @@ def test_start(mock_run: MagicMock) -> None:
     mock_run.return_value = None
     result = runner.invoke(cli, ["start"])
     assert result.exit_code == 0
+
+
+def test_text_cache() -> None:
+    result = runner.invoke(cli, ["text-cache", "config/chat-vectorstore-qa.yml", "--days", "365"])
+    assert result.exit_code == 0
+    assert "entries" in result.stdout
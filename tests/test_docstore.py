@@ -0,0 +1,36 @@
+from typing import List
+
+from langchain.schema.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+
+from libre_chat.docstore import MmapDocstore, has_chunks, load_mmap_vectorstore, write_chunks
+
+
+class LetterEmbeddings(Embeddings):
+    """Embed texts by the count of a few letters"""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [[float(text.count(letter)) for letter in "aeiou"] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_mmap_vectorstore(tmp_path) -> None:
+    """Test the vectorstore loaded memory-mapped finds the same chunks as the one in memory"""
+    embeddings = LetterEmbeddings()
+    texts = ["banana", "kiwi", "apple", "", "pineapple", "été"]
+    vectorstore = FAISS.from_texts(
+        texts, embeddings, metadatas=[{"source": f"{i}.txt"} for i in range(len(texts))]
+    )
+    vectorstore.delete([vectorstore.index_to_docstore_id[1]])
+    vectorstore.save_local(str(tmp_path))
+    write_chunks(vectorstore, str(tmp_path))
+    assert has_chunks(str(tmp_path))
+
+    mapped = load_mmap_vectorstore(str(tmp_path), embeddings)
+    assert isinstance(mapped.docstore, MmapDocstore)
+    assert len(mapped.docstore) == mapped.index.ntotal == 5
+    for query in ["banana split", "kiwi", "ete"]:
+        assert mapped.similarity_search(query, k=3) == vectorstore.similarity_search(query, k=3)
+    assert mapped.docstore.search("5") == "ID 5 not found."
@@ -0,0 +1,85 @@
+"""Test the on-disk embeddings cache"""
+import multiprocessing
+import shutil
+from typing import List
+
+from langchain.schema.embeddings import Embeddings
+
+from libre_chat.embeddings import (
+    CachedEmbeddings,
+    EmbeddingsCache,
+    ShardedEmbeddings,
+    embeddings_report,
+    text_key,
+)
+
+cache_path = "tests/tmp/embeddings_cache"
+
+
+class CountingEmbeddings(Embeddings):
+    """Embeddings counting how many texts were encoded"""
+
+    def __init__(self) -> None:
+        self.encoded = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.encoded += len(texts)
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(len(text)), float(sum(map(ord, text)))]
+
+
+def test_embeddings_cache() -> None:
+    """Test embeddings are only computed for texts not in the cache"""
+    shutil.rmtree(cache_path, ignore_errors=True)
+    counting = CountingEmbeddings()
+    embeddings = CachedEmbeddings(counting, EmbeddingsCache(cache_path, "test-model"))
+    vectors = embeddings.embed_documents(["amsterdam", "paris"])
+    assert counting.encoded == 2
+    # Reopen the cache from disk
+    embeddings = CachedEmbeddings(counting, EmbeddingsCache(cache_path, "test-model"))
+    assert embeddings.embed_documents(["paris", "berlin", "amsterdam"]) == [
+        vectors[1],
+        [6.0, 636.0],
+        vectors[0],
+    ]
+    assert counting.encoded == 3
+    assert embeddings.hits == 2
+    # Another model does not share the cache
+    assert len(EmbeddingsCache(cache_path, "other-model")) == 0
+
+
+def add_to_cache(worker: int) -> None:
+    """Add vectors to the cache in small batches, from another process"""
+    cache = EmbeddingsCache(cache_path, "test-model")
+    for start in range(0, 40, 4):
+        texts = [f"text {worker} {i}" for i in range(start, start + 4)] + ["shared"]
+        cache.add([text_key(text) for text in texts], CountingEmbeddings().embed_documents(texts))
+
+
+def test_embeddings_cache_processes() -> None:
+    """Test processes adding to the same cache at the same time keep keys and vectors in step"""
+    shutil.rmtree(cache_path, ignore_errors=True)
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        pool.map(add_to_cache, range(4))
+    cache = EmbeddingsCache(cache_path, "test-model")
+    texts = [f"text {worker} {i}" for worker in range(4) for i in range(40)] + ["shared"]
+    assert len(cache) == len(texts)
+    assert cache.get([text_key(text) for text in texts]) == CountingEmbeddings().embed_documents(
+        texts
+    )
+
+
+def test_sharded_embeddings_order() -> None:
+    """Test embeddings encoded by several processes are returned in the original order"""
+    texts = [f"text {'x' * i}" for i in range(11)]
+    embeddings = ShardedEmbeddings(CountingEmbeddings, shards=3, threads=1)
+    try:
+        assert embeddings.embed_documents(texts) == CountingEmbeddings().embed_documents(texts)
+        assert embeddings.embed_documents([]) == []
+        assert embeddings_report(embeddings, len(texts), 1) == (
+            "Embedded 11 chunks at 11.0 chunks/sec, on 3 processes of 1 threads"
+        )
+    finally:
+        embeddings.close()
@@ -0,0 +1,178 @@
+"""Test the engine decoding concurrent requests in batches, with a fake llama.cpp model"""
+import ctypes
+import sys
+import threading
+import types
+from concurrent.futures import CancelledError
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from libre_chat.engine import BatchedEngine
+
+N_VOCAB = 128
+BOS = 1
+EOS = 0
+SEP = ord("|")
+
+
+class FakeBatch:
+    def __init__(self, n_tokens: int) -> None:
+        self.token = [0] * n_tokens
+        self.pos = [0] * n_tokens
+        self.n_seq_id = [0] * n_tokens
+        self.seq_id = [[0] for _ in range(n_tokens)]
+        self.logits = [False] * n_tokens
+        self.n_tokens = 0
+
+
+class FakeModel:
+    """Characters are tokens, and the answer to a prompt "<turns>|<answer>|" is <answer>."""
+
+    def __init__(self, model_path: str, n_ctx: int, **kwargs: Any) -> None:
+        self._n_ctx = n_ctx
+        self._model = model_path
+        self.context_params = types.SimpleNamespace(n_ctx=n_ctx, n_seq_max=1)
+        self._ctx: Any = None
+
+    @staticmethod
+    def longest_token_prefix(a: List[int], b: List[int]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return N_VOCAB
+
+    def token_eos(self) -> int:
+        return EOS
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        return ([BOS] if add_bos else []) + list(text)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return bytes(tokens)
+
+
+class FakeLlamaCpp(types.ModuleType):
+    """The llama_cpp functions used by the engine, with a KV cache of the tokens of each sequence."""
+
+    def __init__(self) -> None:
+        super().__init__("llama_cpp")
+        self.Llama = FakeModel
+        self._internals = types.SimpleNamespace(_LlamaContext=self._context)
+        self.kv: Dict[int, List[int]] = {}
+        self.batch_sequences: List[int] = []
+        self.gate: Optional[threading.Event] = None
+        self.params: Any = None
+        self.logits: List[Any] = []
+
+    def _context(self, model: Any, params: Any, verbose: bool) -> Any:
+        self.params = params
+        return types.SimpleNamespace(ctx="ctx")
+
+    def llama_batch_init(self, n_tokens: int, embd: int, n_seq_max: int) -> FakeBatch:
+        return FakeBatch(n_tokens)
+
+    def llama_kv_cache_seq_rm(self, ctx: Any, seq_id: int, p0: int, p1: int) -> None:
+        self.kv[seq_id] = [] if p0 < 0 else self.kv.get(seq_id, [])[:p0]
+
+    def llama_kv_cache_seq_cp(self, ctx: Any, src: int, dst: int, p0: int, p1: int) -> None:
+        self.kv[dst] = self.kv.get(src, [])[p0:p1]
+
+    def llama_decode(self, ctx: Any, batch: FakeBatch) -> int:
+        if self.gate:
+            self.gate.wait()
+        self.logits = [None] * batch.n_tokens
+        for i in range(batch.n_tokens):
+            tokens = self.kv.setdefault(batch.seq_id[i][0], [])
+            del tokens[batch.pos[i] :]
+            tokens.append(batch.token[i])
+            if batch.logits[i]:
+                self.logits[i] = self._next_logits(tokens)
+        self.batch_sequences.append(len({batch.seq_id[i][0] for i in range(batch.n_tokens)}))
+        return 0
+
+    @staticmethod
+    def _next_logits(tokens: List[int]) -> Any:
+        seps = [0] + [i for i, token in enumerate(tokens) if token == SEP]
+        answer = tokens[seps[-2] + 1 : seps[-1]]
+        generated = len(tokens) - seps[-1] - 1
+        logits = (ctypes.c_float * N_VOCAB)()
+        logits[answer[generated] if generated < len(answer) else EOS] = 1.0
+        return logits
+
+    def llama_get_logits_ith(self, ctx: Any, index: int) -> Any:
+        return ctypes.cast(self.logits[index], ctypes.POINTER(ctypes.c_float))
+
+
+@pytest.fixture
+def llama_cpp(monkeypatch) -> FakeLlamaCpp:
+    fake = FakeLlamaCpp()
+    monkeypatch.setitem(sys.modules, "llama_cpp", fake)
+    return fake
+
+
+def test_engine_batches_requests(llama_cpp: FakeLlamaCpp) -> None:
+    """Test concurrent requests are decoded together, more requests than sequences wait their turn"""
+    llama_cpp.gate = threading.Event()
+    engine = BatchedEngine("model.gguf", max_sequences=2, n_ctx=256)
+    assert llama_cpp.params.n_seq_max == 3
+    assert engine.model.n_ctx() == 256 * 3
+    futures = [engine.submit(f"answer {i}|", temperature=0) for i in range(3)]
+    llama_cpp.gate.set()
+    assert [future.result(timeout=10) for future in futures] == [f"answer {i}" for i in range(3)]
+    assert max(llama_cpp.batch_sequences) == 2
+    # The next turn only evaluates the new tokens
+    assert engine.generate("hello|", temperature=0) == "hello"
+    reused = engine.stats()["prefix_tokens_reused"]
+    assert engine.generate("hello|hello|next turn|", temperature=0) == "next turn"
+    # The BOS token, the prompt and the answer of the previous turn
+    assert engine.stats()["prefix_tokens_reused"] - reused == 1 + len("hello|hello")
+    assert engine.stats()["active"] == 0
+
+
+def test_engine_cancel(llama_cpp: FakeLlamaCpp) -> None:
+    """Test cancelling a request waiting for a sequence, and a request being generated"""
+    llama_cpp.gate = threading.Event()
+    engine = BatchedEngine("model.gguf", max_sequences=1, n_ctx=256)
+    active = engine.submit("a long answer|", temperature=0)
+    waiting = engine.submit("waiting|", temperature=0)
+    engine.cancel(waiting)
+    engine.cancel(active)
+    llama_cpp.gate.set()
+    with pytest.raises(CancelledError):
+        active.result(timeout=10)
+    assert active.cancelled() and waiting.cancelled()
+    assert engine.generate("next|", temperature=0) == "next"
+
+
+def test_engine_stop_strings(llama_cpp: FakeLlamaCpp) -> None:
+    """Test the text streamed stops before a stop string, even when it spans several tokens"""
+    engine = BatchedEngine("model.gguf", max_sequences=2, n_ctx=256)
+    streamed: List[str] = []
+    answer = engine.generate(
+        "Paris\nUser: and Rome?|", temperature=0, stop=["\nUser:"], on_token=streamed.append
+    )
+    assert answer == "Paris"
+    assert "".join(streamed) == "Paris"
+    # Text held back as the beginning of a stop string is sent once it does not match
+    streamed.clear()
+    answer = engine.generate(
+        "Paris\nUs|", temperature=0, stop=["\nUser:"], on_token=streamed.append
+    )
+    assert answer == "Paris\nUs"
+    assert "".join(streamed) == "Paris\nUs"
+    # The tokens generated until max_tokens are all sent
+    streamed.clear()
+    answer = engine.generate(
+        "Paris\nUs|", max_tokens=6, temperature=0, stop=["\nUser:"], on_token=streamed.append
+    )
+    assert answer == "Paris\n"
+    assert "".join(streamed) == "Paris\n"
@@ -0,0 +1,77 @@
+import numpy as np
+
+from libre_chat.conf import ChatConf
+from libre_chat.index import (
+    benchmark_indexes,
+    create_index,
+    estimate_recall,
+    index_description,
+    index_vectors,
+    is_flat,
+)
+
+
+def test_benchmark_indexes() -> None:
+    """Test the flat index finds the exact neighbors, and IVF and HNSW indexes are built and compared"""
+    conf = ChatConf()
+    rng = np.random.default_rng(0)
+    vectors = rng.random((2000, 16), dtype=np.float32)
+    queries = rng.random((20, 16), dtype=np.float32)
+    results = benchmark_indexes(
+        conf, vectors, queries, k=5, index_factories=["Flat", "IVF16,Flat", "HNSW16"]
+    )
+    assert [res["index"] for res in results] == ["Flat (exact)", "Flat", "IVF16,Flat", "HNSW16"]
+    assert results[1]["recall@5"] == 1.0
+    assert all(0 < res["recall@5"] <= 1 and res["p99_ms"] >= res["p50_ms"] for res in results)
+
+
+def test_index_vectors() -> None:
+    """Test the vectors are read back from flat and clustered indexes, decoded from compressed ones"""
+    conf = ChatConf()
+    vectors = np.random.default_rng(0).random((1000, 8), dtype=np.float32)
+    for factory, exact in [("Flat", True), ("IVF4,Flat", True), ("HNSW8", True), ("SQ8", False)]:
+        conf.vector.index_factory = factory
+        index, _ = create_index(conf, vectors)
+        index.add(vectors)
+        read, is_exact = index_vectors(index)
+        assert is_exact == exact
+        assert np.array_equal(read, vectors) if exact else np.allclose(read, vectors, atol=0.01)
+
+
+def test_create_index_training() -> None:
+    """Test IVF indexes are trained on a sample of the vectors, and fall back to flat without enough vectors"""
+    conf = ChatConf()
+    conf.vector.index_factory = "IVF8,Flat"
+    conf.vector.index_train_size = 500
+    assert not is_flat(conf)
+    rng = np.random.default_rng(0)
+    index, factory = create_index(conf, rng.random((1000, 8), dtype=np.float32))
+    assert index.is_trained and index.ntotal == 0 and index.nprobe == conf.vector.nprobe
+    assert factory == "IVF8,Flat"
+    index, factory = create_index(conf, rng.random((4, 8), dtype=np.float32))
+    assert index.is_trained and index.d == 8 and factory == "Flat"
+
+
+def test_compressed_index() -> None:
+    """Test the vectors are stored as float16 or int8 and reduced with a PCA, with their recall estimated"""
+    conf = ChatConf()
+    conf.vector.vector_dtype = "float16"
+    assert index_description(conf) == "SQfp16"
+    conf.vector.index_factory = "HNSW32"
+    assert index_description(conf) == "HNSW32,SQfp16"
+    conf.vector.index_factory = "IVF16,Flat"
+    conf.vector.vector_dtype = "int8"
+    conf.vector.pca_dim = 8
+    assert index_description(conf) == "PCA8,IVF16,SQ8"
+    assert not is_flat(conf)
+
+    rng = np.random.default_rng(0)
+    vectors = rng.random((2000, 16), dtype=np.float32)
+    index, factory = create_index(conf, vectors)
+    # Estimated on a copy of the index trained, without training another one
+    recall = estimate_recall(conf, index, factory, vectors)
+    assert recall and recall["index"] == "PCA8,IVF16,SQ8" and 0 < recall["recall@10"] < 1
+    assert index.ntotal == 0
+    index.add(vectors)
+    # The PCA stored in the index is applied to the queries
+    assert index.search(vectors[:1], 1)[1].shape == (1, 1)
@@ -0,0 +1,75 @@
+import multiprocessing
+import time
+from typing import Any, Dict, List, Optional
+
+from libre_chat.conf import ChatConf
+from libre_chat.jobs import IngestionJobs, JobProgress
+from libre_chat.vectorstore import lock_vectorstore
+
+
+def fake_ingestion(
+    conf: ChatConf,
+    document_loaders: Any,
+    device: Any,
+    vector_path: str,
+    status_path: Optional[str],
+    job: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Report the progress of an ingestion, without embedding anything"""
+    progress = JobProgress(status_path, job)
+    progress(stage="ingesting", started_at=time.time())
+    progress(files_processed=len(job["files"]), chunks_embedded=10)
+    progress(stage="done", finished_at=time.time())
+    return progress.job
+
+
+def test_ingestion_jobs_debounce(tmp_path) -> None:
+    """Test uploads received together are added to the same job, run in the background"""
+    conf = ChatConf()
+    conf.vector.ingest_debounce = 0.5
+    done: List[Dict[str, Any]] = []
+    jobs = IngestionJobs(conf, [], "cpu", str(tmp_path), on_done=done.append, run=fake_ingestion)
+    first = jobs.submit(["a.txt"])
+    second = jobs.submit(["b.txt", "a.txt"])
+    assert first["id"] == second["id"]
+    assert jobs.get(first["id"])["stage"] == "queued"  # type: ignore[index]
+    for _ in range(600):
+        if done:
+            break
+        time.sleep(0.1)
+    job = jobs.get(first["id"])
+    assert job and job["stage"] == "done"
+    assert job["files"] == ["a.txt", "b.txt"]
+    assert job["uploads"] == 2 and job["files_processed"] == 2
+    assert done[0]["id"] == first["id"]
+    # Uploads after the job started go to a new job
+    assert jobs.submit(["c.txt"])["id"] != first["id"]
+    assert jobs.get("../../etc/passwd") is None
+    assert jobs.stats() == {"queued": 1, "ingesting": 0, "done": 1, "failed": 0}
+    jobs.close()
+
+
+def locked_update(vector_path: str, log_path: str) -> None:
+    """Record the start and end of an update holding the vectorstore lock"""
+    with lock_vectorstore(vector_path):
+        with open(log_path, "a") as file:
+            file.write("start\n")
+        time.sleep(0.3)
+        with open(log_path, "a") as file:
+            file.write("end\n")
+
+
+def test_vectorstore_lock_processes(tmp_path) -> None:
+    """Test updates of the same vectorstore by several workers are applied one after the other"""
+    log_path = str(tmp_path / "updates.log")
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=locked_update, args=(str(tmp_path / "vectorstore"), log_path))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    with open(log_path) as file:
+        assert file.read().split() == ["start", "end"] * 3
@@ -0,0 +1,103 @@
+"""Test the cache of the llama.cpp states of the conversations"""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from libre_chat.kv_cache import (
+    SessionStateCache,
+    load_prefix_state,
+    prefix_state_path,
+    save_prefix_state,
+    save_state,
+    static_prefix,
+)
+
+
+def state(size: int) -> SimpleNamespace:
+    return SimpleNamespace(llama_state_size=size)
+
+
+def test_session_state_cache(tmp_path) -> None:
+    """Test the state with the longest prefix is returned, and evicted states are spilled to disk"""
+    cache = SessionStateCache(100, str(tmp_path), disk_capacity_bytes=100)
+    cache[(1, 2, 3)] = state(60)
+    cache[(1, 5)] = state(60)
+    assert cache.stats()["states"] == 1
+    assert cache.stats()["states_on_disk"] == 1
+    # The state of the previous turn is loaded back from disk
+    assert cache[(1, 2, 3, 4)].llama_state_size == 60
+    assert cache.stats()["states_on_disk"] == 1
+    assert cache.stats()["prefix_tokens_matched"] == 3
+    with pytest.raises(KeyError):
+        cache[(7, 8)]
+    assert cache.stats()["misses"] == 1
+    # Pinned states are kept whatever the capacity
+    cache.pin((7, 8), state(1000))
+    assert cache[(7, 8, 9)].llama_state_size == 1000
+    assert cache.stats()["states"] == 1
+
+
+def test_session_state_cache_min_prefix(tmp_path) -> None:
+    """Test a state sharing fewer tokens than the minimum with the prompt is not reused"""
+    cache = SessionStateCache(100, str(tmp_path), disk_capacity_bytes=100, min_prefix_tokens=3)
+    cache.pin((1, 2, 3), state(10))
+    cache[(1, 2, 3, 4, 5)] = state(60)
+    cache[(1, 9, 9)] = state(60)
+    # Only the BOS token in common with the state spilled to disk
+    with pytest.raises(KeyError):
+        cache[(1, 9, 8)]
+    assert cache.stats()["states_on_disk"] == 1 and cache.stats()["hits"] == 0
+    # The pinned state is used when the other states do not share more tokens
+    assert cache[(1, 2, 3, 7)].llama_state_size == 10
+    assert cache[(1, 2, 3, 4, 6)].llama_state_size == 60
+    # Without capacity only the pinned states are kept
+    cache = SessionStateCache(0, min_prefix_tokens=3)
+    cache[(1, 2, 3, 4)] = state(60)
+    assert cache.stats()["states"] == 0
+
+
+def test_session_state_cache_disk_errors(tmp_path) -> None:
+    """Test each process spills in its own folder, and a state lost on disk is a cache miss"""
+    os.makedirs(tmp_path / "999999999")
+    cache = SessionStateCache(100, str(tmp_path), disk_capacity_bytes=100)
+    assert cache.disk_path == str(tmp_path / str(os.getpid()))
+    # The folder of a process not running anymore is removed
+    assert not os.path.exists(tmp_path / "999999999")
+    cache[(1, 2)] = state(60)
+    cache[(3, 4)] = state(60)
+    for name in os.listdir(cache.disk_path):
+        os.remove(os.path.join(cache.disk_path, name))
+    with pytest.raises(KeyError):
+        cache[(1, 2, 3)]
+    assert cache.stats()["states_on_disk"] == 0
+    assert cache.stats()["misses"] == 1
+
+
+def test_static_prefix() -> None:
+    """Test the static prefix of a prompt template stops at its first variable"""
+    assert static_prefix("You are an assistant {{json}}.\nContext: {context}\n{question}") == (
+        "You are an assistant {json}.\nContext: "
+    )
+    assert static_prefix("{input}") == ""
+
+
+def test_prefix_state_context_size(tmp_path) -> None:
+    """Test the state of the prompt prefix is only restored in a context of the same size"""
+    model_path = tmp_path / "model.gguf"
+    model_path.write_bytes(b"model")
+    path = prefix_state_path(str(model_path), "You are an assistant", 2048, "replicas")
+    assert path != prefix_state_path(str(model_path), "You are an assistant", 2048, "batched")
+    assert path != prefix_state_path(str(model_path), "You are an assistant", 4096, "replicas")
+    save_state(path, SimpleNamespace(input_ids=[0] * 2048, n_tokens=5, llama_state_size=10))
+    assert load_prefix_state(path, SimpleNamespace(n_ctx=lambda: 2048)) is not None
+    assert load_prefix_state(path, SimpleNamespace(n_ctx=lambda: 18432)) is None
+    assert load_prefix_state(f"{path}.missing", SimpleNamespace(n_ctx=lambda: 2048)) is None
+
+
+def test_save_prefix_state_read_only(tmp_path) -> None:
+    """Test the state of the prompt prefix is only kept in memory when it cannot be written"""
+    state = SimpleNamespace(input_ids=[0] * 2048, n_tokens=5, llama_state_size=10)
+    assert not save_prefix_state(str(tmp_path / "read-only" / "model.state"), state)
+    assert save_prefix_state(str(tmp_path / "model.state"), state)
+    assert os.listdir(tmp_path) == ["model.state"]
@@ -5,6 +5,7 @@ import pytest
 
 from libre_chat.conf import parse_conf
 from libre_chat.llm import Llm
+from libre_chat.vectorstore import is_vectorstore_up_to_date, load_manifest
 
 llm = Llm(conf=parse_conf("config/chat-vectorstore-qa.yml"))
 capital_query = "What is the capital of the Netherlands?"
@@ -55,6 +56,51 @@ def test_build_vectorstore() -> None:
     assert os.path.exists(llm.conf.vector.vector_path)
 
 
+def test_vectorstore_fingerprint() -> None:
+    """Test the vectorstore is not rebuilt when documents and settings did not change"""
+    llm.build_vectorstore()
+    assert is_vectorstore_up_to_date(llm.conf, llm.document_loaders, llm.conf.vector.vector_path)
+    conf = parse_conf("config/chat-vectorstore-qa.yml")
+    conf.vector.chunk_size = 200
+    assert not is_vectorstore_up_to_date(conf, llm.document_loaders, conf.vector.vector_path)
+
+
+def test_update_vectorstore() -> None:
+    """Test only adding and removing the documents that changed"""
+    llm.build_vectorstore()
+    with open("documents/test_update.txt", "w") as f:
+        f.write("The capital of Belgium is Brussels.")
+    llm.update_vectorstore()
+    manifest = load_manifest(llm.conf.vector.vector_path)
+    assert manifest is not None
+    assert len(manifest["files"]["test_update.txt"]["chunk_ids"]) == 1
+    os.remove("documents/test_update.txt")
+    llm.update_vectorstore()
+    manifest = load_manifest(llm.conf.vector.vector_path)
+    assert manifest is not None
+    assert "test_update.txt" not in manifest["files"]
+
+
+def test_retrieval_cache_version_reload() -> None:
+    """Test the cached retrievals are keyed by the version of the vectorstore loaded"""
+    llm.reload_vectorstore()
+    version = llm.vectorstore_version
+    assert llm.dbqa.retriever.version == version != ""
+    llm.query(capital_query)
+    with open("documents/test_reload.txt", "w") as f:
+        f.write("The capital of Belgium is Brussels.")
+    llm.update_vectorstore()
+    os.remove("documents/test_reload.txt")
+    llm.reload_vectorstore()
+    manifest = load_manifest(llm.conf.vector.vector_path)
+    assert manifest is not None
+    assert llm.vectorstore_version == manifest["fingerprint"] != version
+    assert llm.dbqa.retriever.version == llm.vectorstore_version
+    assert llm.retrieval_cache and llm.retrieval_cache.version == llm.vectorstore_version
+    assert llm.retrieval_cache.stats()["results"] == 0
+    llm.update_vectorstore()
+
+
 def test_build_failed_no_docs() -> None:
     """Test fail building the vectorstore when no documents"""
     conf = parse_conf("config/chat-vectorstore-qa.yml")
@@ -0,0 +1,42 @@
+from typing import List
+
+from langchain.schema.embeddings import Embeddings
+
+from libre_chat.response_cache import ResponseCache
+
+
+class LetterEmbeddings(Embeddings):
+    """Embed texts by the count of a few letters"""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(text.count(letter)) for letter in "aeiou"]
+
+
+def test_response_cache_exact() -> None:
+    """Test responses are found by normalized prompt, evicted, and dropped when the scope changes"""
+    cache = ResponseCache(max_entries=2)
+    cache.put("What is the capital of France?", "v1", {"result": "Paris"})
+    assert cache.get("  what is the capital   of France?", "v1") == {"result": "Paris"}
+    cache.put("Capital of Italy?", "v1", {"result": "Rome"})
+    cache.put("Capital of Spain?", "v1", {"result": "Madrid"})
+    assert cache.get("Capital of Italy?", "v1") == {"result": "Rome"}
+    # Least recently used entry evicted
+    assert cache.get("What is the capital of France?", "v1") is None
+    # Vectorstore or template changed
+    assert cache.get("Capital of Italy?", "v2") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["hits"] == 2
+
+
+def test_response_cache_semantic_and_ttl() -> None:
+    """Test responses to similar prompts are reused above the threshold, and entries expire"""
+    cache = ResponseCache(semantic_threshold=0.99, embeddings=LetterEmbeddings())
+    cache.put("banana", "v1", {"result": "fruit"})
+    assert cache.get("bananas", "v1") == {"result": "fruit"}
+    assert cache.get("kiwi", "v1") is None
+    assert cache.stats()["semantic_hits"] == 1
+    cache.ttl = 0
+    assert cache.get("banana", "v1") is None
@@ -0,0 +1,62 @@
+from typing import List
+
+from langchain.schema.document import Document
+from langchain.schema.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+
+from libre_chat.retriever import CachedRetriever, RetrievalCache
+
+
+class CountingEmbeddings(Embeddings):
+    """Embed texts by the count of a few letters, and count the queries embedded"""
+
+    def __init__(self) -> None:
+        self.queries = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [[float(text.count(letter)) for letter in "aeiou"] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries += 1
+        return self.embed_documents([text])[0]
+
+
+def test_cached_retriever() -> None:
+    """Test repeated queries are answered from the cache, until the vectorstore version changes"""
+    embeddings = CountingEmbeddings()
+    vectorstore = FAISS.from_texts(["banana", "kiwi", "apple"], embeddings)
+    cache = RetrievalCache()
+    cache.set_version("v1")
+    retriever = CachedRetriever(
+        vectorstore=vectorstore, cache=cache, version="v1", search_kwargs={"k": 1}
+    )
+    docs = retriever.get_relevant_documents("Bananas")
+    assert docs == [Document(page_content="banana")]
+    assert retriever.get_relevant_documents("  bananas ") == docs
+    assert embeddings.queries == 1
+    assert cache.stats()["hits"] == 1
+    cache.set_version("v2")
+    retriever = CachedRetriever(vectorstore=vectorstore, cache=cache, version="v2")
+    retriever.get_relevant_documents("bananas")
+    assert embeddings.queries == 2
+    assert cache.stats()["misses"] == 2
+
+
+def test_cached_retriever_normalized_query() -> None:
+    """Test the query embedded is the normalized one, whichever variant of the query comes first"""
+    embedded: List[str] = []
+
+    class RecordingEmbeddings(CountingEmbeddings):
+        def embed_query(self, text: str) -> List[float]:
+            embedded.append(text)
+            return super().embed_query(text)
+
+    vectorstore = FAISS.from_texts(["banana", "kiwi", "apple"], RecordingEmbeddings())
+    retriever = CachedRetriever(
+        vectorstore=vectorstore,
+        cache=RetrievalCache(),
+        search_type="similarity_score_threshold",
+        search_kwargs={"k": 2, "score_threshold": 0.5},
+    )
+    assert len(retriever.get_relevant_documents("  KIWI ")) <= 2
+    assert embedded == ["kiwi"]
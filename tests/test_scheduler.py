@@ -0,0 +1,94 @@
+"""Test the scheduler queuing requests to the LLM"""
+import asyncio
+import threading
+import time
+from typing import List
+
+import pytest
+
+from libre_chat.scheduler import (
+    PRIORITY_API,
+    PRIORITY_CHAT,
+    InferenceScheduler,
+    SchedulerFullError,
+    SchedulerTimeoutError,
+)
+
+
+def test_scheduler_priority() -> None:
+    """Test requests waiting for the LLM are served by priority"""
+    scheduler = InferenceScheduler(slots=1, max_queue=4, max_wait=5)
+    served: List[str] = []
+    slot = scheduler.acquire()
+
+    def wait(name: str, priority: int) -> None:
+        with scheduler.slot(priority):
+            served.append(name)
+
+    threads = [threading.Thread(target=wait, args=("api", PRIORITY_API))]
+    threads.append(threading.Thread(target=wait, args=("chat", PRIORITY_CHAT)))
+    for thread in threads:
+        thread.start()
+        time.sleep(0.1)
+    assert scheduler.stats()["queued"] == 2
+    scheduler.release(slot)
+    for thread in threads:
+        thread.join()
+    assert served == ["chat", "api"]
+    assert scheduler.stats()["served"] == 3
+
+
+def test_scheduler_full_and_timeout() -> None:
+    """Test requests are rejected when the queue is full, or when they waited too long"""
+    scheduler = InferenceScheduler(slots=1, max_queue=0, max_wait=0.1)
+    slot = scheduler.acquire()
+    with pytest.raises(SchedulerFullError) as exc_info:
+        scheduler.acquire()
+    assert exc_info.value.retry_after >= 1
+    scheduler.max_queue = 1
+    with pytest.raises(SchedulerTimeoutError):
+        scheduler.acquire()
+    assert scheduler.stats()["queued"] == 0
+    scheduler.release(slot)
+    assert scheduler.stats()["rejected"] == 1
+    assert scheduler.stats()["timed_out"] == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_async() -> None:
+    """Test async requests wait for a slot released by another thread"""
+    scheduler = InferenceScheduler(slots=1, max_queue=2, max_wait=5)
+    slot = scheduler.acquire()
+    threading.Timer(0.1, scheduler.release, args=[slot]).start()
+    async with scheduler.aslot() as new_slot:
+        assert new_slot == slot
+    scheduler.max_wait = 0.1
+    with scheduler.slot(), pytest.raises(SchedulerTimeoutError):
+        await asyncio.wait_for(scheduler.aacquire(), 1)
+    assert scheduler.stats()["busy"] == 0
+
+
+def test_scheduler_replicas() -> None:
+    """Test concurrent requests are dispatched to different slots, and their utilization reported"""
+    scheduler = InferenceScheduler(slots=2, max_queue=2, max_wait=1)
+    with scheduler.slot() as first, scheduler.slot() as second:
+        assert {first, second} == {0, 1}
+        time.sleep(0.05)
+        assert scheduler.stats()["busy"] == 2
+    replicas = scheduler.stats()["replicas"]
+    assert [replica["requests"] for replica in replicas] == [1, 1]
+    assert all(0 < replica["utilization"] <= 1 for replica in replicas)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancelled() -> None:
+    """Test a client going away while waiting is counted as cancelled, not timed out"""
+    scheduler = InferenceScheduler(slots=1, max_queue=2, max_wait=5)
+    with scheduler.slot():
+        waiting = asyncio.ensure_future(scheduler.aacquire())
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    stats = scheduler.stats()
+    assert (stats["cancelled"], stats["timed_out"], stats["queued"]) == (1, 0, 0)
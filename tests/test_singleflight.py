@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import pytest
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from libre_chat.singleflight import SingleFlight
+
+
+def test_singleflight_sync() -> None:
+    """Test concurrent calls with the same key share the result of a single call"""
+    flights = SingleFlight()
+    calls: List[int] = []
+    results: List[Dict[str, Any]] = []
+
+    def generate() -> Dict[str, Any]:
+        calls.append(1)
+        time.sleep(0.2)
+        return {"result": "Paris"}
+
+    threads = [
+        threading.Thread(target=lambda: results.append(flights.do("paris", generate)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"result": "Paris"}] * 3
+    assert flights.stats() == {"running": 0, "generations": 1, "coalesced": 2}
+
+
+class TokensCallback:
+    def __init__(self) -> None:
+        self.tokens: List[str] = []
+        self.received: List[float] = []
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.append(token)
+        self.received.append(time.monotonic())
+
+
+@pytest.mark.asyncio
+async def test_singleflight_async_stream() -> None:
+    """Test async calls attached to a running generation get all its tokens"""
+    flights = SingleFlight()
+
+    async def generate(callbacks: List[Any]) -> str:
+        for token in ["The", " capital", " is", " Paris"]:
+            for callback in callbacks:
+                await callback.on_llm_new_token(token)
+            await asyncio.sleep(0.05)
+        return "The capital is Paris"
+
+    first, second = TokensCallback(), TokensCallback()
+    leader = asyncio.ensure_future(flights.ado("paris", generate, [first]))
+    await asyncio.sleep(0.08)
+    results = await asyncio.gather(leader, flights.ado("paris", generate, [second]))
+    assert results == ["The capital is Paris"] * 2
+    assert first.tokens == second.tokens == ["The", " capital", " is", " Paris"]
+    assert flights.stats()["generations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_singleflight_async_cancel() -> None:
+    """Test cancelling the leader does not cancel the generation of the other requests,
+    and the generation is cancelled when no request is left"""
+    flights = SingleFlight()
+    cancelled: List[bool] = []
+
+    async def generate(callbacks: List[Any]) -> str:
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "Paris"
+
+    leader = asyncio.ensure_future(flights.ado("paris", generate))
+    await asyncio.sleep(0.01)
+    follower = asyncio.ensure_future(flights.ado("paris", generate))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    assert await follower == "Paris"
+    assert leader.cancelled() and not cancelled
+
+    requests = [asyncio.ensure_future(flights.ado("rome", generate)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    for request in requests:
+        request.cancel()
+    await asyncio.sleep(0.01)
+    assert cancelled == [True]
+    assert flights.stats()["running"] == 0
+
+
+class SlowCallback(TokensCallback):
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        await asyncio.sleep(0.5)
+        await super().on_llm_new_token(token)
+
+
+@pytest.mark.asyncio
+async def test_singleflight_async_slow_subscriber() -> None:
+    """Test a slow request does not hold back the tokens streamed to the others"""
+    flights = SingleFlight()
+    fast, slow = TokensCallback(), SlowCallback()
+
+    async def generate(callbacks: List[Any]) -> str:
+        for token in ["Paris", " is", " nice"]:
+            for callback in callbacks:
+                await callback.on_llm_new_token(token)
+        await asyncio.sleep(0.1)
+        return "Paris is nice"
+
+    requests = asyncio.gather(
+        flights.ado("paris", generate, [slow]), flights.ado("paris", generate, [fast])
+    )
+    await asyncio.sleep(0.05)
+    assert fast.tokens == ["Paris", " is", " nice"]
+    assert slow.tokens == []
+    assert await requests == ["Paris is nice"] * 2
+    assert slow.tokens == ["Paris", " is", " nice"]
+
+
+class SyncLLM(LLM):
+    """LLM without native async, like LlamaCpp: langchain runs it in an executor thread"""
+
+    @property
+    def _llm_type(self) -> str:
+        return "sync"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        for token in ["The", " capital", " is", " Paris"]:
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            time.sleep(0.1)
+        return "The capital is Paris"
+
+
+@pytest.mark.asyncio
+async def test_singleflight_async_executor_thread() -> None:
+    """Test the tokens of a sync LLM generating in an executor thread are streamed as generated"""
+    flights = SingleFlight()
+    first, second = TokensCallback(), TokensCallback()
+
+    async def generate(callbacks: List[Any]) -> str:
+        return await SyncLLM().ainvoke("capital?", config={"callbacks": callbacks})
+
+    start = time.monotonic()
+    results = await asyncio.gather(
+        flights.ado("paris", generate, [first]), flights.ado("paris", generate, [second])
+    )
+    assert results == ["The capital is Paris"] * 2
+    assert first.tokens == second.tokens == ["The", " capital", " is", " Paris"]
+    # Received while the generation is running, not in a burst at the end
+    assert first.received[0] - start < 0.2 and second.received[0] - start < 0.2
@@ -0,0 +1,49 @@
+from typing import List
+
+from langchain.schema.document import Document
+
+from libre_chat.splitter import TokenAwareTextSplitter
+
+calls: List[int] = []
+
+
+def count_words(texts: List[str]) -> List[int]:
+    """Count one token per word, and per 10 characters of a long word"""
+    calls.append(len(texts))
+    return [sum(max(len(word) // 10, 1) for word in text.split()) for text in texts]
+
+
+def test_token_aware_splitter() -> None:
+    """Test chunks are sized in tokens, and the pieces of all the texts are counted together"""
+    calls.clear()
+    paragraph = " ".join(f"word{i}" for i in range(30)) + ". " + " ".join("end" for _ in range(5))
+    texts = [paragraph + "\n\n" + paragraph for _ in range(20)]
+    splitter = TokenAwareTextSplitter(count_words, chunk_size=12, chunk_overlap=0)
+    docs = splitter.split_documents([Document(page_content=t, metadata={"p": 0}) for t in texts])
+    # One batched call for the texts, one per level of separator, and one for the chunks
+    assert len(calls) <= 2 + len(splitter.separators)
+    assert all(count_words([doc.page_content])[0] <= 12 for doc in docs)
+    assert " ".join(d.page_content for d in docs[: len(docs) // 20]).split() == texts[0].split()
+    assert docs[0].metadata == {"p": 0}
+    report = splitter.report()
+    assert report and "p50" in report and "over the limit" not in report
+
+
+def test_token_aware_splitter_overlap() -> None:
+    """Test chunks overlap, and words without separator are cut"""
+    splitter = TokenAwareTextSplitter(count_words, chunk_size=10, chunk_overlap=3)
+    chunks = splitter.split_text(" ".join(str(i) for i in range(40)) + " " + "x" * 300)
+    assert chunks[0].split()[-3:] == chunks[1].split()[:3]
+    assert max(splitter.lengths) <= 10
+    assert "".join(chunks).count("x") >= 300
+
+
+def test_token_aware_splitter_report_lengths() -> None:
+    """Test the lengths reported are the token counts of the chunks, not the sums of their pieces"""
+
+    def count_with_bos(texts: List[str]) -> List[int]:
+        return [len(text.split()) + 1 for text in texts]
+
+    splitter = TokenAwareTextSplitter(count_with_bos, chunk_size=10, chunk_overlap=0)
+    chunks = splitter.split_text(" ".join(f"word{i}" for i in range(40)))
+    assert splitter.lengths == count_with_bos(chunks)
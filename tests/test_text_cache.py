@@ -0,0 +1,76 @@
+import os
+from typing import List
+
+from langchain.schema.document import Document
+
+from libre_chat.text_cache import TextCache
+from libre_chat.vectorstore import load_file
+
+
+class CountingLoader:
+    """Loader counting the files it parsed"""
+
+    loaded = 0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def load(self) -> List[Document]:
+        CountingLoader.loaded += 1
+        with open(self.path) as file:
+            return [Document(page_content=file.read(), metadata={"source": self.path, "page": 0})]
+
+
+def test_text_cache_load_file(tmp_path) -> None:
+    """Test the text of a file is only extracted once for the same content and loader"""
+    cache = TextCache(str(tmp_path / "text_cache"))
+    doc_loads = [{"glob": "*.txt", "loader_cls": CountingLoader}]
+    path = str(tmp_path / "amsterdam.txt")
+    with open(path, "w") as file:
+        file.write("Amsterdam is the capital of the Netherlands")
+    first = load_file(path, doc_loads, cache, "hash1")
+    assert load_file(path, doc_loads, cache, "hash1") == first
+    assert CountingLoader.loaded == 1
+    # The same content at another path
+    moved = load_file(str(tmp_path / "moved.txt"), doc_loads, cache, "hash1")
+    assert moved[0].metadata == {"source": str(tmp_path / "moved.txt"), "page": 0}
+    assert CountingLoader.loaded == 1
+    load_file(path, doc_loads, cache, "hash2")
+    assert CountingLoader.loaded == 2
+    assert cache.stats()["entries"] == 2
+
+
+def test_text_cache_prune(tmp_path) -> None:
+    """Test the least recently used entries are pruned first"""
+    cache = TextCache(str(tmp_path))
+    doc_load = {"glob": "*.txt", "loader_cls": CountingLoader}
+    for i in range(3):
+        cache.put(f"hash{i}", doc_load, "doc.txt", [Document(page_content="x" * 1000)])
+        entry_path = cache._entry_path(cache.key(f"hash{i}", doc_load))
+        os.utime(entry_path, (1000 + i, 1000 + i))
+    assert cache.get("hash0", doc_load, "doc.txt")
+    size = sum(size for _, size, _ in cache.entries())
+    assert cache.prune(max_bytes=size - 1) == 1
+    assert cache.get("hash1", doc_load, "doc.txt") is None
+    assert cache.get("hash0", doc_load, "doc.txt")
+    assert cache.prune(max_days=1) == 1
+    assert cache.stats()["entries"] == 1
+
+
+def test_text_cache_corrupted_entry(tmp_path, monkeypatch) -> None:
+    """Test a corrupted entry is a miss, even when another worker already removed it"""
+    cache = TextCache(str(tmp_path))
+    doc_load = {"glob": "*.txt", "loader_cls": CountingLoader}
+    cache.put("hash0", doc_load, "doc.txt", [Document(page_content="Amsterdam")])
+    entry_path = cache._entry_path(cache.key("hash0", doc_load))
+    with open(entry_path, "wb") as file:
+        file.write(b"not gzip")
+    real_remove = os.remove
+
+    def removed_by_another_worker(path: str) -> None:
+        real_remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "remove", removed_by_another_worker)
+    assert cache.get("hash0", doc_load, "doc.txt") is None
+    assert not os.path.exists(entry_path)
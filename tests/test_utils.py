@@ -1,9 +1,20 @@
+import io
 import os
+import zipfile
 
 import pytest
 
+import libre_chat.utils
 from libre_chat.conf import parse_conf
-from libre_chat.utils import ChatResponse, download_file, parallel_download
+from libre_chat.utils import (
+    ChatResponse,
+    FileTooLargeError,
+    UnsafeFileError,
+    download_file,
+    extract_zip,
+    parallel_download,
+    save_stream,
+)
 
 
 def test_no_conf_file() -> None:
@@ -42,3 +53,41 @@ def test_parallel_download_success() -> None:
     ]
     parallel_download(ddl_test)
     assert os.path.exists("tests/tmp/amsterdam.txt")
+
+
+def test_save_stream_limit(tmp_path) -> None:
+    """Test files are written by chunks, and not written when larger than the limit"""
+    path = str(tmp_path / "doc.txt")
+    assert save_stream(io.BytesIO(b"x" * 3000), path, max_bytes=3000) == 3000
+    assert save_stream(iter([b"ab", b"cd"]), path) == 4
+    with pytest.raises(FileTooLargeError):
+        save_stream(io.BytesIO(b"x" * 3001), path, max_bytes=3000)
+    with open(path, "rb") as file:
+        assert file.read() == b"abcd"
+    assert os.listdir(tmp_path) == ["doc.txt"]
+
+
+def test_extract_zip(tmp_path, monkeypatch) -> None:
+    """Test zip files are extracted by several threads, unless they are unsafe"""
+    zip_path = str(tmp_path / "docs.zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for i in range(5):
+            zip_ref.writestr(f"folder/doc{i}.txt", os.urandom(1000 + i))
+    monkeypatch.setattr(libre_chat.utils, "PARALLEL_UNZIP_MIN_BYTES", 0)
+    files = extract_zip(zip_path, str(tmp_path / "out"), max_ratio=10, workers=3)
+    assert len(files) == 5
+    assert os.path.getsize(tmp_path / "out" / "folder" / "doc4.txt") == 1004
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("bomb.txt", b"0" * 1000000)
+    with pytest.raises(FileTooLargeError):
+        extract_zip(zip_path, str(tmp_path / "bomb"), max_ratio=100)
+    with pytest.raises(FileTooLargeError):
+        extract_zip(zip_path, str(tmp_path / "bomb"), max_file_bytes=1000)
+    assert not os.path.exists(tmp_path / "bomb")
+
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        zip_ref.writestr("../outside.txt", b"content")
+    with pytest.raises(UnsafeFileError):
+        extract_zip(zip_path, str(tmp_path / "out"))
+    assert not os.path.exists(tmp_path / "outside.txt")
@@ -0,0 +1,87 @@
+"""Test loading the documents on a pool of processes, and updating the vectorstore"""
+import json
+import os
+from typing import List
+
+from langchain.schema.document import Document
+from langchain_community.document_loaders import TextLoader
+
+from libre_chat import vectorstore
+from libre_chat.conf import ChatConf
+from libre_chat.vectorstore import (
+    INDEX_FILES,
+    MANIFEST_FILE,
+    is_vectorstore_up_to_date,
+    load_files,
+    load_manifest,
+    settings_fingerprint,
+    stat_documents,
+    update_vectorstore,
+    vectorstore_fingerprint,
+)
+
+
+class CrashingLoader(TextLoader):
+    """Text loader crashing the process loading crash.txt"""
+
+    def load(self) -> List[Document]:
+        if os.path.basename(self.file_path) == "crash.txt":
+            os._exit(1)
+        return super().load()
+
+
+def test_load_files_worker_crash(tmp_path) -> None:
+    """Test a file crashing its worker process only fails this file, the others are loaded"""
+    for name in ["a.txt", "crash.txt", "b.txt", "c.txt"]:
+        (tmp_path / name).write_text(f"Content of {name}")
+    conf = ChatConf()
+    conf.vector.documents_path = str(tmp_path)
+    conf.vector.text_cache_path = None
+    conf.vector.ingest_workers = 2
+    doc_loads = [{"glob": "*.txt", "loader_cls": CrashingLoader}]
+    files = {name: doc_loads for name in ["a.txt", "crash.txt", "b.txt", "c.txt"]}
+    results = {filename: (docs, error) for filename, docs, error in load_files(conf, files)}
+    assert list(results) == ["a.txt", "crash.txt", "b.txt", "c.txt"]
+    assert "BrokenProcessPool" in str(results["crash.txt"][1])
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        docs, error = results[name]
+        assert error is None and docs[0].page_content == f"Content of {name}"
+
+
+def test_update_vectorstore_touched_file(tmp_path, monkeypatch) -> None:
+    """Test touching a file does not load the index, and the new modification time is recorded"""
+    documents_path = tmp_path / "documents"
+    vector_path = tmp_path / "vectorstore"
+    documents_path.mkdir()
+    vector_path.mkdir()
+    (documents_path / "a.txt").write_text("Content of a.txt")
+    conf = ChatConf()
+    conf.vector.documents_path = str(documents_path)
+    doc_loads = [{"glob": "*.txt", "loader_cls": TextLoader}]
+    files = {"a.txt": doc_loads}
+    stats = stat_documents(str(documents_path), files)
+    settings = settings_fingerprint(conf, doc_loads)
+    manifest = {
+        "documents_path": str(documents_path),
+        "settings": settings,
+        "fingerprint": vectorstore_fingerprint(settings, stats),
+        "files": {"a.txt": {**stats["a.txt"], "chunk_ids": ["0"]}},
+    }
+    (vector_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    (vector_path / INDEX_FILES[0]).write_text("")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The file should not be loaded nor hashed")
+
+    monkeypatch.setattr(vectorstore, "get_embeddings", fail)
+    for mtime in [1_000_000_000, 2_000_000_000]:
+        os.utime(documents_path / "a.txt", ns=(mtime, mtime))
+        if mtime == 1_000_000_000:
+            assert update_vectorstore(conf, doc_loads, "cpu", str(vector_path)) is None
+        else:
+            assert is_vectorstore_up_to_date(conf, doc_loads, str(vector_path))
+        updated = load_manifest(str(vector_path))
+        assert updated is not None and updated["files"]["a.txt"]["mtime"] == mtime
+    # The file is not hashed again on the next start
+    monkeypatch.setattr(vectorstore, "hash_file", fail)
+    assert is_vectorstore_up_to_date(conf, doc_loads, str(vector_path))
@@ -0,0 +1,54 @@
+from libre_chat.conf import ChatConf
+from libre_chat.jobs import IngestionJobs
+from libre_chat.watcher import DocumentsWatcher
+
+loaders = [{"glob": "*.txt"}]
+
+
+def test_watcher_changes(tmp_path) -> None:
+    """Test files created, modified and deleted are submitted once they stopped changing"""
+    conf = ChatConf()
+    conf.vector.documents_path = str(tmp_path / "documents")
+    conf.vector.ingest_debounce = 60
+    (tmp_path / "documents").mkdir()
+    (tmp_path / "documents" / "ignored.pdf.part").write_text("ignored")
+    jobs = IngestionJobs(conf, loaders, "cpu", str(tmp_path / "vectorstore"))
+    watcher = DocumentsWatcher(conf, jobs, loaders)
+    assert watcher.check() == []
+
+    doc = tmp_path / "documents" / "doc.txt"
+    doc.write_text("Amsterdam")
+    # Still being written until the next scan
+    assert watcher.check() == []
+    assert watcher.check() == ["doc.txt"]
+    assert watcher.check() == []
+    doc.write_text("Amsterdam is the capital of the Netherlands")
+    watcher.check()
+    assert watcher.check() == ["doc.txt"]
+    doc.unlink()
+    assert watcher.check() == []
+    assert watcher.check() == ["doc.txt"]
+
+    stats = watcher.stats()
+    # Changes received while the job waits to start are added to this job
+    assert stats["changes_detected"] == 3
+    assert stats["queue_jobs"] == 1 and stats["queue_files"] == 1
+    assert stats["documents"] == 0
+    jobs.close()
+
+
+def test_watcher_single_process(tmp_path) -> None:
+    """Test only one watcher runs for a vectorstore, when several workers start one"""
+    conf = ChatConf()
+    conf.vector.documents_path = str(tmp_path / "documents")
+    conf.vector.watch_interval = 60
+    (tmp_path / "documents").mkdir()
+    jobs = IngestionJobs(conf, loaders, "cpu", str(tmp_path / "vectorstore"))
+    first = DocumentsWatcher(conf, jobs, loaders)
+    second = DocumentsWatcher(conf, jobs, loaders)
+    assert first.start()
+    assert not second.start()
+    first.stop()
+    assert second.start()
+    second.stop()
+    jobs.close()